@@ -1,21 +1,288 @@
+import collections
 import datetime
+import os
+import threading
+import time
 
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import Q
+from account.models import ProfileInformation, get_account_from_user
+from hnet.logsegments import find_segments, read_segment_lines
+from hospital.models import ActivityLog
 
-def CreateLogEntry(user, message):
+DEFAULT_LOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'activity.log')
+
+LOG_PAGE_SIZE = 20
+
+# Defaults of the ACTIVITY_LOG_STREAM_* settings; see `follow_log`.
+LOG_STREAM_BACKLOG = 20
+LOG_STREAM_MAX_BACKLOG = 200
+LOG_STREAM_POLL_INTERVAL = 2
+LOG_STREAM_DURATION = 20
+
+# Default of the ACTIVITY_LOG_MAX_AGE_DAYS setting; see `prune_log`.
+LOG_MAX_AGE_DAYS = 400
+LOG_PRUNE_BATCH_SIZE = 1000
+
+# The entries logged while handling the current request; see `hnet.middleware.ActivityLogMiddleware`.
+_request_state = threading.local()
+
+
+def CreateLogEntry(user, message, target=None):
     """
-    Creates a Log entry that is saved into a activity.log text file
-    :param user:
-    :param message:
+    Creates a Log entry that is saved into the ActivityLog table.
+    Within a request, the entry is saved along with every other entry of the request when the response is sent.
+    :param user: A `User` object, or a username.
+    :param message: A log message, one of the messages in `ActivityLog.ACTIONS`.
+    :param target: The model object the action was performed on, if any.
     :return: null
     """
-    log_file = open('hnet/activity.log', 'a')
-    log_file.write(
-        "" + datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + ", " + str(user) + ", " + message + "\n")
+    entry = ActivityLog()
+    if isinstance(user, User):
+        entry.user = user
+        entry.username = user.username
+    else:
+        entry.username = str(user)
+    entry.action, entry.detail = ActivityLog.action_for_message(message)
+    if target is not None:
+        entry.target = target
+
+    entries = getattr(_request_state, 'entries', None)
+    if entries is None:
+        save_log_entries([entry])
+    else:
+        entries.append(entry)
+
+
+def begin_request(request):
+    """Start collecting log entries for a request, instead of saving them one at a time."""
+
+    _request_state.entries = []
+
+
+def finish_request(request):
+    """Save the log entries collected for a request."""
+
+    entries = getattr(_request_state, 'entries', None)
+    _request_state.entries = None
+    if entries:
+        save_log_entries(entries, getattr(request, 'user', None))
+
+
+def save_log_entries(entries, request_user=None):
+    """
+    Fill in the user, account type and hospital of unsaved log entries, and save them in one query.
+    :param entries: A list of unsaved `ActivityLog` objects.
+    :param request_user: The user of the current request, if any, which doesn't have to be looked up.
+    """
+
+    users = {}
+    if request_user is not None and request_user.is_authenticated():
+        users[request_user.username] = request_user
+    for entry in entries:
+        if entry.user_id is not None:
+            users[entry.username] = entry.user
+    missing = set(entry.username for entry in entries if entry.username and entry.username not in users)
+    if missing:
+        users.update((user.username, user) for user in User.objects.filter(username__in=missing))
+
+    accounts = {}
+    for entry in entries:
+        user = users.get(entry.username)
+        if user is None:
+            continue
+        if user.username not in accounts:
+            accounts[user.username] = describe_account(user)
+        entry.user = user
+        entry.account_type, entry.hospital = accounts[user.username]
+
+    ActivityLog.objects.bulk_create(entries)
+
+
+def describe_account(user):
+    """
+    Get the account type and the hospital of a user.
+    :return: A tuple of the account type ('' for users without an account) and a `Hospital` (or None).
+    """
+
+    profile_information = ProfileInformation.from_user(user)
+    if profile_information is None:
+        return '', None
+    account = get_account_from_user(user)
+    hospital = getattr(account, 'hospital', None) or getattr(account, 'preferred_hospital', None)
+    return profile_information.account_type, hospital
+
+
+LogPage = collections.namedtuple('LogPage', ['entries', 'newer', 'older'])
+
+
+def read_log_page(entries, before=None, after=None, page_size=LOG_PAGE_SIZE):
+    """
+    Read one page of log entries, newest first, by keyset pagination on (timestamp, id).
+    Every page is a single indexed range query, however far back in the log it is.
+    :param entries: An `ActivityLog` queryset, already filtered.
+    :param before: The id of an entry; read the entries older than it.
+    :param after: The id of an entry; read the entries newer than it.
+    :return: A `LogPage` with the entries, and the ids to pass as `after` and `before` for the
+             newer and older pages (None if there's no such page).
+    """
+
+    if after is not None:
+        boundary = ActivityLog.objects.filter(pk=after).values_list('timestamp', flat=True).first()
+        if boundary is not None:
+            page = list(entries.filter(Q(timestamp__gt=boundary) | Q(timestamp=boundary, pk__gt=after))
+                        .order_by('timestamp', 'pk')[:page_size + 1])
+            has_newer = len(page) > page_size
+            page = page[:page_size]
+            page.reverse()
+            if page:
+                return LogPage(page, page[0].pk if has_newer else None, page[-1].pk)
+
+    has_newer = False
+    if before is not None:
+        boundary = ActivityLog.objects.filter(pk=before).values_list('timestamp', flat=True).first()
+        if boundary is not None:
+            entries = entries.filter(Q(timestamp__lt=boundary) | Q(timestamp=boundary, pk__lt=before))
+            has_newer = True
+
+    page = list(entries.order_by('-timestamp', '-pk')[:page_size + 1])
+    has_older = len(page) > page_size
+    page = page[:page_size]
+    return LogPage(page, page[0].pk if has_newer and page else None, page[-1].pk if has_older else None)
+
+
+def follow_log(entries, after=None, backlog=LOG_STREAM_BACKLOG, poll_interval=LOG_STREAM_POLL_INTERVAL,
+               duration=LOG_STREAM_DURATION, sleep=time.sleep):
+    """
+    Follow the activity log as a stream of server-sent events, one event per entry, oldest first.
+    Entries are followed in the (timestamp, id) order of the log pages (see `read_log_page`): each poll is a single
+    indexed query for the entries after the last one sent in that order, so a viewer costs the same however large
+    the log grows, and entries imported with earlier timestamps aren't sent as new activity.
+
+    The stream is a long poll: it ends as soon as it has sent some entries, or after `duration` seconds without any.
+    The browser then reconnects, resuming after the last event it received (its `Last-Event-ID`). A synchronous
+    worker is held by each viewer while its stream is open, so with the default duration a viewer holds a worker for
+    at most 20 seconds at a time, but every open log page still needs a worker most of the time: the worker pool has
+    to be larger than the number of viewers expected at once.
+    :param entries: An `ActivityLog` queryset, already filtered.
+    :param after: The id of the last entry the viewer has; if None, the last `backlog` entries are sent first.
+    :param duration: The most seconds to wait for new entries for.
+    :return: A generator of events, to be used as the content of a `StreamingHttpResponse`.
+    """
+
+    started = time.monotonic()
+    # Tell the browser how soon to reconnect once the stream ends.
+    yield 'retry: %d\n\n' % (poll_interval * 1000)
+
+    last = None
+    if after is not None:
+        boundary = ActivityLog.objects.filter(pk=after).values_list('timestamp', flat=True).first()
+        if boundary is not None:
+            last = (boundary, after)
+    if last is None:
+        # The viewer is new, or its last entry has since been pruned.
+        page = list(entries.order_by('-timestamp', '-pk')[:backlog]) if after is None and backlog > 0 else []
+        page.reverse()
+        for entry in page:
+            yield format_log_event(entry)
+        if page:
+            return
+        last = entries.order_by('-timestamp', '-pk').values_list('timestamp', 'pk').first()
+
+    while True:
+        new_entries = entries
+        if last is not None:
+            new_entries = entries.filter(Q(timestamp__gt=last[0]) | Q(timestamp=last[0], pk__gt=last[1]))
+        new_entries = list(new_entries.order_by('timestamp', 'pk')[:LOG_STREAM_MAX_BACKLOG])
+        for entry in new_entries:
+            yield format_log_event(entry)
+        if new_entries:
+            return
+        # A comment line keeps the connection open through proxies, and finds disconnected viewers.
+        yield ': keep-alive\n\n'
+
+        if time.monotonic() - started >= duration:
+            return
+        sleep(poll_interval)
+
+
+def get_log_max_age():
+    """
+    Get how long log entries are kept, as configured by the `ACTIVITY_LOG_MAX_AGE_DAYS` setting.
+    :return: A `timedelta`, or None if entries are kept forever.
+    """
+
+    days = getattr(settings, 'ACTIVITY_LOG_MAX_AGE_DAYS', LOG_MAX_AGE_DAYS)
+    return datetime.timedelta(days=days) if days is not None else None
+
+
+def prune_log(max_age, now=None, batch_size=LOG_PRUNE_BATCH_SIZE):
+    """
+    Delete the log entries older than a maximum age.
+    The entries are deleted in batches, each its own short transaction, so the log stays writable while a large
+    backlog is pruned. Each batch is a range query on the timestamp index.
+    :param max_age: A `timedelta`.
+    :return: The number of entries deleted.
+    """
+
+    if now is None:
+        now = datetime.datetime.now()
+    expired = ActivityLog.objects.filter(timestamp__lt=now - max_age)
+
+    deleted = 0
+    while True:
+        batch = list(expired.order_by('timestamp').values_list('pk', flat=True)[:batch_size])
+        if not batch:
+            return deleted
+        ActivityLog.objects.filter(pk__in=batch).delete()
+        deleted += len(batch)
+
+
+def format_log_event(entry):
+    """Format a log entry as a server-sent event, with the entry's id as the event id."""
+
+    return 'id: %d\ndata: %s\n\n' % (entry.pk, str(entry).replace('\n', ' '))
+
+
+def get_log_file():
+    """Get the path of the text activity log, as configured by the `ACTIVITY_LOG_FILE` setting."""
+
+    return getattr(settings, 'ACTIVITY_LOG_FILE', DEFAULT_LOG_FILE)
+
+
+def readLog(path=None):
+    """
+    Read the text activity log, including its rotated segments, oldest entries first.
+    Segments are decompressed one at a time, as the lines are consumed.
+    :return: A generator of log lines.
+    """
+    if path is None:
+        path = get_log_file()
+    for segment in find_segments(path):
+        for line in read_segment_lines(segment):
+            yield line
+    try:
+        with open(path, 'r') as file:
+            for line in file:
+                yield line
+    except FileNotFoundError:
+        pass
+
+
+def parse_log_line(line):
+    """
+    Parse a line of the text activity log, formatted as '<timestamp>, <username>, <message>'.
+    :return: An unsaved `ActivityLog` object, or None if the line isn't a well-formed log entry.
+    """
 
+    parts = line.rstrip('\n').split(', ', 2)
+    if len(parts) != 3:
+        return None
+    try:
+        timestamp = datetime.datetime.strptime(parts[0], "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return None
 
-def readLog():
-    log = []
-    file = open('HNet/activity.log', 'r')
-    for line in file:
-        log.append(line)
-    return log
+    action, detail = ActivityLog.action_for_message(parts[2])
+    return ActivityLog(timestamp=timestamp, username=parts[1], action=action, detail=detail)
@@ -0,0 +1,107 @@
+"""
+Rotated segments of the text activity log, which was written before the log moved into the database.
+
+A segment is a standard gzip file (readable with `zcat`) holding a contiguous run of log lines.
+Its gzip header carries an 'extra' field recording the timestamps of the first and last lines and the number of
+lines, so a segment can be described by reading the first few dozen bytes of the file, without decompressing it.
+"""
+import collections
+import os
+import re
+import struct
+import time
+import zlib
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+GZIP_DEFLATE = 8
+GZIP_FLAG_EXTRA = 4
+
+# The subfield ID of the segment header in the gzip 'extra' field, followed by its payload:
+# first timestamp, last timestamp and line count.
+HEADER_ID = b'HN'
+HEADER = struct.Struct('<19s19sQ')
+GZIP_PREFIX = struct.Struct('<2sBBIBBH2sH')
+
+TIMESTAMP_LENGTH = 19
+
+Segment = collections.namedtuple('Segment', ['path', 'number', 'first', 'last', 'lines'])
+
+
+def write_segment(path, data):
+    """
+    Compress log lines into a segment file.
+    :param path: The path of the segment file to create.
+    :param data: The log lines, as bytes. Must be non-empty and end with a newline.
+    """
+
+    first_line = data[:data.index(b'\n')]
+    last_line = data[data.rindex(b'\n', 0, len(data) - 1) + 1:] if data.count(b'\n') > 1 else first_line
+    header = HEADER.pack(first_line[:TIMESTAMP_LENGTH], last_line[:TIMESTAMP_LENGTH], data.count(b'\n'))
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush()
+
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as file:
+        file.write(GZIP_PREFIX.pack(GZIP_MAGIC, GZIP_DEFLATE, GZIP_FLAG_EXTRA, int(time.time()), 0, 255,
+                                    4 + HEADER.size, HEADER_ID, HEADER.size))
+        file.write(header)
+        file.write(body)
+        file.write(struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff))
+    # Readers never see a half-written segment.
+    os.replace(temporary_path, path)
+
+
+def read_segment_header(path, number):
+    """
+    Read the header of a segment file.
+    :return: A `Segment`, or None if the file isn't a segment.
+    """
+
+    with open(path, 'rb') as file:
+        prefix = file.read(GZIP_PREFIX.size + HEADER.size)
+    if len(prefix) < GZIP_PREFIX.size + HEADER.size:
+        return None
+
+    magic, method, flags, _, _, _, _, header_id, header_size = GZIP_PREFIX.unpack_from(prefix)
+    if magic != GZIP_MAGIC or not flags & GZIP_FLAG_EXTRA or header_id != HEADER_ID or header_size != HEADER.size:
+        return None
+
+    first, last, lines = HEADER.unpack_from(prefix, GZIP_PREFIX.size)
+    return Segment(path, number, first.decode('ascii', errors='replace'), last.decode('ascii', errors='replace'),
+                   lines)
+
+
+def read_segment_lines(segment):
+    """Decompress a segment. :return: Its lines, in file order."""
+
+    with open(segment.path, 'rb') as file:
+        file.seek(GZIP_PREFIX.size + HEADER.size)
+        data = zlib.decompressobj(-zlib.MAX_WBITS).decompress(file.read())
+    return data.decode('utf-8', errors='replace').splitlines(keepends=True)
+
+
+def find_segments(log_path):
+    """
+    Find the rotated segments of a log file, named `<log file>.<number>.gz`.
+    :return: A list of `Segment`s, oldest first.
+    """
+
+    directory = os.path.dirname(os.path.abspath(log_path))
+    pattern = re.compile(re.escape(os.path.basename(log_path)) + r'\.(\d+)\.gz$')
+
+    segments = []
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return segments
+    for name in names:
+        match = pattern.match(name)
+        if match:
+            segment = read_segment_header(os.path.join(directory, name), int(match.group(1)))
+            if segment is not None:
+                segments.append(segment)
+
+    segments.sort(key=lambda segment: segment.number)
+    return segments
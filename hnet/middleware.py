@@ -0,0 +1,15 @@
+from hnet.logger import begin_request, finish_request
+
+
+class ActivityLogMiddleware(object):
+    """
+    Collects the activity log entries created while handling a request,
+    and saves them with a single bulk insert once the response is ready.
+    """
+
+    def process_request(self, request):
+        begin_request(request)
+
+    def process_response(self, request, response):
+        finish_request(request)
+        return response
@@ -50,6 +50,7 @@ MIDDLEWARE_CLASSES = [
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
+    'hnet.middleware.ActivityLogMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -123,3 +124,21 @@ USE_TZ = False
 
 STATIC_URL = '/static/'
 
+
+# Activity log
+# The log is kept in the database (hospital.models.ActivityLog). ACTIVITY_LOG_FILE is the old text log,
+# which can be loaded into the database with `python manage.py importactivitylog`.
+
+ACTIVITY_LOG_FILE = os.path.join(BASE_DIR, 'hnet', 'activity.log')
+
+# How many days log entries are kept; `python manage.py pruneactivitylog` deletes the older ones, and should be run
+# daily. None keeps them forever.
+ACTIVITY_LOG_MAX_AGE_DAYS = 400
+
+# The live log stream: the number of recent entries sent when a viewer connects, how often (in seconds) the log is
+# polled for new entries, and how long (in seconds) a stream waits for new entries before the browser reconnects.
+# Streams end as soon as they send entries, too. Each open log page holds a worker while its stream is open, which is
+# most of the time, so the worker pool has to be larger than the number of viewers expected at once.
+ACTIVITY_LOG_STREAM_BACKLOG = 20
+ACTIVITY_LOG_STREAM_POLL_INTERVAL = 2
+ACTIVITY_LOG_STREAM_DURATION = 20
@@ -0,0 +1,69 @@
+import datetime
+import gzip
+import os
+import shutil
+import tempfile
+from django.test import SimpleTestCase
+from hnet.logger import readLog, parse_log_line
+from hnet.logsegments import find_segments, write_segment
+
+
+class LogSegmentTestCase(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'activity.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_day(self, number, day):
+        data = ''.join('2017-04-%02d 12:00:%02d, user, Entry %d.\n' % (day, i, i) for i in range(5))
+        write_segment('%s.%06d.gz' % (self.path, number), data.encode('utf-8'))
+
+    def test_segment_header(self):
+        self.write_day(2, 2)
+        self.write_day(1, 1)
+
+        segments = find_segments(self.path)
+        self.assertEqual([segment.number for segment in segments], [1, 2], 'Expected segments oldest first.')
+        self.assertEqual(segments[1].first, '2017-04-02 12:00:00')
+        self.assertEqual(segments[1].last, '2017-04-02 12:00:04')
+        self.assertEqual(segments[1].lines, 5)
+
+        with gzip.open(segments[0].path, 'rt') as file:
+            self.assertEqual(file.readline(), '2017-04-01 12:00:00, user, Entry 0.\n',
+                             'Expected segments to be readable as ordinary gzip files.')
+
+    def test_read_log(self):
+        self.write_day(1, 1)
+        self.write_day(2, 2)
+        with open(self.path, 'w') as file:
+            file.write('2017-04-03 12:00:00, user, Entry 0.\n')
+
+        lines = list(readLog(self.path))
+        self.assertEqual(len(lines), 11)
+        self.assertEqual(lines[0], '2017-04-01 12:00:00, user, Entry 0.\n')
+        self.assertEqual(lines[-1], '2017-04-03 12:00:00, user, Entry 0.\n',
+                         'Expected the segments to be read before the log file.')
+
+    def test_missing_log(self):
+        self.assertEqual(list(readLog(self.path)), [])
+
+
+class ParseLogLineTestCase(SimpleTestCase):
+    def test_known_action(self):
+        entry = parse_log_line('2017-04-01 09:30:05, doctor, Patient admitted.\n')
+        self.assertEqual(entry.timestamp, datetime.datetime(2017, 4, 1, 9, 30, 5))
+        self.assertEqual(entry.username, 'doctor')
+        self.assertEqual(entry.action, 'patient_admitted')
+        self.assertEqual(str(entry), '2017-04-01 09:30:05, doctor, Patient admitted.',
+                         'Expected an entry to be displayed the way it was written to the text log.')
+
+    def test_unknown_action(self):
+        entry = parse_log_line('2017-04-01 09:30:05, STEPHEN,  HAS LOGGED IN.\n')
+        self.assertEqual(entry.action, 'other')
+        self.assertEqual(entry.message(), 'HAS LOGGED IN.', 'Expected unknown messages to be kept as the detail.')
+
+    def test_malformed(self):
+        self.assertIsNone(parse_log_line('not a log entry\n'))
+        self.assertIsNone(parse_log_line('yesterday, doctor, Patient admitted.\n'))
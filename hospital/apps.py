@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class HospitalConfig(AppConfig):
     name = 'hospital'
+
+    def ready(self):
+        # Connect the signal handlers that keep the hospital statistics up to date.
+        from hospital import signals
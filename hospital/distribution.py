@@ -0,0 +1,153 @@
+"""
+The distribution of the lengths of hospital stays: percentiles, a histogram and a breakdown by weekday.
+
+The (admission, discharge) pairs of a hospital are read in one pass and kept as compact arrays. With NumPy
+installed, every statistic is computed with vectorized operations, which handles a million stays in well under a
+second (see `python manage.py benchmarklengthofstay`). NumPy is optional: without it, the same statistics are
+computed in plain Python, which is fine for small hospitals.
+"""
+import bisect
+import itertools
+import math
+from datetime import datetime, timedelta
+from django.db.models import DateTimeField, Value
+from hospital.models import TreatmentSession
+from hospital.statistics import SecondsBetween
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+"""Admission times are read as the seconds since this time; it was a Thursday."""
+EPOCH = datetime(1970, 1, 1)
+EPOCH_WEEKDAY = 3
+
+WEEKDAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+
+"""The upper edges of the histogram bins, in hours; the last bin holds every longer stay."""
+HISTOGRAM_EDGES = (6, 12, 24, 48, 72, 24 * 7, 24 * 14, 24 * 30)
+
+
+def percentile(sorted_values, q):
+    """
+    Get a percentile of sorted values, interpolating linearly between the closest ranks, as NumPy does by default.
+    :param q: The percentile, from 0 to 100.
+    """
+
+    position = (len(sorted_values) - 1) * q / 100
+    lower = math.floor(position)
+    upper = math.ceil(position)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+class LengthOfStayDistribution:
+    def __init__(self, lengths, weekdays):
+        """
+        :param lengths: The lengths of the stays, in seconds.
+        :param weekdays: The weekday (0 for Monday) on which each stay started.
+        """
+        if numpy is not None:
+            self.lengths = numpy.asarray(lengths, dtype=numpy.float64)
+            self.weekdays = numpy.asarray(weekdays, dtype=numpy.int8)
+            self._sorted = numpy.sort(self.lengths)
+        else:
+            self.lengths = list(lengths)
+            self.weekdays = list(weekdays)
+            self._sorted = sorted(self.lengths)
+
+    @classmethod
+    def for_hospital(cls, hospital, since=None, until=None):
+        """
+        Read the stays at a hospital that have ended, in a single query.
+        The database computes the times as seconds, so only two floats per stay are sent back and converted.
+        :param since: If given, only include the stays that ended on or after this `datetime`.
+        :param until: If given, only include the stays that ended before this `datetime`.
+        """
+        sessions = TreatmentSession.objects.filter(treating_hospital=hospital).exclude(discharge_timestamp=None)
+        if since is not None:
+            sessions = sessions.filter(discharge_timestamp__gte=since)
+        if until is not None:
+            sessions = sessions.filter(discharge_timestamp__lt=until)
+        rows = sessions.order_by().annotate(
+            admitted_at=SecondsBetween(Value(EPOCH, output_field=DateTimeField()), 'admission_timestamp'),
+            length=SecondsBetween('admission_timestamp', 'discharge_timestamp'),
+        ).values_list('admitted_at', 'length')
+        return cls.from_seconds(rows.iterator())
+
+    @classmethod
+    def from_seconds(cls, rows):
+        """
+        Create a distribution from (admission time, length of stay) pairs.
+        Lengths are rounded to milliseconds, since SQLite's julianday() is no more precise than that.
+        :param rows: An iterable of pairs of the seconds from `EPOCH` to the admission, and the length of the stay
+                     in seconds.
+        """
+        if numpy is None:
+            admitted_at = []
+            lengths = []
+            for row in rows:
+                admitted_at.append(row[0])
+                lengths.append(round(row[1], 3))
+            return cls(lengths, [(int(seconds // 86400) + EPOCH_WEEKDAY) % 7 for seconds in admitted_at])
+
+        data = numpy.fromiter(itertools.chain.from_iterable(rows), dtype=numpy.float64).reshape(-1, 2)
+        weekdays = (numpy.floor_divide(data[:, 0], 86400).astype(numpy.int64) + EPOCH_WEEKDAY) % 7
+        return cls(numpy.round(data[:, 1], 3), weekdays)
+
+    def count(self):
+        return len(self._sorted)
+
+    def mean(self):
+        if not self.count():
+            return timedelta()
+        if numpy is not None:
+            return timedelta(seconds=float(self.lengths.mean()))
+        return timedelta(seconds=sum(self.lengths) / self.count())
+
+    def percentile(self, q):
+        """
+        :param q: The percentile, from 0 to 100; e.g. 50 for the median.
+        :return: A `timedelta`.
+        """
+        if not self.count():
+            return timedelta()
+        if numpy is not None:
+            return timedelta(seconds=float(numpy.percentile(self._sorted, q)))
+        return timedelta(seconds=percentile(self._sorted, q))
+
+    def median(self):
+        return self.percentile(50)
+
+    def histogram(self):
+        """
+        Count the stays in the bins of `HISTOGRAM_EDGES`.
+        :return: A list of (upper edge in hours, or None for the last bin, count) tuples.
+        """
+        edges = [hours * 3600 for hours in HISTOGRAM_EDGES]
+        if numpy is not None:
+            # The number of stays no longer than each edge.
+            cumulative = numpy.searchsorted(self._sorted, edges, side='right').tolist()
+        else:
+            cumulative = [bisect.bisect_right(self._sorted, edge) for edge in edges]
+        cumulative.append(self.count())
+
+        counts = [cumulative[0]] + [cumulative[i] - cumulative[i - 1] for i in range(1, len(cumulative))]
+        return list(zip(list(HISTOGRAM_EDGES) + [None], counts))
+
+    def by_weekday(self):
+        """
+        Break the stays down by the weekday they started on.
+        :return: A list of (weekday name, count, median `timedelta`) tuples, from Monday to Sunday.
+        """
+        breakdown = []
+        for weekday, name in enumerate(WEEKDAYS):
+            if numpy is not None:
+                lengths = self.lengths[self.weekdays == weekday]
+                median = float(numpy.median(lengths)) if len(lengths) else 0
+            else:
+                lengths = sorted(length for length, day in zip(self.lengths, self.weekdays) if day == weekday)
+                median = percentile(lengths, 50) if lengths else 0
+            breakdown.append((name, len(lengths), timedelta(seconds=median)))
+        return breakdown
@@ -0,0 +1,116 @@
+"""
+Episodes of care: the chains of treatment sessions linked by `TreatmentSession.previous_session`.
+
+A patient transferred between hospitals gets a new session that points at the one before it, so one episode of care
+is a chain of sessions, from an admission (a session without a previous one) to the final discharge.
+The sessions are read in a single query ordered by patient, and the chains are built in memory one patient at a
+time, instead of following `previous_session`/`next_session` one query per hop.
+"""
+import collections
+import itertools
+from datetime import timedelta
+from hospital.models import TreatmentSession
+
+
+"""The windows, in days, within which a new admission after a discharge counts as a readmission."""
+READMISSION_WINDOWS = (30, 90)
+
+Session = collections.namedtuple('Session', ['id', 'patient', 'hospital', 'admission', 'discharge', 'previous'])
+
+
+def build_episodes(sessions):
+    """
+    Link the sessions of one patient into episodes.
+    :param sessions: All the `Session`s of a patient.
+    :return: A list of episodes, each a list of `Session`s from admission to the final discharge,
+             ordered by the time of admission.
+    """
+
+    following = {}
+    for session in sessions:
+        if session.previous is not None:
+            following[session.previous] = session
+
+    ids = set(session.id for session in sessions)
+    episodes = []
+    for session in sessions:
+        if session.previous is None or session.previous not in ids:
+            episode = [session]
+            while episode[-1].id in following:
+                episode.append(following[episode[-1].id])
+            episodes.append(episode)
+    episodes.sort(key=lambda episode: episode[0].admission)
+    return episodes
+
+
+class CareFlow:
+    """Readmissions and transfers between hospitals, computed from the episodes of care of every patient."""
+
+    def __init__(self):
+        # The number of episodes that ended with a discharge from each hospital.
+        self.discharges = collections.Counter()
+        # For each readmission window, the number of those episodes followed by a new admission within the window.
+        self.readmissions = dict((days, collections.Counter()) for days in READMISSION_WINDOWS)
+        # The number of transfers from one hospital to another, keyed by (from hospital id, to hospital id).
+        self.transfers = collections.Counter()
+
+    @classmethod
+    def for_hospitals(cls, hospital_ids=None):
+        """
+        Compute the care flow in a single query.
+        :param hospital_ids: If given, only read the sessions of the patients who have been treated at one of
+                             these hospitals; the figures of these hospitals are complete, but other hospitals'
+                             aren't.
+        """
+        sessions = TreatmentSession.objects.all()
+        if hospital_ids is not None:
+            sessions = sessions.filter(patient__in=TreatmentSession.objects.filter(treating_hospital__in=hospital_ids)
+                                       .values('patient'))
+        rows = sessions.order_by('patient', 'admission_timestamp', 'id').values_list(
+            'id', 'patient', 'treating_hospital', 'admission_timestamp', 'discharge_timestamp', 'previous_session')
+
+        care_flow = cls()
+        for _, patient_sessions in itertools.groupby((Session(*row) for row in rows.iterator()),
+                                                     key=lambda session: session.patient):
+            care_flow.add_episodes(build_episodes(list(patient_sessions)))
+        return care_flow
+
+    def add_episodes(self, episodes):
+        """Count the readmissions and transfers of a patient's episodes, ordered by the time of admission."""
+
+        for index, episode in enumerate(episodes):
+            for previous, session in zip(episode, episode[1:]):
+                self.transfers[previous.hospital, session.hospital] += 1
+
+            last = episode[-1]
+            if last.discharge is None:
+                continue
+            self.discharges[last.hospital] += 1
+            if index + 1 < len(episodes):
+                gap = episodes[index + 1][0].admission - last.discharge
+                for days in READMISSION_WINDOWS:
+                    if gap <= timedelta(days=days):
+                        self.readmissions[days][last.hospital] += 1
+
+    def readmission_rate(self, hospital_id, days):
+        """
+        :param days: One of `READMISSION_WINDOWS`.
+        :return: The fraction of the episodes ending at a hospital that were followed by a readmission (to any
+                 hospital) within the window, from 0 to 1.
+        """
+        discharges = self.discharges[hospital_id]
+        return self.readmissions[days][hospital_id] / discharges if discharges else 0
+
+    def transfers_in(self, hospital_id):
+        return sum(count for (_, to_hospital), count in self.transfers.items() if to_hospital == hospital_id)
+
+    def transfers_out(self, hospital_id):
+        return sum(count for (from_hospital, _), count in self.transfers.items() if from_hospital == hospital_id)
+
+    def transfer_matrix(self, hospitals):
+        """
+        :param hospitals: The hospitals for the rows and columns of the matrix.
+        :return: A list of (hospital, list of transfer counts to each hospital) rows.
+        """
+        return [(from_hospital, [self.transfers[from_hospital.pk, to_hospital.pk] for to_hospital in hospitals])
+                for from_hospital in hospitals]
@@ -0,0 +1,109 @@
+"""
+Exporting hospital statistics as CSV or as newline-delimited JSON (one object per line).
+
+Rows are generated and formatted one at a time, and handed to a `StreamingHttpResponse`,
+so an export of any size is sent in constant memory.
+"""
+import csv
+import json
+from datetime import date
+from hospital.models import DailyStats
+from hospital.statistics import Statistics
+
+
+EXPORT_FORMATS = (
+    ('csv', 'CSV'),
+    ('ndjson', 'JSON, one object per line'),
+)
+
+"""
+The columns of an export. 'summary' rows hold the current statistics of a hospital; 'daily' rows hold the snapshot
+of a day. Columns that don't apply to a type of row are left empty (or left out, in JSON).
+"""
+EXPORT_FIELDS = ('type', 'hospital_id', 'hospital', 'date', 'admitted_patients', 'average_visits_per_patient',
+                 'average_length_of_stay_seconds', 'prescriptions', 'appointments', 'doctors', 'nurses',
+                 'readmission_rate_30_days', 'readmission_rate_90_days', 'transfers_in', 'transfers_out',
+                 'admissions', 'discharges', 'census')
+
+"""The number of hospitals whose statistics are read at a time."""
+HOSPITAL_BATCH_SIZE = 100
+
+
+def statistics_rows(hospitals, since=None, until=None):
+    """
+    Generate the rows of an export: the current statistics of every hospital, followed by their daily snapshots.
+    :param hospitals: A `Hospital` queryset.
+    :param since: The first day of snapshots to export; if None, no snapshots are exported.
+    :param until: The last day of snapshots to export.
+    :return: A generator of dicts.
+    """
+
+    today = date.today().isoformat()
+    last_id = 0
+    while True:
+        batch = list(hospitals.filter(pk__gt=last_id).order_by('pk')[:HOSPITAL_BATCH_SIZE])
+        if not batch:
+            break
+        last_id = batch[-1].pk
+        for statistics in Statistics.for_hospitals(batch):
+            yield {
+                'type': 'summary',
+                'hospital_id': statistics.hospital.pk,
+                'hospital': statistics.hospital.name,
+                'date': today,
+                'admitted_patients': statistics.num_of_patients(),
+                'average_visits_per_patient': round(statistics.average_visits_per_patient(), 2),
+                'average_length_of_stay_seconds': statistics.average_length_of_stay().total_seconds(),
+                'prescriptions': statistics.num_prescriptions_given(),
+                'appointments': statistics.num_of_appointments_today(),
+                'doctors': statistics.num_of_doctors(),
+                'nurses': statistics.num_of_nurses(),
+                'readmission_rate_30_days': round(statistics.readmission_rate(30), 4),
+                'readmission_rate_90_days': round(statistics.readmission_rate(90), 4),
+                'transfers_in': statistics.num_transfers_in(),
+                'transfers_out': statistics.num_transfers_out(),
+            }
+
+    if since is None:
+        return
+    snapshots = DailyStats.objects.filter(hospital__in=hospitals.values('pk'), date__gte=since, date__lte=until) \
+        .order_by('hospital', 'date') \
+        .values_list('hospital', 'hospital__name', 'date', 'admissions', 'discharges', 'census', 'total_stay_seconds',
+                     'prescriptions', 'appointments')
+    for hospital_id, name, day, admissions, discharges, census, total_stay_seconds, prescriptions, appointments \
+            in snapshots.iterator():
+        yield {
+            'type': 'daily',
+            'hospital_id': hospital_id,
+            'hospital': name,
+            'date': day.isoformat(),
+            'admissions': admissions,
+            'discharges': discharges,
+            'census': census,
+            'average_length_of_stay_seconds': round(total_stay_seconds / discharges, 3) if discharges else 0,
+            'prescriptions': prescriptions,
+            'appointments': appointments,
+        }
+
+
+class Echo:
+    """A file-like object that returns what is written to it, so `csv.writer` can format one row at a time."""
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows):
+    """Format export rows as CSV, starting with a header line. :return: A generator of lines."""
+
+    writer = csv.DictWriter(Echo(), fieldnames=EXPORT_FIELDS, restval='')
+    yield writer.writerow(dict(zip(EXPORT_FIELDS, EXPORT_FIELDS)))
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def stream_ndjson(rows):
+    """Format export rows as newline-delimited JSON. :return: A generator of lines."""
+
+    for row in rows:
+        yield json.dumps(row) + '\n'
@@ -1,9 +1,11 @@
 from django import forms
-from .models import TreatmentSession
+from datetime import date, timedelta
+from .models import TreatmentSession, ActivityLog, Hospital
+from .statistics import TREND_PERIODS
+from .export import EXPORT_FORMATS
 from account.models import Doctor
 
 
-
 class TransferForm(forms.ModelForm):
     """
     A form for obtaining the hospital a patient should be transferred to.
@@ -25,3 +27,89 @@ class TransferForm(forms.ModelForm):
         if user:
             self.fields['treating_hospital'].queryset = \
                 self.fields['treating_hospital'].queryset.exclude(administrator=user.administrator)
+
+
+class LogFilterForm(forms.Form):
+    """
+    A form for filtering the activity log by user, action and date range.
+    All fields are optional; an empty form matches every entry.
+    Users are matched by the username recorded in the entries, so the entries of removed users can be found too.
+    """
+
+    username = forms.CharField(required=False, max_length=150)
+    action = forms.ChoiceField(required=False, choices=(('', 'Any action'),) + ActivityLog.ACTIONS)
+    since = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date'}), label='From')
+    until = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date'}), label='To')
+
+    def clean(self):
+        cleaned_data = super(LogFilterForm, self).clean()
+        since = cleaned_data.get('since')
+        until = cleaned_data.get('until')
+        if since and until and since > until:
+            raise forms.ValidationError('The start date must not be after the end date.')
+        return cleaned_data
+
+    def filter(self, entries):
+        """
+        Apply the filters to a queryset of `ActivityLog` entries.
+        The form must be valid.
+        """
+
+        if self.cleaned_data.get('username'):
+            entries = entries.filter(username=self.cleaned_data['username'])
+        if self.cleaned_data.get('action'):
+            entries = entries.filter(action=self.cleaned_data['action'])
+        if self.cleaned_data.get('since'):
+            entries = entries.filter(timestamp__gte=self.cleaned_data['since'])
+        if self.cleaned_data.get('until'):
+            entries = entries.filter(timestamp__lt=self.cleaned_data['until'] + timedelta(days=1))
+        return entries
+
+
+class StatisticsRangeForm(forms.Form):
+    """
+    A form for choosing the hospital and date range of statistics.
+    The hospital can only be chosen by users who can see every hospital; pass `choose_hospital=False` otherwise.
+    """
+
+    DEFAULT_DAYS = 365
+
+    hospital = forms.ModelChoiceField(queryset=Hospital.objects.all(), required=False, empty_label=None)
+    since = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date'}), label='From')
+    until = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date'}), label='To')
+
+    def __init__(self, *args, **kwargs):
+        choose_hospital = kwargs.pop('choose_hospital', True)
+        super(StatisticsRangeForm, self).__init__(*args, **kwargs)
+        if not choose_hospital:
+            del self.fields['hospital']
+
+    def clean(self):
+        cleaned_data = super(StatisticsRangeForm, self).clean()
+        cleaned_data['until'] = cleaned_data.get('until') or date.today()
+        cleaned_data['since'] = cleaned_data.get('since') or cleaned_data['until'] - timedelta(days=self.DEFAULT_DAYS)
+        if cleaned_data['since'] > cleaned_data['until']:
+            raise forms.ValidationError('The start date must not be after the end date.')
+        return cleaned_data
+
+
+class TrendsForm(StatisticsRangeForm):
+    """A form for choosing the hospital, period and date range of the statistics trends."""
+
+    period = forms.ChoiceField(choices=TREND_PERIODS, required=False)
+
+    def clean(self):
+        cleaned_data = super(TrendsForm, self).clean()
+        cleaned_data['period'] = cleaned_data.get('period') or 'month'
+        return cleaned_data
+
+
+class StatisticsExportForm(StatisticsRangeForm):
+    """
+    A form for choosing the statistics to export, and the format to export them in.
+    The date range only applies to the daily history.
+    """
+
+    hospital = forms.ModelChoiceField(queryset=Hospital.objects.all(), required=False, empty_label='All hospitals')
+    format = forms.ChoiceField(choices=EXPORT_FORMATS)
+    history = forms.BooleanField(required=False, label='Include daily history')
@@ -0,0 +1,71 @@
+import random
+import time
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from hospital import distribution
+from hospital.distribution import LengthOfStayDistribution, EPOCH
+
+
+class Command(BaseCommand):
+    help = 'Time the length-of-stay distribution on synthetic stays, with NumPy and, for comparison, ' \
+           'in plain Python. No database is used.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sessions',
+            dest='sessions',
+            type=int,
+            nargs='+',
+            default=[10000, 100000, 1000000],
+            help='The numbers of stays to time the distribution with.'
+        )
+
+        parser.add_argument(
+            '--python-limit',
+            dest='python_limit',
+            type=int,
+            default=100000,
+            help='Skip the plain Python timing above this number of stays, as it gets slow.'
+        )
+
+    def handle(self, *args, **options):
+        if distribution.numpy is None:
+            raise CommandError('NumPy is not installed; install it with `pip install numpy`.')
+
+        numpy = distribution.numpy
+        for count in options.get('sessions'):
+            rows = self.generate(count)
+            self.stdout.write('%d stays:' % count)
+            self.stdout.write('    NumPy:        %.3fs' % self.time_distribution(rows))
+            if count <= options.get('python_limit'):
+                distribution.numpy = None
+                try:
+                    self.stdout.write('    Plain Python: %.3fs' % self.time_distribution(rows))
+                finally:
+                    distribution.numpy = numpy
+
+    @staticmethod
+    def generate(count):
+        """
+        Generate stays over ten years, with exponentially distributed lengths averaging three days,
+        as the (admission time, length) pairs in seconds that are read from the database.
+        """
+
+        random.seed(count)
+        start = (datetime(2007, 1, 1) - EPOCH).total_seconds()
+        return [(start + random.randrange(10 * 365 * 86400), random.expovariate(1 / (3 * 86400)))
+                for _ in range(count)]
+
+    @staticmethod
+    def time_distribution(rows):
+        """Time building a distribution from the rows of a query, and computing every statistic."""
+
+        started = time.perf_counter()
+        stays = LengthOfStayDistribution.from_seconds(iter(rows))
+        stays.mean()
+        stays.median()
+        stays.percentile(90)
+        stays.percentile(99)
+        stays.histogram()
+        stays.by_weekday()
+        return time.perf_counter() - started
@@ -0,0 +1,82 @@
+import multiprocessing
+import os
+from datetime import date, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.utils import OperationalError
+from hospital.models import Hospital
+from hospital.statistics import rebuild_care_flow_stats, rebuild_hospital_stats, take_daily_snapshot
+
+
+def compute_statistics(hospital_ids, snapshot_day):
+    """
+    Rebuild the statistics counters of some hospitals, with their readmissions and transfers, and take their
+    snapshot of a day.
+    Runs in a worker process, which opens its own database connection.
+    :return: The number of hospitals computed.
+    """
+    rebuild_hospital_stats(hospital_ids)
+    rebuild_care_flow_stats(hospital_ids)
+    if snapshot_day is not None:
+        take_daily_snapshot(snapshot_day, hospital_ids)
+    return len(hospital_ids)
+
+
+class Command(BaseCommand):
+    help = 'Precompute the statistics of every hospital: rebuild the counters the statistics page is served from, ' \
+           'including the readmissions and transfers, ' \
+           'and take the snapshot of the day before for the trends. The hospitals are split between ' \
+           'worker processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes',
+            dest='processes',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='The number of worker processes. Defaults to the number of CPUs; '
+                 '1 computes everything in this process.'
+        )
+
+        parser.add_argument(
+            '--batch-size',
+            dest='batch_size',
+            type=int,
+            default=50,
+            help='The number of hospitals each worker computes at a time, with one grouped query per table.'
+        )
+
+        parser.add_argument(
+            '--no-snapshot',
+            action='store_false',
+            dest='snapshot',
+            default=True,
+            help="Only rebuild the counters; don't take the snapshot of the day before."
+        )
+
+    def handle(self, *args, **options):
+        processes = options.get('processes')
+        batch_size = options.get('batch_size')
+        if processes < 1 or batch_size < 1:
+            raise CommandError('The number of processes and the batch size must be at least 1.')
+        snapshot_day = date.today() - timedelta(days=1) if options.get('snapshot') else None
+
+        try:
+            hospital_ids = list(Hospital.objects.order_by('pk').values_list('pk', flat=True))
+            batches = [hospital_ids[i:i + batch_size] for i in range(0, len(hospital_ids), batch_size)]
+
+            if processes == 1 or len(batches) <= 1:
+                computed = sum(compute_statistics(batch, snapshot_day) for batch in batches)
+            else:
+                # Forked workers must not share this process's connections; each one opens its own.
+                connections.close_all()
+                pool = multiprocessing.Pool(min(processes, len(batches)))
+                try:
+                    computed = sum(pool.starmap(compute_statistics, [(batch, snapshot_day) for batch in batches]))
+                finally:
+                    pool.close()
+                    pool.join()
+        except OperationalError:
+            raise CommandError('Operation cannot be completed. Did you forget to do database migration?')
+
+        self.stdout.write(self.style.SUCCESS('Computed the statistics of %d hospitals.' % computed))
@@ -0,0 +1,57 @@
+import os
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.utils import OperationalError
+from hnet.logger import get_log_file, readLog, parse_log_line, save_log_entries
+from hnet.logsegments import find_segments
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = 'Import the text activity log (and its rotated segments) into the ActivityLog table. ' \
+           'The imported files are renamed with an `.imported` suffix, so they are never imported twice.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--file',
+            dest='file',
+            default=None,
+            help='The text activity log to import. Defaults to the ACTIVITY_LOG_FILE setting.'
+        )
+
+    def handle(self, *args, **options):
+        path = options.get('file') or get_log_file()
+        segments = find_segments(path)
+        if not segments and not os.path.exists(path):
+            raise CommandError('There is no activity log at %s.' % path)
+
+        imported = 0
+        skipped = 0
+        try:
+            with transaction.atomic():
+                batch = []
+                for line in readLog(path):
+                    entry = parse_log_line(line)
+                    if entry is None:
+                        skipped += 1
+                        continue
+                    batch.append(entry)
+                    if len(batch) == BATCH_SIZE:
+                        save_log_entries(batch)
+                        imported += len(batch)
+                        batch = []
+                if batch:
+                    save_log_entries(batch)
+                    imported += len(batch)
+        except OperationalError:
+            raise CommandError('Operation cannot be completed. Did you forget to do database migration?')
+
+        for segment in segments:
+            os.rename(segment.path, segment.path + '.imported')
+        if os.path.exists(path):
+            os.rename(path, path + '.imported')
+
+        self.stdout.write(self.style.SUCCESS('Imported %d log entries.' % imported))
+        if skipped:
+            self.stdout.write(self.style.WARNING('Skipped %d malformed lines.' % skipped))
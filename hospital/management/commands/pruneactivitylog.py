@@ -0,0 +1,36 @@
+import datetime
+from django.core.management.base import BaseCommand, CommandError
+from django.db.utils import OperationalError
+from hnet.logger import get_log_max_age, prune_log
+
+
+class Command(BaseCommand):
+    help = 'Delete the activity log entries older than the ACTIVITY_LOG_MAX_AGE_DAYS setting, so the log ' \
+           'doesn\'t grow without bound. Meant to be run daily.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            dest='days',
+            type=int,
+            default=None,
+            help='The number of days to keep entries for. Defaults to the ACTIVITY_LOG_MAX_AGE_DAYS setting.'
+        )
+
+    def handle(self, *args, **options):
+        if options.get('days') is not None:
+            if options['days'] < 0:
+                raise CommandError('The number of days must not be negative.')
+            max_age = datetime.timedelta(days=options['days'])
+        else:
+            max_age = get_log_max_age()
+            if max_age is None:
+                self.stdout.write('Log entries are kept forever; nothing to prune.')
+                return
+
+        try:
+            deleted = prune_log(max_age)
+        except OperationalError:
+            raise CommandError('Operation cannot be completed. Did you forget to do database migration?')
+
+        self.stdout.write(self.style.SUCCESS('Deleted %d log entries.' % deleted))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.utils import OperationalError
+from hospital.models import Hospital
+from hospital.statistics import rebuild_care_flow_stats, rebuild_hospital_stats
+
+
+class Command(BaseCommand):
+    help = 'Recompute the statistics counters of hospitals from scratch, to correct any drift, along with their ' \
+           'readmissions and transfers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'hospital_ids',
+            nargs='*',
+            type=int,
+            help='The ids of the hospitals to rebuild the statistics of. Defaults to all hospitals.'
+        )
+
+    def handle(self, *args, **options):
+        hospital_ids = options.get('hospital_ids') or None
+        try:
+            if hospital_ids is not None:
+                unknown = set(hospital_ids) - set(Hospital.objects.filter(pk__in=hospital_ids)
+                                                  .values_list('pk', flat=True))
+                if unknown:
+                    raise CommandError('There is no hospital with the id %s.' % ', '.join(map(str, sorted(unknown))))
+            stats = rebuild_hospital_stats(hospital_ids)
+            rebuild_care_flow_stats(hospital_ids)
+        except OperationalError:
+            raise CommandError('Operation cannot be completed. Did you forget to do database migration?')
+
+        self.stdout.write(self.style.SUCCESS('Rebuilt the statistics of %d hospitals.' % len(stats)))
@@ -0,0 +1,45 @@
+from datetime import date, datetime, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db.utils import OperationalError
+from hospital.statistics import take_daily_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Take the daily statistics snapshots of every hospital. Run nightly, e.g. from cron, ' \
+           'to snapshot the day before; taking a snapshot again replaces it.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--date',
+            dest='date',
+            default=None,
+            help='The (last) day to take snapshots of, as YYYY-MM-DD. Defaults to yesterday.'
+        )
+
+        parser.add_argument(
+            '--days',
+            dest='days',
+            type=int,
+            default=1,
+            help='The number of days, ending with --date, to take snapshots of; use it to backfill history.'
+        )
+
+    def handle(self, *args, **options):
+        if options.get('date'):
+            try:
+                last_day = datetime.strptime(options['date'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('Invalid date: %s. Use the format YYYY-MM-DD.' % options['date'])
+        else:
+            last_day = date.today() - timedelta(days=1)
+        days = options.get('days')
+        if days < 1:
+            raise CommandError('The number of days must be at least 1.')
+
+        try:
+            for offset in reversed(range(days)):
+                take_daily_snapshot(last_day - timedelta(days=offset))
+        except OperationalError:
+            raise CommandError('Operation cannot be completed. Did you forget to do database migration?')
+
+        self.stdout.write(self.style.SUCCESS('Took the statistics snapshots of %d days, up to %s.' % (days, last_day)))
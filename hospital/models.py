@@ -1,4 +1,8 @@
+from datetime import datetime
 from django.db import models
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
 
 
 class Hospital(models.Model):
@@ -57,3 +61,177 @@ class TreatmentSession(models.Model):
             ('transfer_patient_any_hospital', 'Can transfer patient to any hospital'),
             ('transfer_patient_receiving_hospital', "Can transfer patient to user's hospital")
         )
+        # For counting the admissions and discharges of a day at a hospital; see `hospital.statistics`.
+        index_together = (
+            ('treating_hospital', 'admission_timestamp'),
+            ('treating_hospital', 'discharge_timestamp'),
+        )
+
+
+class ActivityLog(models.Model):
+    """
+    An entry of the activity log, recording an action performed by a user.
+    Entries are created through `hnet.logger.CreateLogEntry`.
+    """
+
+    OTHER = 'other'
+
+    """The action codes, and the messages that used to be written to the text log for them."""
+    ACTIONS = (
+        ('patient_logged_in', 'Patient logged in.'),
+        ('doctor_logged_in', 'Doctor logged in.'),
+        ('nurse_logged_in', 'Nurse logged in.'),
+        ('administrator_logged_in', 'Administrator logged in.'),
+        ('patient_registered', 'Patient account registered.'),
+        ('administrator_registered', 'Administrator account registered.'),
+        ('doctor_registered', 'Doctor account registered.'),
+        ('nurse_created', 'Nurse account created.'),
+        ('profile_changed', 'Changed profile information.'),
+        ('patient_admitted', 'Patient admitted.'),
+        ('patient_discharged', 'Patient discharged.'),
+        ('patient_transferred', 'Patient transferred.'),
+        ('drug_added', 'Added new drug.'),
+        ('drug_removed', 'Drug removed.'),
+        ('drug_updated', 'Updated drug.'),
+        ('prescription_added', 'Added prescription.'),
+        ('prescription_edited', 'Edited prescription.'),
+        ('prescription_deleted', 'Prescription deleted.'),
+        ('diagnosis_created', 'Diagnosis created.'),
+        ('diagnosis_updated', 'Diagnosis updated.'),
+        ('diagnosis_archived', 'Diagnosis archived.'),
+        ('test_requested', 'Test requested.'),
+        ('test_results_uploaded', 'Test results uploaded.'),
+        ('test_result_released', 'Test result released.'),
+        ('medical_information_exported', 'Patient exported medical information.'),
+        ('appointment_created', 'Appointment created.'),
+        ('appointment_edited', 'Appointment edited.'),
+        ('appointment_canceled', 'Appointment canceled.'),
+        ('appointment_series_created', 'Appointment series created.'),
+        ('calendar_feed_reset', 'Calendar feed address reset.'),
+        (OTHER, 'Other'),
+    )
+
+    """Indexed on its own for pruning old entries; see `hnet.logger.prune_log`."""
+    timestamp = models.DateTimeField(default=datetime.now, db_index=True)
+
+    """The user who performed the action; NULL if the user is unknown or has since been removed."""
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    """The username at the time of the action, kept even if the user is removed."""
+    username = models.CharField(max_length=150, blank=True)
+    """The type of the user's account at the time of the action; see `account.models.ProfileInformation`."""
+    account_type = models.CharField(max_length=1, blank=True)
+
+    action = models.CharField(max_length=40, choices=ACTIONS)
+    """The original message of an entry whose action has no code of its own."""
+    detail = models.CharField(max_length=200, blank=True)
+
+    """The hospital of the user's account; NULL for users without one, e.g. super users."""
+    hospital = models.ForeignKey(Hospital, on_delete=models.SET_NULL, null=True, blank=True)
+
+    """The object the action was performed on, if any."""
+    target_type = models.ForeignKey(ContentType, on_delete=models.SET_NULL, null=True, blank=True)
+    target_id = models.PositiveIntegerField(null=True, blank=True)
+    target = GenericForeignKey('target_type', 'target_id')
+
+    @classmethod
+    def action_for_message(cls, message):
+        """
+        Get the action code for a log message.
+        :return: A tuple of the action code, and the message itself if there's no code for it.
+        """
+        message = str(message).strip()
+        for code, action_message in cls.ACTIONS:
+            if action_message == message:
+                return code, ''
+        return cls.OTHER, message[:200]
+
+    def message(self):
+        if self.action == self.OTHER:
+            return self.detail
+        return self.get_action_display()
+
+    def __str__(self):
+        return "%s, %s, %s" % (self.timestamp.strftime("%Y-%m-%d %H:%M:%S"), self.username, self.message())
+
+    class Meta:
+        index_together = (
+            ('hospital', 'timestamp'),
+            ('user', 'timestamp'),
+            # The filters of the log page; see `hospital.forms.LogFilterForm`.
+            ('hospital', 'username', 'timestamp'),
+            ('hospital', 'action', 'timestamp'),
+        )
+
+
+class HospitalStats(models.Model):
+    """
+    Running totals of a hospital's statistics, kept up to date by the signal handlers in `hospital.signals`,
+    so that statistics can be read without aggregating the hospital's history.
+    Rebuild them with `python manage.py rebuildstatistics` if they ever drift.
+    """
+
+    hospital = models.OneToOneField(Hospital, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+
+    """The number of treatment sessions at the hospital."""
+    visit_count = models.IntegerField(default=0)
+    """The number of distinct patients who have had a treatment session at the hospital."""
+    patient_count = models.IntegerField(default=0)
+    """The number of distinct patients who are currently admitted to the hospital."""
+    admitted_patient_count = models.IntegerField(default=0)
+
+    """The number of discharged treatment sessions, and their total length in seconds."""
+    discharged_count = models.IntegerField(default=0)
+    total_stay_seconds = models.FloatField(default=0)
+
+    """The number of active doctors and nurses at the hospital."""
+    doctor_count = models.IntegerField(default=0)
+    nurse_count = models.IntegerField(default=0)
+
+    """The number of prescriptions given by the hospital's doctors."""
+    prescription_count = models.IntegerField(default=0)
+
+    """
+    The readmissions and transfers of the episodes of care of the hospital's patients (see `hospital.episodes`).
+    Following the chains of sessions takes the patients' whole history, so these aren't kept up to date by the
+    signal handlers; `python manage.py computestatistics` and `rebuildstatistics` recompute them.
+    """
+    """The number of episodes of care that ended with a discharge from the hospital."""
+    episode_discharge_count = models.IntegerField(default=0)
+    """The number of those episodes followed by another admission within 30 and 90 days."""
+    readmission_30_count = models.IntegerField(default=0)
+    readmission_90_count = models.IntegerField(default=0)
+    """The number of patients transferred to and from the hospital."""
+    transfer_in_count = models.IntegerField(default=0)
+    transfer_out_count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return "Statistics for " + self.hospital.name
+
+
+class DailyStats(models.Model):
+    """
+    A snapshot of a hospital's activity on one day, written nightly by `python manage.py snapshotstatistics`.
+    Trends over weeks, months and years are rolled up from these rows, rather than from the raw records.
+    """
+
+    hospital = models.ForeignKey(Hospital, on_delete=models.CASCADE)
+    date = models.DateField()
+
+    """The number of treatment sessions started and ended on the day."""
+    admissions = models.IntegerField(default=0)
+    discharges = models.IntegerField(default=0)
+    """The number of patients admitted to the hospital at the end of the day."""
+    census = models.IntegerField(default=0)
+    """The total length, in seconds, of the treatment sessions that ended on the day."""
+    total_stay_seconds = models.FloatField(default=0)
+
+    """The number of prescriptions given by the hospital's doctors on the day."""
+    prescriptions = models.IntegerField(default=0)
+    """The number of appointments (that weren't cancelled) with the hospital's doctors on the day."""
+    appointments = models.IntegerField(default=0)
+
+    def __str__(self):
+        return "Statistics for %s on %s" % (self.hospital.name, self.date)
+
+    class Meta:
+        unique_together = (('hospital', 'date'),)
@@ -0,0 +1,162 @@
+"""
+Signal handlers that keep `HospitalStats` up to date as the data the statistics are computed from changes.
+
+Each handler compares the state of an object before a change (read from the database in `pre_save`/`pre_delete`)
+with its state after it, and adjusts the counters of the hospitals involved by the difference.
+"""
+from collections import Counter, defaultdict
+from django.contrib.auth.models import User
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from django.dispatch import receiver
+from account.models import Doctor, Nurse
+from hospital.models import Hospital, HospitalStats, TreatmentSession
+from hospital.statistics import adjust_hospital_stats
+from medical.models import Prescription
+
+
+def apply_deltas(deltas):
+    for hospital_id, hospital_deltas in deltas.items():
+        if hospital_id is not None:
+            adjust_hospital_stats(hospital_id, **hospital_deltas)
+
+
+@receiver(post_save, sender=Hospital)
+def create_hospital_stats(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        HospitalStats.objects.create(hospital=instance)
+
+
+def session_state(session):
+    return {'hospital': session.treating_hospital_id, 'patient': session.patient_id,
+            'admission': session.admission_timestamp, 'discharge': session.discharge_timestamp}
+
+
+@receiver(pre_save, sender=TreatmentSession)
+@receiver(pre_delete, sender=TreatmentSession)
+def remember_session(sender, instance, raw=False, **kwargs):
+    instance._previous_stats_state = None
+    if instance.pk is not None and not raw:
+        previous = TreatmentSession.objects.filter(pk=instance.pk).first()
+        if previous is not None:
+            instance._previous_stats_state = session_state(previous)
+
+
+@receiver(post_save, sender=TreatmentSession)
+def session_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        update_session_stats(instance, getattr(instance, '_previous_stats_state', None), session_state(instance))
+
+
+@receiver(post_delete, sender=TreatmentSession)
+def session_deleted(sender, instance, **kwargs):
+    update_session_stats(instance, getattr(instance, '_previous_stats_state', None), None)
+
+
+def in_pair(state, pair, admitted_only=False):
+    """Whether a session state belongs to a (patient, hospital) pair, and is still open if `admitted_only`."""
+    return state is not None and (state['patient'], state['hospital']) == pair and \
+        (not admitted_only or state['discharge'] is None)
+
+
+def update_session_stats(session, old, new):
+    deltas = defaultdict(Counter)
+    for state, sign in ((old, -1), (new, 1)):
+        if state is None:
+            continue
+        hospital_deltas = deltas[state['hospital']]
+        hospital_deltas['visit_count'] += sign
+        if state['discharge'] is not None:
+            hospital_deltas['discharged_count'] += sign
+            hospital_deltas['total_stay_seconds'] += sign * (state['discharge'] - state['admission']).total_seconds()
+
+    # A patient is counted once per hospital, however many sessions they have there, so the distinct counts only
+    # change when this session is the patient's first (or last) one at the hospital.
+    pairs = set((state['patient'], state['hospital']) for state in (old, new) if state is not None)
+    for pair in pairs:
+        other_sessions = TreatmentSession.objects.filter(patient=pair[0], treating_hospital=pair[1]) \
+            .exclude(pk=session.pk)
+        was_visiting, is_visiting = in_pair(old, pair), in_pair(new, pair)
+        if was_visiting != is_visiting and not other_sessions.exists():
+            deltas[pair[1]]['patient_count'] += is_visiting - was_visiting
+        was_admitted, is_admitted = in_pair(old, pair, True), in_pair(new, pair, True)
+        if was_admitted != is_admitted and not other_sessions.filter(discharge_timestamp=None).exists():
+            deltas[pair[1]]['admitted_patient_count'] += is_admitted - was_admitted
+
+    apply_deltas(deltas)
+
+
+def update_count(field, old_hospital, new_hospital):
+    """Move one unit of a counter from one hospital to another; either may be None."""
+    if old_hospital != new_hospital:
+        deltas = defaultdict(Counter)
+        deltas[old_hospital][field] -= 1
+        deltas[new_hospital][field] += 1
+        apply_deltas(deltas)
+
+
+@receiver(pre_save, sender=Prescription)
+@receiver(pre_delete, sender=Prescription)
+def remember_prescription(sender, instance, raw=False, **kwargs):
+    instance._previous_stats_state = None
+    if instance.pk is not None and not raw:
+        instance._previous_stats_state = Prescription.objects.filter(pk=instance.pk) \
+            .values_list('doctor__hospital', flat=True).first()
+
+
+@receiver(post_save, sender=Prescription)
+def prescription_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        update_count('prescription_count', getattr(instance, '_previous_stats_state', None),
+                     instance.doctor.hospital_id)
+
+
+@receiver(post_delete, sender=Prescription)
+def prescription_deleted(sender, instance, **kwargs):
+    update_count('prescription_count', getattr(instance, '_previous_stats_state', None), None)
+
+
+STAFF_COUNTERS = {Doctor: 'doctor_count', Nurse: 'nurse_count'}
+
+
+def remember_staff(sender, instance, raw=False, **kwargs):
+    instance._previous_stats_state = None
+    if instance.pk is not None and not raw:
+        # Only active staff are counted; the hospital of an inactive account is recorded as None.
+        instance._previous_stats_state = sender.objects.filter(pk=instance.pk, user__is_active=True) \
+            .values_list('hospital', flat=True).first()
+
+
+def staff_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        update_count(STAFF_COUNTERS[sender], getattr(instance, '_previous_stats_state', None),
+                     instance.hospital_id if instance.user.is_active else None)
+
+
+def staff_deleted(sender, instance, **kwargs):
+    update_count(STAFF_COUNTERS[sender], getattr(instance, '_previous_stats_state', None), None)
+
+
+for staff_class in STAFF_COUNTERS:
+    pre_save.connect(remember_staff, sender=staff_class)
+    pre_delete.connect(remember_staff, sender=staff_class)
+    post_save.connect(staff_saved, sender=staff_class)
+    post_delete.connect(staff_deleted, sender=staff_class)
+
+
+@receiver(pre_save, sender=User)
+def remember_user(sender, instance, raw=False, update_fields=None, **kwargs):
+    # Only activating or deactivating a doctor or nurse changes the statistics.
+    instance._previous_is_active = None
+    if instance.pk is not None and not raw and (update_fields is None or 'is_active' in update_fields):
+        instance._previous_is_active = User.objects.filter(pk=instance.pk).values_list('is_active', flat=True).first()
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, raw=False, **kwargs):
+    previous_is_active = getattr(instance, '_previous_is_active', None)
+    if raw or previous_is_active is None or previous_is_active == instance.is_active:
+        return
+    for staff_class, field in STAFF_COUNTERS.items():
+        hospital_id = staff_class.objects.filter(user=instance).values_list('hospital', flat=True).first()
+        if hospital_id is not None:
+            adjust_hospital_stats(hospital_id, **{field: 1 if instance.is_active else -1})
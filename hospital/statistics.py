@@ -1,9 +1,12 @@
-from django.db import models
-from datetime import date, timedelta
-from functools import reduce
-from account.models import Patient, Doctor, Nurse
+import collections
+import itertools
+from django.db import models, transaction
+from django.db.models.expressions import RawSQL
+from datetime import date, datetime, time, timedelta
+from account.models import Doctor, Nurse
 from reservation.models import Appointment
-from hospital.models import TreatmentSession
+from hospital.episodes import CareFlow, READMISSION_WINDOWS
+from hospital.models import Hospital, HospitalStats, DailyStats, TreatmentSession
 
 
 def format_timedelta(delta):
@@ -15,9 +18,283 @@ def format_timedelta(delta):
     return '{} days {:02}h {:02}m {:02}s'.format(delta.days, hours, minutes, seconds)
 
 
+class SecondsBetween(models.Func):
+    """
+    The number of seconds from one timestamp to another, computed by the database.
+    Django doesn't support subtracting timestamps on every backend, so each backend gets its own SQL.
+    """
+
+    template = 'EXTRACT(EPOCH FROM (%(end)s - %(start)s))'
+
+    def __init__(self, start, end):
+        super(SecondsBetween, self).__init__(start, end, output_field=models.FloatField())
+
+    def as_sql(self, compiler, connection, template=None):
+        template = template or self.template
+        (start, start_params), (end, end_params) = [compiler.compile(expression)
+                                                    for expression in self.source_expressions]
+        if template.index('%(start)s') < template.index('%(end)s'):
+            params = start_params + end_params
+        else:
+            params = end_params + start_params
+        return template % {'start': start, 'end': end}, params
+
+    def as_sqlite(self, compiler, connection):
+        return self.as_sql(compiler, connection, template='((julianday(%(end)s) - julianday(%(start)s)) * 86400.0)')
+
+    def as_mysql(self, compiler, connection):
+        return self.as_sql(compiler, connection,
+                           template='(TIMESTAMPDIFF(MICROSECOND, %(start)s, %(end)s) / 1000000.0)')
+
+
+def count_subquery(queryset):
+    """
+    Count the rows of a queryset in a subquery, so the count can be selected along with other values.
+    :return: A `RawSQL` expression.
+    """
+    sql, params = queryset.values('pk').query.sql_with_params()
+    return RawSQL('SELECT COUNT(*) FROM (%s) counted' % sql, params, output_field=models.IntegerField())
+
+
+COUNTER_NAMES = ('visit_count', 'patient_count', 'admitted_patient_count', 'discharged_count', 'total_stay_seconds',
+                 'doctor_count', 'nurse_count', 'prescription_count')
+
+"""The figures of `HospitalStats` computed from the episodes of care, by `rebuild_care_flow_stats`."""
+CARE_FLOW_NAMES = ('episode_discharge_count', 'readmission_30_count', 'readmission_90_count', 'transfer_in_count',
+                   'transfer_out_count')
+
+
+def readmission_count_name(days):
+    """:return: The name of the `HospitalStats` field counting the readmissions within one of `READMISSION_WINDOWS`."""
+    return 'readmission_%d_count' % days
+
+
+def session_aggregates():
+    """
+    The aggregates of treatment sessions that the statistics are computed from.
+    :return: A dict of aggregate expressions, to be passed to `annotate()` or `aggregate()`.
+    """
+    return {
+        'visit_count': models.Count('id'),
+        'patient_count': models.Count('patient', distinct=True),
+        'admitted_patient_count': models.Count(
+            models.Case(models.When(discharge_timestamp=None, then='patient')), distinct=True),
+        'discharged_count': models.Count('discharge_timestamp'),
+        # Sessions that haven't been discharged have a NULL length, which is left out of the sum.
+        'total_stay_seconds': models.Sum(SecondsBetween('admission_timestamp', 'discharge_timestamp')),
+    }
+
+
+def count_by_hospital(queryset, hospital_field, hospital_ids):
+    """
+    Count the rows of a queryset per hospital, in one GROUP BY query.
+    :return: A dict of hospital ids to counts; hospitals without rows are left out.
+    """
+    rows = queryset.filter(**{hospital_field + '__in': hospital_ids}).order_by().values(hospital_field) \
+        .annotate(count=models.Count('pk'))
+    return dict((row[hospital_field], row['count']) for row in rows)
+
+
+def rebuild_hospital_stats(hospital_ids=None):
+    """
+    Recompute the `HospitalStats` counters of hospitals from scratch, with one grouped query per table.
+    The figures computed from the episodes of care are kept; `rebuild_care_flow_stats` recomputes them.
+    :param hospital_ids: The ids of the hospitals to rebuild the statistics of; all hospitals if None.
+    :return: A dict of hospital ids to the new `HospitalStats` objects.
+    """
+    from medical.models import Prescription
+
+    if hospital_ids is None:
+        hospital_ids = list(Hospital.objects.values_list('pk', flat=True))
+
+    sessions = TreatmentSession.objects.filter(treating_hospital__in=hospital_ids).order_by() \
+        .values('treating_hospital').annotate(**session_aggregates())
+    sessions = dict((row.pop('treating_hospital'), row) for row in sessions)
+    counts = {
+        'doctor_count': count_by_hospital(Doctor.objects.filter(user__is_active=True), 'hospital', hospital_ids),
+        'nurse_count': count_by_hospital(Nurse.objects.filter(user__is_active=True), 'hospital', hospital_ids),
+        'prescription_count': count_by_hospital(Prescription.objects.all(), 'doctor__hospital', hospital_ids),
+    }
+    care_flow = dict((row.pop('hospital'), row) for row in HospitalStats.objects.filter(hospital__in=hospital_ids)
+                     .values('hospital', *CARE_FLOW_NAMES))
+
+    stats = {}
+    for hospital_id in hospital_ids:
+        values = dict((name, count.get(hospital_id, 0)) for name, count in counts.items())
+        values.update(sessions.get(hospital_id, {}))
+        values['total_stay_seconds'] = values.get('total_stay_seconds') or 0
+        values.update(care_flow.get(hospital_id, {}))
+        stats[hospital_id] = HospitalStats(hospital_id=hospital_id, **values)
+
+    with transaction.atomic():
+        HospitalStats.objects.filter(hospital__in=hospital_ids).delete()
+        HospitalStats.objects.bulk_create(stats.values())
+    return stats
+
+
+def rebuild_care_flow_stats(hospital_ids=None):
+    """
+    Recompute the readmissions and transfers in the `HospitalStats` of hospitals from the episodes of care of their
+    patients. This reads the whole treatment history of the patients, so it is done by the statistics commands, and
+    never when statistics are read.
+    :param hospital_ids: The ids of the hospitals to recompute the figures of; all hospitals if None.
+    """
+    care_flow = CareFlow.for_hospitals(hospital_ids)
+    if hospital_ids is None:
+        hospital_ids = list(Hospital.objects.values_list('pk', flat=True))
+
+    with transaction.atomic():
+        for hospital_id in hospital_ids:
+            values = dict((readmission_count_name(days), care_flow.readmissions[days][hospital_id])
+                          for days in READMISSION_WINDOWS)
+            HospitalStats.objects.filter(hospital=hospital_id).update(
+                episode_discharge_count=care_flow.discharges[hospital_id],
+                transfer_in_count=care_flow.transfers_in(hospital_id),
+                transfer_out_count=care_flow.transfers_out(hospital_id), **values)
+
+
+def adjust_hospital_stats(hospital_id, **deltas):
+    """
+    Add to the counters of a hospital's `HospitalStats`, e.g. `adjust_hospital_stats(1, visit_count=1)`.
+    The counters are updated in the database, so concurrent adjustments don't overwrite each other.
+    If the hospital has no statistics yet, they are rebuilt instead, which accounts for the change.
+    """
+    deltas = dict((name, delta) for name, delta in deltas.items() if delta)
+    if not deltas:
+        return
+    updated = HospitalStats.objects.filter(hospital=hospital_id) \
+        .update(**dict((name, models.F(name) + delta) for name, delta in deltas.items()))
+    if not updated:
+        rebuild_hospital_stats([hospital_id])
+
+
+def take_daily_snapshot(day, hospital_ids=None):
+    """
+    Write the `DailyStats` of hospitals for a day, replacing any snapshot already taken for it.
+    Each metric is one grouped query over the day's rows, which the (hospital, timestamp) indexes keep small.
+    :param day: A `date`.
+    :param hospital_ids: The ids of the hospitals to take snapshots of; all hospitals if None.
+    :return: A list of the new `DailyStats` objects.
+    """
+    from medical.models import Prescription
+
+    if hospital_ids is None:
+        hospital_ids = list(Hospital.objects.values_list('pk', flat=True))
+    start = datetime.combine(day, time())
+    end = start + timedelta(days=1)
+
+    sessions = TreatmentSession.objects.all()
+    discharges = sessions.filter(treating_hospital__in=hospital_ids, discharge_timestamp__gte=start,
+                                 discharge_timestamp__lt=end).order_by().values('treating_hospital') \
+        .annotate(count=models.Count('id'),
+                  total_stay_seconds=models.Sum(SecondsBetween('admission_timestamp', 'discharge_timestamp')))
+    discharges = dict((row['treating_hospital'], row) for row in discharges)
+    census = sessions.filter(treating_hospital__in=hospital_ids, admission_timestamp__lt=end) \
+        .filter(models.Q(discharge_timestamp=None) | models.Q(discharge_timestamp__gte=end)).order_by() \
+        .values('treating_hospital').annotate(count=models.Count('patient', distinct=True))
+    census = dict((row['treating_hospital'], row['count']) for row in census)
+    admissions = count_by_hospital(sessions.filter(admission_timestamp__gte=start, admission_timestamp__lt=end),
+                                   'treating_hospital', hospital_ids)
+    prescriptions = count_by_hospital(
+        Prescription.objects.filter(creation_timestamp__gte=start, creation_timestamp__lt=end),
+        'doctor__hospital', hospital_ids)
+    appointments = count_by_hospital(Appointment.objects.filter(cancelled=False, date=day),
+                                     'doctor__hospital', hospital_ids)
+
+    snapshots = []
+    for hospital_id in hospital_ids:
+        discharged = discharges.get(hospital_id, {})
+        snapshots.append(DailyStats(hospital_id=hospital_id, date=day, admissions=admissions.get(hospital_id, 0),
+                                    discharges=discharged.get('count', 0),
+                                    total_stay_seconds=discharged.get('total_stay_seconds') or 0,
+                                    census=census.get(hospital_id, 0),
+                                    prescriptions=prescriptions.get(hospital_id, 0),
+                                    appointments=appointments.get(hospital_id, 0)))
+
+    with transaction.atomic():
+        DailyStats.objects.filter(date=day, hospital__in=hospital_ids).delete()
+        DailyStats.objects.bulk_create(snapshots)
+    return snapshots
+
+
+TREND_PERIODS = (
+    ('day', 'Daily'),
+    ('week', 'Weekly'),
+    ('month', 'Monthly'),
+    ('year', 'Yearly'),
+)
+
+Trend = collections.namedtuple('Trend', ['start', 'days', 'admissions', 'discharges', 'average_census',
+                                         'average_length_of_stay', 'prescriptions', 'appointments'])
+
+
+def period_start(day, period):
+    """Get the first day of the period (one of `TREND_PERIODS`) that a day is in; weeks start on Monday."""
+
+    if period == 'week':
+        return day - timedelta(days=day.weekday())
+    if period == 'month':
+        return day.replace(day=1)
+    if period == 'year':
+        return day.replace(month=1, day=1)
+    return day
+
+
+def read_trends(hospital, period, since, until):
+    """
+    Roll up a hospital's `DailyStats` into one `Trend` per period, oldest first.
+    Counts are summed over the period; the census is averaged over the days that have a snapshot,
+    and the average length of stay is taken over all the stays that ended in the period.
+    :param period: One of the periods in `TREND_PERIODS`.
+    :param since: The first day to include.
+    :param until: The last day to include.
+    """
+
+    snapshots = DailyStats.objects.filter(hospital=hospital, date__gte=since, date__lte=until).order_by('date') \
+        .values_list('date', 'admissions', 'discharges', 'census', 'total_stay_seconds', 'prescriptions',
+                     'appointments')
+
+    trends = []
+    for start, rows in itertools.groupby(snapshots, key=lambda row: period_start(row[0], period)):
+        rows = list(rows)
+        days = len(rows)
+        admissions, discharges, census, total_stay_seconds, prescriptions, appointments = \
+            [sum(row[column] for row in rows) for column in range(1, 7)]
+        average_length_of_stay = timedelta(seconds=round(total_stay_seconds / discharges, 3)) \
+            if discharges else timedelta()
+        trends.append(Trend(start, days, admissions, discharges, round(census / days, 1), average_length_of_stay,
+                            prescriptions, appointments))
+    return trends
+
+
 class Statistics:
-    def __init__(self, hospital):
+    def __init__(self, hospital, values=None):
         self.hospital = hospital
+        self._values = values
+
+    @classmethod
+    def for_hospitals(cls, hospitals=None):
+        """
+        Read the statistics of many hospitals at once, in a constant number of queries.
+        :param hospitals: The hospitals to read statistics for; all hospitals if None.
+        :return: A list of `Statistics`, one per hospital, in the same order.
+        """
+        hospitals = list(Hospital.objects.all() if hospitals is None else hospitals)
+        hospital_ids = [hospital.pk for hospital in hospitals]
+
+        stats = HospitalStats.objects.in_bulk(hospital_ids)
+        missing = [hospital_id for hospital_id in hospital_ids if hospital_id not in stats]
+        if missing:
+            stats.update(rebuild_hospital_stats(missing))
+        appointments = count_by_hospital(Appointment.objects.filter(cancelled=False, date=date.today()),
+                                         'doctor__hospital', hospital_ids)
+
+        statistics = []
+        for hospital in hospitals:
+            values = dict((name, getattr(stats[hospital.pk], name)) for name in COUNTER_NAMES + CARE_FLOW_NAMES)
+            values['appointments_today'] = appointments.get(hospital.pk, 0)
+            statistics.append(cls(hospital, values))
+        return statistics
 
     def calculate(self):
         return ["Number of patients visiting the hospital : " + str(self.num_of_patients()),
@@ -26,43 +303,76 @@ class Statistics:
                 "Number of prescriptions given : " + str(self.num_prescriptions_given()),
                 "Number of Doctors : " + str(self.num_of_doctors()),
                 "Number of Nurses : " + str(self.num_of_nurses()),
-                "Appointments today : " + str(self.num_of_appointments_today())]
+                "Appointments today : " + str(self.num_of_appointments_today())] + \
+               ["Readmitted within %d days : %.1f%%" % (days, self.readmission_rate(days) * 100)
+                for days in READMISSION_WINDOWS] + \
+               ["Patients transferred in : " + str(self.num_transfers_in()),
+                "Patients transferred out : " + str(self.num_transfers_out())]
+
+    def values(self):
+        """
+        Read the hospital's `HospitalStats`, along with today's appointments, in a single query;
+        the result is kept for the other methods.
+        Appointments are counted in a subquery, since the count changes with the date rather than with the data.
+        :return: A dict of the raw values.
+        """
+        if self._values is None:
+            query = HospitalStats.objects.filter(hospital=self.hospital).annotate(
+                appointments_today=count_subquery(Appointment.objects.filter(
+                    cancelled=False, date=date.today(), doctor__hospital=self.hospital))
+            ).values('appointments_today', *(COUNTER_NAMES + CARE_FLOW_NAMES))
+            self._values = query.first()
+            if self._values is None:
+                rebuild_hospital_stats([self.hospital.pk])
+                self._values = query.first()
+        return self._values
 
     def num_of_patients(self):
-        treatment_session_query = TreatmentSession.objects.filter(discharge_timestamp=None).filter(treating_hospital=self.hospital)
-        return Patient.objects.filter(treatmentsession__in=treatment_session_query).count()
+        return self.values()['admitted_patient_count']
 
     def num_of_doctors(self):
-        return Doctor.objects.filter(hospital=self.hospital).filter(user__is_active=True).count()
+        return self.values()['doctor_count']
 
     def num_of_nurses(self):
-        return Nurse.objects.filter(hospital=self.hospital).filter(user__is_active=True).count()
+        return self.values()['nurse_count']
 
     def num_of_appointments_today(self):
-        return Appointment.objects.filter(cancelled=False).filter(date=date.today()).filter(doctor__hospital=self.hospital).count()
+        return self.values()['appointments_today']
 
     def average_visits_per_patient(self):
-        treatment_session_query = TreatmentSession.objects.filter(treating_hospital=self.hospital)
-        query_results = treatment_session_query.aggregate(
-            visit_count=models.Count('id'),
-            patient_count=models.Count('patient', distinct=True)
-        )
-        if query_results['patient_count'] == 0:
+        values = self.values()
+        if values['patient_count'] == 0:
             return 0
         else:
-            return query_results['visit_count'] / query_results['patient_count']
+            return values['visit_count'] / values['patient_count']
 
     def average_length_of_stay(self):
-        treatment_session = TreatmentSession.objects.exclude(discharge_timestamp=None).filter(treating_hospital=self.hospital)
-        if treatment_session.count() == 0:
+        values = self.values()
+        if values['discharged_count'] == 0:
             return timedelta()
-        else:
-            total_time = reduce(lambda acc, x: acc + (x.discharge_timestamp - x.admission_timestamp), treatment_session, timedelta())
-            return total_time / treatment_session.count()
+        # julianday() is only precise to about a millisecond.
+        return timedelta(seconds=round(values['total_stay_seconds'] / values['discharged_count'], 3))
 
     def num_prescriptions_given(self):
-        from medical.models import Prescription
-        return Prescription.objects.filter(doctor__hospital=self.hospital).count()
+        return self.values()['prescription_count']
+
+    def readmission_rate(self, days):
+        """
+        As of the last time the statistics were computed; see `rebuild_care_flow_stats`.
+        :param days: One of `READMISSION_WINDOWS`.
+        :return: The fraction of the episodes of care ending at the hospital that were followed by another admission
+                 within the given number of days, from 0 to 1.
+        """
+        values = self.values()
+        if values['episode_discharge_count'] == 0:
+            return 0
+        return values[readmission_count_name(days)] / values['episode_discharge_count']
+
+    def num_transfers_in(self):
+        return self.values()['transfer_in_count']
+
+    def num_transfers_out(self):
+        return self.values()['transfer_out_count']
 
     def __str__(self):
         return "Statistics for " + self.hospital.name
@@ -1,11 +1,26 @@
-from django.test import TestCase, RequestFactory
+import csv
+import datetime
+import json
+import os
+import shutil
+import tempfile
+from io import StringIO
+from unittest import mock, skipUnless
+from django.test import TestCase, RequestFactory, override_settings
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User, AnonymousUser
 from account.management.commands import setupgroups
 from account.models import Patient, Doctor, Nurse, create_default_account, Administrator
-from medical.models import Diagnosis
-from hospital.models import Hospital, TreatmentSession
-from hospital import views
+from medical.models import Diagnosis, Drug, Prescription
+from reservation.models import Appointment
+from hospital.models import Hospital, HospitalStats, DailyStats, TreatmentSession, ActivityLog
+from hospital.statistics import Statistics, COUNTER_NAMES, rebuild_hospital_stats, take_daily_snapshot, \
+    read_trends, rebuild_care_flow_stats
+from hospital import distribution, views
+from hospital.distribution import LengthOfStayDistribution
+from hospital.episodes import CareFlow
+from hnet.logger import follow_log
 
 PATIENT_USERNAME = 'patient'
 DOCTOR_USERNAME = 'doctor'
@@ -324,6 +339,362 @@ class PatientTransferTestCase(TestCase):
                          'Expected no new treatment session to be added to the database.')
 
 
+class StatisticsTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        setupgroups.Command().handle(quiet=True)
+
+        cls.hospital = Hospital.objects.create(name='Test hospital', location='Test location')
+        other_hospital = Hospital.objects.create(name='Other hospital', location='Other location')
+        create_default_account(PATIENT_USERNAME, PASSWORD, Patient, cls.hospital)
+        create_default_account('patient2', PASSWORD, Patient, cls.hospital)
+        create_default_account(DOCTOR_USERNAME, PASSWORD, Doctor, cls.hospital)
+        create_default_account(NURSE_USERNAME, PASSWORD, Nurse, other_hospital)
+        inactive_doctor = create_default_account('doctor2', PASSWORD, Doctor, cls.hospital)
+        inactive_doctor.is_active = False
+        inactive_doctor.save()
+
+        patient = User.objects.get(username=PATIENT_USERNAME).patient
+        other_patient = User.objects.get(username='patient2').patient
+        doctor = User.objects.get(username=DOCTOR_USERNAME).doctor
+        admission = datetime.datetime(2017, 4, 1, 8, 0)
+        for days, hours in ((1, 0), (2, 6)):
+            session = TreatmentSession.objects.create(patient=patient, treating_hospital=cls.hospital)
+            session.admission_timestamp = admission
+            session.discharge_timestamp = admission + datetime.timedelta(days=days, hours=hours)
+            session.save()
+        TreatmentSession.objects.create(patient=other_patient, treating_hospital=cls.hospital)
+        TreatmentSession.objects.create(patient=other_patient, treating_hospital=other_hospital)
+
+        diagnosis = Diagnosis.objects.create(patient=patient, summary='Summary')
+        drug = Drug.objects.create(name='Drug', description='Description')
+        Prescription.objects.create(diagnosis=diagnosis, doctor=doctor, drug=drug, instruction='Instruction')
+        Appointment.objects.create(title='Today', patient=patient, doctor=doctor, date=datetime.date.today(),
+                                   start_time=datetime.time(9), end_time=datetime.time(10))
+        Appointment.objects.create(title='Cancelled', patient=patient, doctor=doctor, date=datetime.date.today(),
+                                   start_time=datetime.time(11), end_time=datetime.time(12), cancelled=True)
+
+    def test_calculate(self):
+        statistics = Statistics(self.hospital)
+        with self.assertNumQueries(1):
+            statistics.calculate()
+        self.assertEqual(statistics.values()['visit_count'], 3)
+
+        self.assertEqual(statistics.num_of_patients(), 1, 'Expected only the admitted patients to be counted.')
+        self.assertEqual(statistics.average_visits_per_patient(), 1.5)
+        self.assertEqual(statistics.average_length_of_stay(), datetime.timedelta(days=1, hours=15),
+                         'Expected the sessions that are still open to be left out of the average.')
+        self.assertEqual(statistics.num_prescriptions_given(), 1)
+        self.assertEqual(statistics.num_of_doctors(), 1, 'Expected inactive doctors not to be counted.')
+        self.assertEqual(statistics.num_of_nurses(), 0)
+        self.assertEqual(statistics.num_of_appointments_today(), 1)
+
+    def test_for_hospitals(self):
+        Hospital.objects.create(name='Empty hospital', location='Location')
+        with self.assertNumQueries(3):
+            statistics = Statistics.for_hospitals()
+            for hospital_statistics in statistics:
+                hospital_statistics.calculate()
+
+        self.assertEqual([hospital_statistics.hospital.name for hospital_statistics in statistics],
+                         ['Test hospital', 'Other hospital', 'Empty hospital'])
+        for hospital_statistics in statistics:
+            self.assertEqual(hospital_statistics.calculate(), Statistics(hospital_statistics.hospital).calculate(),
+                             'Expected the same statistics as when read for one hospital.')
+
+        statistics = Statistics.for_hospitals(Hospital.objects.filter(name='Other hospital'))
+        self.assertEqual(len(statistics), 1)
+        self.assertEqual(statistics[0].num_of_nurses(), 1)
+
+    def assertCountersCorrect(self):
+        maintained = dict((stats.hospital_id, stats) for stats in HospitalStats.objects.all())
+        rebuilt = rebuild_hospital_stats()
+        self.assertEqual(set(maintained), set(rebuilt))
+        for hospital_id, stats in rebuilt.items():
+            for name in COUNTER_NAMES:
+                self.assertAlmostEqual(getattr(maintained[hospital_id], name), getattr(stats, name), places=2,
+                                       msg='Expected the maintained %s to match the rebuilt one.' % name)
+
+    def test_counters(self):
+        self.assertCountersCorrect()
+
+        other_patient = User.objects.get(username='patient2').patient
+        session = other_patient.treatmentsession_set.get(treating_hospital=self.hospital)
+        session.discharge_timestamp = session.admission_timestamp + datetime.timedelta(hours=5)
+        session.save()
+        self.assertCountersCorrect()
+
+        session.treating_hospital = Hospital.objects.get(name='Other hospital')
+        session.save()
+        self.assertCountersCorrect()
+
+        session.delete()
+        self.assertCountersCorrect()
+
+        user = User.objects.get(username='doctor2')
+        user.is_active = True
+        user.save()
+        self.assertEqual(Statistics(self.hospital).num_of_doctors(), 2, 'Expected reactivated doctors to be counted.')
+        user.is_active = False
+        user.save()
+        self.assertCountersCorrect()
+
+        Prescription.objects.all().delete()
+        self.assertCountersCorrect()
+
+    def test_rebuild_command(self):
+        HospitalStats.objects.update(visit_count=100)
+        HospitalStats.objects.filter(hospital=self.hospital).delete()
+        self.assertEqual(Statistics(self.hospital).values()['visit_count'], 3,
+                         'Expected missing statistics to be rebuilt when read.')
+
+        call_command('rebuildstatistics', stdout=StringIO())
+        self.assertCountersCorrect()
+        self.assertEqual(HospitalStats.objects.get(hospital__name='Other hospital').visit_count, 1)
+
+    def test_compute_command(self):
+        HospitalStats.objects.update(visit_count=100)
+        # The test database only exists in this process, so the statistics are computed without workers.
+        call_command('computestatistics', processes=1, batch_size=1, stdout=StringIO())
+        self.assertCountersCorrect()
+        self.assertEqual(DailyStats.objects.filter(date=datetime.date.today() - datetime.timedelta(days=1)).count(),
+                         2, 'Expected the snapshot of the day before to be taken for every hospital.')
+
+    def test_empty_hospital(self):
+        statistics = Statistics(Hospital.objects.create(name='Empty hospital', location='Location'))
+        self.assertEqual(statistics.calculate()[:3], ['Number of patients visiting the hospital : 0',
+                                                      'Average visits per patient : 0',
+                                                      'Average length of stay : 0 days 00h 00m 00s'])
+
+
+class CareFlowTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        setupgroups.Command().handle(quiet=True)
+
+        cls.hospitals = [Hospital.objects.create(name='Hospital %d' % i, location='Location') for i in range(3)]
+        create_default_account(PATIENT_USERNAME, PASSWORD, Patient, cls.hospitals[0])
+        create_default_account(ADMINISTRATOR_USERNAME, PASSWORD, Administrator, cls.hospitals[0])
+        patient = User.objects.get(username=PATIENT_USERNAME).patient
+
+        # Admitted to hospital 0, transferred to hospital 1 and then to hospital 2, and discharged on 2017-01-10;
+        # then admitted to hospital 0 again 20 days later, and discharged there; then again 60 days later.
+        first = cls.create_session(patient, 0, datetime.datetime(2017, 1, 1), datetime.datetime(2017, 1, 3))
+        second = cls.create_session(patient, 1, datetime.datetime(2017, 1, 3), datetime.datetime(2017, 1, 5), first)
+        cls.create_session(patient, 2, datetime.datetime(2017, 1, 5), datetime.datetime(2017, 1, 10), second)
+        cls.create_session(patient, 0, datetime.datetime(2017, 1, 30), datetime.datetime(2017, 2, 1))
+        cls.create_session(patient, 0, datetime.datetime(2017, 4, 2), None)
+
+    @classmethod
+    def create_session(cls, patient, hospital, admission, discharge, previous_session=None):
+        session = TreatmentSession.objects.create(patient=patient, treating_hospital=cls.hospitals[hospital],
+                                                  previous_session=previous_session)
+        session.admission_timestamp = admission
+        session.discharge_timestamp = discharge
+        session.save()
+        return session
+
+    def test_care_flow(self):
+        with self.assertNumQueries(1):
+            care_flow = CareFlow.for_hospitals()
+
+        hospital_ids = [hospital.pk for hospital in self.hospitals]
+        self.assertEqual(care_flow.discharges[hospital_ids[2]], 1,
+                         'Expected an episode to be discharged from the hospital it ended at.')
+        self.assertEqual(care_flow.readmission_rate(hospital_ids[2], 30), 1)
+        self.assertEqual(care_flow.readmission_rate(hospital_ids[0], 30), 0)
+        self.assertEqual(care_flow.readmission_rate(hospital_ids[0], 90), 1)
+        self.assertEqual(care_flow.transfers_out(hospital_ids[0]), 1)
+        self.assertEqual(care_flow.transfers_in(hospital_ids[2]), 1)
+        self.assertEqual([counts for _, counts in care_flow.transfer_matrix(self.hospitals)],
+                         [[0, 1, 0], [0, 0, 1], [0, 0, 0]])
+
+    def test_statistics(self):
+        call_command('computestatistics', processes=1, stdout=StringIO())
+        statistics = Statistics(self.hospitals[2])
+        self.assertIn('Readmitted within 30 days : 100.0%', statistics.calculate())
+        self.assertIn('Patients transferred in : 1', statistics.calculate())
+        self.assertEqual(Statistics(self.hospitals[0]).num_transfers_out(), 1)
+
+    def test_statistics_are_precomputed(self):
+        statistics = Statistics(self.hospitals[2])
+        self.assertIn('Readmitted within 30 days : 0.0%', statistics.calculate(),
+                      'Expected the statistics not to follow the episodes of care when they are read.')
+
+        rebuild_care_flow_stats([self.hospitals[2].pk])
+        rebuild_hospital_stats()
+        self.assertIn('Readmitted within 30 days : 100.0%', Statistics(self.hospitals[2]).calculate(),
+                      'Expected rebuilding the counters to keep the readmissions and transfers.')
+        self.assertIn('Patients transferred out : 0', Statistics(self.hospitals[0]).calculate(),
+                      'Expected only the hospitals given to be recomputed.')
+
+    def test_transfers_view(self):
+        self.client.login(username=ADMINISTRATOR_USERNAME, password=PASSWORD)
+        response = self.client.get(reverse('hospital:transfers'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([hospital.name for hospital in response.context['hospitals']],
+                         ['Hospital 0', 'Hospital 1'],
+                         'Expected administrators to only see the hospitals their hospital transfers with.')
+
+
+class DailyStatsTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        setupgroups.Command().handle(quiet=True)
+
+        cls.hospital = Hospital.objects.create(name='Test hospital', location='Test location')
+        create_default_account(PATIENT_USERNAME, PASSWORD, Patient, cls.hospital)
+        create_default_account('patient2', PASSWORD, Patient, cls.hospital)
+        create_default_account(DOCTOR_USERNAME, PASSWORD, Doctor, cls.hospital)
+        create_default_account(ADMINISTRATOR_USERNAME, PASSWORD, Administrator, cls.hospital)
+
+        patient = User.objects.get(username=PATIENT_USERNAME).patient
+        other_patient = User.objects.get(username='patient2').patient
+        doctor = User.objects.get(username=DOCTOR_USERNAME).doctor
+        # 2017-03-30 is a Thursday; the patient stays a day and a half, and the other patient hasn't left yet.
+        cls.create_session(patient, datetime.datetime(2017, 3, 30, 8), datetime.datetime(2017, 3, 31, 20))
+        cls.create_session(other_patient, datetime.datetime(2017, 3, 31, 9), None)
+        cls.create_session(patient, datetime.datetime(2017, 4, 3, 10), datetime.datetime(2017, 4, 3, 16))
+
+        diagnosis = Diagnosis.objects.create(patient=patient, summary='Summary')
+        prescription = Prescription.objects.create(diagnosis=diagnosis, doctor=doctor, instruction='Instruction',
+                                                   drug=Drug.objects.create(name='Drug', description='Description'))
+        prescription.creation_timestamp = datetime.datetime(2017, 3, 31, 12)
+        prescription.save()
+        for day in (30, 31, 31):
+            Appointment.objects.create(title='Appointment', patient=patient, doctor=doctor,
+                                       date=datetime.date(2017, 3, day), start_time=datetime.time(9),
+                                       end_time=datetime.time(10))
+
+    @classmethod
+    def create_session(cls, patient, admission, discharge):
+        session = TreatmentSession.objects.create(patient=patient, treating_hospital=cls.hospital)
+        session.admission_timestamp = admission
+        session.discharge_timestamp = discharge
+        session.save()
+
+    def test_snapshot(self):
+        call_command('snapshotstatistics', date='2017-04-03', days=5, stdout=StringIO())
+        snapshots = dict((snapshot.date.day, snapshot)
+                         for snapshot in DailyStats.objects.filter(hospital=self.hospital))
+        self.assertEqual(sorted(snapshots), [1, 2, 3, 30, 31])
+
+        self.assertEqual([snapshots[30].admissions, snapshots[30].discharges, snapshots[30].census], [1, 0, 1])
+        self.assertEqual([snapshots[31].admissions, snapshots[31].discharges, snapshots[31].census], [1, 1, 1])
+        self.assertAlmostEqual(snapshots[31].total_stay_seconds, 36 * 3600, places=1)
+        self.assertEqual(snapshots[31].prescriptions, 1)
+        self.assertEqual(snapshots[31].appointments, 2)
+        self.assertEqual(snapshots[3].census, 1, 'Expected only the patients still admitted at midnight.')
+
+        take_daily_snapshot(datetime.date(2017, 4, 3))
+        self.assertEqual(DailyStats.objects.count(), 5, 'Expected a snapshot to replace an existing one.')
+
+    def test_trends(self):
+        call_command('snapshotstatistics', date='2017-04-03', days=5, stdout=StringIO())
+
+        weeks = read_trends(self.hospital, 'week', datetime.date(2017, 3, 1), datetime.date(2017, 4, 30))
+        self.assertEqual([week.start for week in weeks], [datetime.date(2017, 3, 27), datetime.date(2017, 4, 3)])
+        self.assertEqual([week.admissions for week in weeks], [2, 1])
+        self.assertEqual(weeks[0].average_census, 1.0)
+        self.assertEqual(weeks[0].average_length_of_stay, datetime.timedelta(hours=36))
+
+        months = read_trends(self.hospital, 'month', datetime.date(2017, 3, 31), datetime.date(2017, 4, 30))
+        self.assertEqual([(month.start, month.days) for month in months],
+                         [(datetime.date(2017, 3, 1), 1), (datetime.date(2017, 4, 1), 3)])
+        self.assertEqual(months[1].average_length_of_stay, datetime.timedelta(hours=6))
+
+    def test_view(self):
+        call_command('snapshotstatistics', date='2017-04-03', days=5, stdout=StringIO())
+        self.client.login(username=ADMINISTRATOR_USERNAME, password=PASSWORD)
+        response = self.client.get(reverse('hospital:trends'), {'period': 'year', 'since': '2017-01-01',
+                                                                 'until': '2017-12-31'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['trends']), 1)
+        self.assertEqual(response.context['trends'][0].admissions, 3)
+        self.assertNotIn('hospital', response.context['form'].fields,
+                         'Expected administrators to only see the trends of their own hospital.')
+
+    def export(self, data):
+        call_command('snapshotstatistics', date='2017-04-03', days=5, stdout=StringIO())
+        self.client.login(username=ADMINISTRATOR_USERNAME, password=PASSWORD)
+        response = self.client.get(reverse('hospital:export_statistics'), data)
+        self.assertTrue(response.streaming, 'Expected the export to be streamed.')
+        return response, b''.join(response.streaming_content).decode('utf-8')
+
+    def test_export_csv(self):
+        response, content = self.export({'format': 'csv', 'history': 'on', 'since': '2017-03-31',
+                                         'until': '2017-04-03'})
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.DictReader(StringIO(content)))
+        self.assertEqual([row['type'] for row in rows], ['summary', 'daily', 'daily', 'daily', 'daily'])
+        self.assertEqual(rows[0]['hospital'], 'Test hospital')
+        self.assertEqual(rows[0]['census'], '', 'Expected columns that don\'t apply to be empty.')
+        self.assertEqual(rows[1]['date'], '2017-03-31')
+        self.assertEqual(rows[1]['average_length_of_stay_seconds'], str(36 * 3600.0))
+        self.assertEqual(rows[1]['appointments'], '2')
+
+    def test_export_ndjson(self):
+        response, content = self.export({'format': 'ndjson'})
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual(len(rows), 1, 'Expected no daily history unless asked for.')
+        self.assertEqual(rows[0]['type'], 'summary')
+        self.assertEqual(rows[0]['admitted_patients'], 1)
+        self.assertNotIn('census', rows[0])
+
+    def test_export_form(self):
+        self.client.login(username=ADMINISTRATOR_USERNAME, password=PASSWORD)
+        response = self.client.get(reverse('hospital:export_statistics'))
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(reverse('hospital:export_statistics'), {'format': 'xml'})
+        self.assertFalse(response.context['form'].is_valid())
+
+
+class LengthOfStayTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        setupgroups.Command().handle(quiet=True)
+
+        cls.hospital = Hospital.objects.create(name='Test hospital', location='Test location')
+        create_default_account(PATIENT_USERNAME, PASSWORD, Patient, cls.hospital)
+        create_default_account(ADMINISTRATOR_USERNAME, PASSWORD, Administrator, cls.hospital)
+
+        patient = User.objects.get(username=PATIENT_USERNAME).patient
+        # Stays of 1 to 10 hours starting on Monday 2017-04-03, then a 40 day stay starting on a Sunday.
+        stays = [(datetime.datetime(2017, 4, 3, 8), datetime.timedelta(hours=hours)) for hours in range(1, 11)]
+        stays.append((datetime.datetime(2017, 4, 9, 8), datetime.timedelta(days=40)))
+        for admission, length in stays:
+            session = TreatmentSession.objects.create(patient=patient, treating_hospital=cls.hospital)
+            session.admission_timestamp = admission
+            session.discharge_timestamp = admission + length
+            session.save()
+        TreatmentSession.objects.create(patient=patient, treating_hospital=cls.hospital)
+
+    def assertDistribution(self, stays):
+        self.assertEqual(stays.count(), 11, 'Expected only the stays that have ended.')
+        self.assertEqual(stays.median(), datetime.timedelta(hours=6))
+        self.assertEqual(stays.percentile(90), datetime.timedelta(hours=10))
+        self.assertEqual(stays.mean(), datetime.timedelta(hours=(55 + 960) / 11))
+        self.assertEqual(stays.histogram(), [(6, 6), (12, 4), (24, 0), (48, 0), (72, 0), (168, 0), (336, 0),
+                                             (720, 0), (None, 1)])
+        self.assertEqual(stays.by_weekday()[0], ('Monday', 10, datetime.timedelta(hours=5, minutes=30)))
+        self.assertEqual(stays.by_weekday()[6], ('Sunday', 1, datetime.timedelta(days=40)))
+
+    @skipUnless(distribution.numpy, 'NumPy is not installed.')
+    def test_numpy(self):
+        self.assertDistribution(LengthOfStayDistribution.for_hospital(self.hospital))
+
+    def test_plain_python(self):
+        with mock.patch.object(distribution, 'numpy', None):
+            self.assertDistribution(LengthOfStayDistribution.for_hospital(self.hospital))
+
+    def test_view(self):
+        self.client.login(username=ADMINISTRATOR_USERNAME, password=PASSWORD)
+        response = self.client.get(reverse('hospital:length_of_stay'), {'since': '2017-04-04', 'until': '2017-05-31'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['distribution'].count(), 1,
+                         'Expected only the stays that ended in the date range.')
+
+
 class ViewStatisticsTestCase(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -341,3 +712,161 @@ class ViewStatisticsTestCase(TestCase):
     def test_redirect(self):
         response = self.client.get(reverse("hospital:statistics"))
         self.assertEqual(response.status_code, 302, 'Expected to view statistics page.')
+
+
+class ViewLogTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        setupgroups.Command().handle(quiet=True)
+
+        hospital = Hospital.objects.create(name='Test hospital', location='Test location')
+        other_hospital = Hospital.objects.create(name='Other hospital', location='Other location')
+        create_default_account(ADMINISTRATOR_USERNAME, PASSWORD, Administrator, hospital)
+        create_default_account(DOCTOR_USERNAME, PASSWORD, Doctor, hospital)
+        create_default_account(NURSE_USERNAME, PASSWORD, Nurse, other_hospital)
+        create_default_account(PATIENT_USERNAME, PASSWORD, Patient, hospital)
+
+        doctor = User.objects.get(username=DOCTOR_USERNAME)
+        ActivityLog.objects.bulk_create(
+            [ActivityLog(timestamp=datetime.datetime(2017, 4, 1, 12, 0, i), user=doctor, username=DOCTOR_USERNAME,
+                         action='patient_admitted', hospital=hospital) for i in range(25)] +
+            [ActivityLog(timestamp=datetime.datetime(2017, 4, 2, 12, 0, 0), user=doctor, username=DOCTOR_USERNAME,
+                         action='patient_discharged', hospital=hospital),
+             ActivityLog(timestamp=datetime.datetime(2017, 4, 2, 12, 0, 0), username=NURSE_USERNAME,
+                         action='patient_discharged', hospital=other_hospital)])
+
+    def get(self, data=None):
+        self.client.login(username=ADMINISTRATOR_USERNAME, password=PASSWORD)
+        return self.client.get(reverse('hospital:log'), data or {})
+
+    def test_pages(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['log_list']), 20)
+        self.assertEqual([entry.username for entry in response.context['log_list']][:2],
+                         [DOCTOR_USERNAME, DOCTOR_USERNAME],
+                         'Expected only the activity at the administrator\'s hospital.')
+        self.assertIsNone(response.context['newer'])
+
+        older = response.context['older']
+        response = self.get({'before': older})
+        self.assertEqual(len(response.context['log_list']), 6)
+        self.assertIsNone(response.context['older'])
+
+        response = self.get({'after': response.context['newer']})
+        self.assertEqual(response.context['older'], older, 'Expected to page back to the first page.')
+        self.assertIsNone(response.context['newer'])
+
+    def test_filters(self):
+        response = self.get({'username': DOCTOR_USERNAME, 'action': 'patient_discharged'})
+        self.assertEqual(len(response.context['log_list']), 1)
+
+        response = self.get({'action': 'patient_admitted', 'since': '2017-04-01', 'until': '2017-04-01'})
+        self.assertEqual(len(response.context['log_list']), 20)
+        self.assertContains(response, 'until=2017-04-01', msg_prefix='Expected the filters to carry over '
+                                                                     'to the next page.')
+
+        response = self.get({'since': '2017-04-02', 'until': '2017-04-01'})
+        self.assertFalse(response.context['form'].is_valid())
+
+    def test_filter_removed_user(self):
+        ActivityLog.objects.filter(action='patient_discharged', username=DOCTOR_USERNAME).update(user=None)
+        response = self.get({'username': DOCTOR_USERNAME, 'action': 'patient_discharged'})
+        self.assertEqual(len(response.context['log_list']), 1,
+                         'Expected entries without a user to be found by their username.')
+
+    def test_prune(self):
+        ActivityLog.objects.create(timestamp=datetime.datetime.now(), username=DOCTOR_USERNAME, action='drug_added')
+        with override_settings(ACTIVITY_LOG_MAX_AGE_DAYS=30):
+            call_command('pruneactivitylog', stdout=StringIO())
+        self.assertFalse(ActivityLog.objects.filter(timestamp__lt=datetime.datetime(2017, 5, 1)).exists())
+        self.assertTrue(ActivityLog.objects.filter(action='drug_added').exists(),
+                        'Expected only the entries older than the maximum age to be deleted.')
+
+        ActivityLog.objects.create(timestamp=datetime.datetime(2017, 4, 1), username=DOCTOR_USERNAME,
+                                   action='drug_removed')
+        with override_settings(ACTIVITY_LOG_MAX_AGE_DAYS=None):
+            call_command('pruneactivitylog', stdout=StringIO())
+        self.assertTrue(ActivityLog.objects.filter(action='drug_removed').exists(),
+                        'Expected entries to be kept forever without a maximum age.')
+
+    def stream(self, data=None, **extra):
+        self.client.login(username=ADMINISTRATOR_USERNAME, password=PASSWORD)
+        with override_settings(ACTIVITY_LOG_STREAM_DURATION=0):
+            response = self.client.get(reverse('hospital:log_stream'), data or {}, **extra)
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_stream_backlog(self):
+        events = self.stream({'backlog': 2})
+        self.assertEqual(events.count('data: '), 2)
+        self.assertIn('data: 2017-04-02 12:00:00, %s, Patient discharged.' % DOCTOR_USERNAME, events)
+        self.assertNotIn(NURSE_USERNAME, events, 'Expected only the activity at the administrator\'s hospital.')
+
+        events = self.stream({'backlog': 0})
+        self.assertNotIn('data: ', events)
+        self.assertIn(': keep-alive', events)
+
+    def test_stream_resume(self):
+        entries = ActivityLog.objects.filter(username=DOCTOR_USERNAME).order_by('pk')
+        last = entries[23]
+        events = self.stream({'action': 'patient_admitted'}, HTTP_LAST_EVENT_ID=str(last.pk))
+        self.assertEqual(events.count('data: '), 1, 'Expected only the filtered entries after the last event.')
+        self.assertIn('id: %d\n' % entries[24].pk, events)
+
+    def test_stream_long_poll(self):
+        entries = ActivityLog.objects.filter(username=DOCTOR_USERNAME)
+        last = entries.latest('pk')
+
+        def sleep(seconds):
+            ActivityLog.objects.create(username=DOCTOR_USERNAME, action='drug_added')
+
+        events = list(follow_log(entries, after=last.pk, duration=60, sleep=sleep))
+        self.assertEqual(len([event for event in events if event.startswith('id: ')]), 1)
+        self.assertTrue(events[-1].startswith('id: '), 'Expected the stream to end once it sent new entries, '
+                                                       'so the viewer releases the worker.')
+
+    def test_stream_skips_imported_entries(self):
+        entries = ActivityLog.objects.filter(username=DOCTOR_USERNAME)
+        last = entries.order_by('timestamp', 'pk').last()
+
+        def sleep(seconds):
+            # Imported entries get new ids, but keep their old timestamps.
+            ActivityLog.objects.create(timestamp=datetime.datetime(2017, 3, 1), username=DOCTOR_USERNAME,
+                                       action='doctor_logged_in')
+            ActivityLog.objects.create(username=DOCTOR_USERNAME, action='drug_added')
+
+        events = list(follow_log(entries, after=last.pk, duration=60, sleep=sleep))
+        self.assertEqual([event for event in events if event.startswith('id: ')],
+                         ['id: %d\ndata: %s\n\n' % (entry.pk, entry) for entry in entries.filter(action='drug_added')],
+                         'Expected only the entries newer than the last one sent, in the order of the log pages.')
+
+    def test_request_entries(self):
+        patient = User.objects.get(username=PATIENT_USERNAME).patient
+        self.client.login(username=DOCTOR_USERNAME, password=PASSWORD)
+        self.client.post(reverse('hospital:admit_patient', args=[patient.id]))
+
+        entry = ActivityLog.objects.latest('pk')
+        self.assertEqual(entry.action, 'patient_admitted')
+        self.assertEqual(entry.user.username, DOCTOR_USERNAME)
+        self.assertEqual(entry.hospital, patient.preferred_hospital, 'Expected the entry to record the doctor\'s hospital.')
+        self.assertEqual(entry.target, patient)
+
+    def test_import(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'activity.log')
+            with open(path, 'w') as file:
+                file.write('2017-03-01 08:00:00, %s, Doctor logged in.\n' % DOCTOR_USERNAME)
+                file.write('not a log entry\n')
+                file.write('2017-03-01 08:00:01, removed, Drug removed.\n')
+            call_command('importactivitylog', file=path, stdout=StringIO())
+
+            entries = ActivityLog.objects.filter(timestamp__lt=datetime.datetime(2017, 4, 1)).order_by('timestamp')
+            self.assertEqual([(entry.username, entry.action) for entry in entries],
+                             [(DOCTOR_USERNAME, 'doctor_logged_in'), ('removed', 'drug_removed')])
+            self.assertEqual(entries[0].user.username, DOCTOR_USERNAME)
+            self.assertIsNone(entries[1].user, 'Expected unknown users to be kept by name only.')
+            self.assertTrue(os.path.exists(path + '.imported'), 'Expected the log not to be imported twice.')
+        finally:
+            shutil.rmtree(directory)
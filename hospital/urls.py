@@ -4,8 +4,12 @@ from . import views
 app_name = 'hospital'
 urlpatterns = [
     url(r'^log/$', views.logView, name='log'),
-    url(r'^log/(?P<page>[0-9]*)/$', views.logView, name='log'),
+    url(r'^log/stream/$', views.logStream, name='log_stream'),
     url(r'^statistics/$', views.statisticsView, name='statistics'),
+    url(r'^statistics/trends/$', views.trendsView, name='trends'),
+    url(r'^statistics/length_of_stay/$', views.lengthOfStayView, name='length_of_stay'),
+    url(r'^statistics/export/$', views.exportStatisticsView, name='export_statistics'),
+    url(r'^statistics/transfers/$', views.transfersView, name='transfers'),
     url(r'^admit/(?P<patient_id>[0-9]+)/$', views.admit_patient, name='admit_patient'),
     url(r'^discharge/(?P<patient_id>[0-9]+)/$', views.discharge_patient, name='discharge_patient'),
     url(r'^doctor_transfer/(?P<patient_id>[0-9]+)/$', views.transfer_patient_as_doctor,
@@ -1,11 +1,18 @@
-from datetime import datetime
+import itertools
+from datetime import datetime, time, timedelta
+from django.conf import settings
 from django.contrib.auth.decorators import login_required, permission_required, user_passes_test
+from django.http import StreamingHttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from account.models import Patient, get_account_from_user
-from hospital.models import TreatmentSession, Hospital
-from hospital.statistics import Statistics
-from hnet.logger import CreateLogEntry, readLog
-from hospital.forms import TransferForm
+from hospital.models import TreatmentSession, Hospital, ActivityLog
+from hospital.statistics import Statistics, read_trends
+from hnet.logger import CreateLogEntry, read_log_page, follow_log, LOG_STREAM_BACKLOG, LOG_STREAM_MAX_BACKLOG, \
+    LOG_STREAM_POLL_INTERVAL, LOG_STREAM_DURATION
+from hospital.distribution import LengthOfStayDistribution
+from hospital.episodes import CareFlow
+from hospital.export import statistics_rows, stream_csv, stream_ndjson
+from hospital.forms import TransferForm, LogFilterForm, TrendsForm, StatisticsRangeForm, StatisticsExportForm
 
 
 @login_required
@@ -17,7 +24,7 @@ def admit_patient(request, patient_id):
         if patient.get_current_treatment_session() is None:
             hospital = get_account_from_user(request.user).hospital
             TreatmentSession.objects.create(patient=patient, treating_hospital=hospital)
-            CreateLogEntry(request.user.username, "Patient admitted.")
+            CreateLogEntry(request.user.username, "Patient admitted.", patient)
 
     return redirect('medical:view_medical_information', patient_id=patient_id)
 
@@ -39,7 +46,7 @@ def discharge_patient(request, patient_id):
             session.discharge_timestamp = datetime.now()
             session.save()
 
-        CreateLogEntry(request.user.username, "Patient discharged.")
+        CreateLogEntry(request.user.username, "Patient discharged.", patient)
         return render(request, 'discharge/discharge_done.html', {'patient_id': patient_id})
     else:
         return render(request, 'discharge/discharge.html', {'session': session})
@@ -47,22 +54,68 @@ def discharge_patient(request, patient_id):
 
 @login_required
 @permission_required('hospital.can_view_system_information')
-def logView(request, page=0):
-    logs = readLog()
-    logs.reverse()
+def logView(request):
+    entries, form = get_log_entries(request)
+    log_page = read_log_page(entries, before=parse_id(request.GET.get('before')),
+                             after=parse_id(request.GET.get('after')))
 
-    page = int(page)
-    start = page * 20
-    end = (page + 1) * 20
+    # Keep the filters, but not the position, in the links to the newer and older pages.
+    query = request.GET.copy()
+    query.pop('before', None)
+    query.pop('after', None)
 
-    total = len(logs)
-    has_prev = page > 0
-    prev = page - 1 if has_prev else None
-    next = page + 1 if end < total else None
+    return render(request, 'hospital/viewlog.html', {"log_list": log_page.entries, 'newer': log_page.newer,
+                                                     'older': log_page.older, 'form': form,
+                                                     'query': query.urlencode()})
 
-    logs = logs[start:end]
-    return render(request, 'hospital/viewlog.html', {"log_list": logs, 'has_prev': has_prev, 'prev': prev,
-                                                     'next': next})
+
+@login_required
+@permission_required('hospital.can_view_system_information')
+def logStream(request):
+    """
+    Stream new log entries to the log page as server-sent events, with the same filters as the page.
+    Each stream is a short long poll (see `hnet.logger.follow_log`); on reconnecting, the browser sends the id of the
+    last event it received, and the stream resumes after it.
+    """
+    entries, form = get_log_entries(request)
+    after = parse_id(request.META.get('HTTP_LAST_EVENT_ID')) or parse_id(request.GET.get('after'))
+    backlog = parse_id(request.GET.get('backlog'))
+    if backlog is None:
+        backlog = getattr(settings, 'ACTIVITY_LOG_STREAM_BACKLOG', LOG_STREAM_BACKLOG)
+
+    response = StreamingHttpResponse(
+        follow_log(entries, after=after, backlog=min(backlog, LOG_STREAM_MAX_BACKLOG),
+                   poll_interval=getattr(settings, 'ACTIVITY_LOG_STREAM_POLL_INTERVAL', LOG_STREAM_POLL_INTERVAL),
+                   duration=getattr(settings, 'ACTIVITY_LOG_STREAM_DURATION', LOG_STREAM_DURATION)),
+        content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Keep proxies such as nginx from buffering the stream.
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def get_log_entries(request):
+    """
+    Get the log entries a user may see, filtered by the filter form in the query string.
+    :return: A tuple of the `ActivityLog` queryset and the bound `LogFilterForm`.
+    """
+    account = get_account_from_user(request.user)
+    entries = ActivityLog.objects.all()
+    if account is not None:
+        # Administrators only see the activity at their own hospital.
+        entries = entries.filter(hospital=account.hospital)
+
+    form = LogFilterForm(request.GET)
+    if form.is_valid():
+        entries = form.filter(entries)
+    return entries, form
+
+
+def parse_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
 
 
 @login_required
@@ -70,13 +123,112 @@ def logView(request, page=0):
 def statisticsView(request):
     account = get_account_from_user(request.user)
     if account is None:
-        stats_list = [Statistics(h) for h in Hospital.objects.all()]
+        stats_list = Statistics.for_hospitals()
     else:
         stats_list = [Statistics(account.hospital)]
 
     return render(request, 'hospital/viewstatistics.html', {"stats_list": stats_list})
 
 
+@login_required
+@permission_required('hospital.can_view_system_information')
+def trendsView(request):
+    account = get_account_from_user(request.user)
+    form = TrendsForm(request.GET, choose_hospital=account is None)
+
+    trends = []
+    hospital = get_statistics_hospital(form, account)
+    if hospital is not None:
+        trends = read_trends(hospital, form.cleaned_data['period'], form.cleaned_data['since'],
+                             form.cleaned_data['until'])
+
+    return render(request, 'hospital/viewtrends.html', {'form': form, 'hospital': hospital, 'trends': trends})
+
+
+@login_required
+@permission_required('hospital.can_view_system_information')
+def lengthOfStayView(request):
+    account = get_account_from_user(request.user)
+    form = StatisticsRangeForm(request.GET, choose_hospital=account is None)
+
+    context = {'form': form, 'distribution': None}
+    hospital = get_statistics_hospital(form, account)
+    if hospital is not None:
+        distribution = LengthOfStayDistribution.for_hospital(
+            hospital, datetime.combine(form.cleaned_data['since'], time()),
+            datetime.combine(form.cleaned_data['until'] + timedelta(days=1), time()))
+        context.update({'hospital': hospital, 'distribution': distribution, 'p90': distribution.percentile(90),
+                        'p99': distribution.percentile(99)})
+
+    return render(request, 'hospital/viewlengthofstay.html', context)
+
+
+@login_required
+@permission_required('hospital.can_view_system_information')
+def transfersView(request):
+    account = get_account_from_user(request.user)
+    if account is None:
+        care_flow = CareFlow.for_hospitals()
+        hospitals = list(Hospital.objects.all())
+    else:
+        # Administrators only see the transfers to and from their own hospital.
+        care_flow = CareFlow.for_hospitals([account.hospital.pk])
+        for from_hospital, to_hospital in list(care_flow.transfers):
+            if account.hospital.pk not in (from_hospital, to_hospital):
+                del care_flow.transfers[from_hospital, to_hospital]
+        hospital_ids = set(itertools.chain.from_iterable(care_flow.transfers))
+        hospital_ids.add(account.hospital.pk)
+        hospitals = list(Hospital.objects.filter(pk__in=hospital_ids))
+
+    return render(request, 'hospital/viewtransfers.html',
+                  {'hospitals': hospitals, 'matrix': care_flow.transfer_matrix(hospitals)})
+
+
+@login_required
+@permission_required('hospital.can_view_system_information')
+def exportStatisticsView(request):
+    account = get_account_from_user(request.user)
+    if 'format' not in request.GET:
+        form = StatisticsExportForm(choose_hospital=account is None, initial={'format': 'csv'})
+        return render(request, 'hospital/exportstatistics.html', {'form': form})
+    form = StatisticsExportForm(request.GET, choose_hospital=account is None)
+    if not form.is_valid():
+        return render(request, 'hospital/exportstatistics.html', {'form': form})
+
+    if account is not None:
+        hospitals = Hospital.objects.filter(pk=account.hospital.pk)
+    elif form.cleaned_data['hospital'] is not None:
+        hospitals = Hospital.objects.filter(pk=form.cleaned_data['hospital'].pk)
+    else:
+        hospitals = Hospital.objects.all()
+    if form.cleaned_data['history']:
+        rows = statistics_rows(hospitals, form.cleaned_data['since'], form.cleaned_data['until'])
+    else:
+        rows = statistics_rows(hospitals)
+
+    if form.cleaned_data['format'] == 'ndjson':
+        response = StreamingHttpResponse(stream_ndjson(rows), content_type='application/x-ndjson')
+        extension = 'ndjson'
+    else:
+        response = StreamingHttpResponse(stream_csv(rows), content_type='text/csv')
+        extension = 'csv'
+    response['Content-Disposition'] = 'attachment; filename=statistics.%s' % extension
+    return response
+
+
+def get_statistics_hospital(form, account):
+    """
+    Get the hospital to show statistics for: the user's own hospital, or the one chosen in a
+    `StatisticsRangeForm` by users without one.
+    :return: A `Hospital`, or None if the form is invalid or there are no hospitals.
+    """
+    if not form.is_valid():
+        return None
+    if account is None:
+        return form.cleaned_data['hospital'] or Hospital.objects.first()
+    return account.hospital
+
+
 @login_required
 @permission_required('hospital.transfer_patient_any_hospital')
 @user_passes_test(lambda u: not u.is_superuser)
@@ -93,7 +245,7 @@ def transfer_patient_as_admin(request, patient_id):
             session.discharge_timestamp = datetime.now()
             session.save()
             form.save_by_admin(patient, session)
-            CreateLogEntry(request.user.username, "Patient transferred.")
+            CreateLogEntry(request.user.username, "Patient transferred.", patient)
             return render(request, 'transfer/transfer_done_admin.html', {'patient_id': patient_id})
     else:
         form = TransferForm()
@@ -121,7 +273,7 @@ def transfer_patient_as_doctor(request, patient_id):
         new_session = TreatmentSession.objects.create(patient=patient, treating_hospital=hospital)
         new_session.previous_session = session
         new_session.save()
-        CreateLogEntry(request.user.username, "Patient transferred.")
+        CreateLogEntry(request.user.username, "Patient transferred.", patient)
         return render(request, 'transfer/transfer_done.html', {'patient_id': patient_id})
 
     return render(request, 'transfer/doctor_transfer.html')
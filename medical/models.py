@@ -121,7 +121,7 @@ class Prescription(models.Model):
     amount = models.IntegerField(default=1)
     cycle = models.IntegerField(null=True, blank=True, default=None)
     repeats = models.IntegerField(null=True, blank=True, default=None)
-    creation_timestamp = models.DateTimeField(auto_now_add=True)
+    creation_timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
 
     @staticmethod
     def pluralize_with_abbreviation(factor, unit):
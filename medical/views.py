@@ -74,8 +74,8 @@ def add_prescription(request, diagnosis_id):
     if request.method == 'POST':
         form = PrescriptionForm(request.POST)
         if form.is_valid():
-            form.save_to_diagnosis_by_doctor(diagnosis, request.user.doctor)
-            CreateLogEntry(request.user.username, "Added prescription.")
+            prescription = form.save_to_diagnosis_by_doctor(diagnosis, request.user.doctor)
+            CreateLogEntry(request.user.username, "Added prescription.", prescription)
             return render(request, 'medical/prescriptions/add_done.html', {'diagnosis_id': diagnosis_id})
     else:
         form = PrescriptionForm()
@@ -98,7 +98,7 @@ def edit_prescription(request, prescription_id):
         form = PrescriptionForm(request.POST, instance=prescription)
         if form.is_valid():
             form.save()
-            CreateLogEntry(request.user.username, "Edited prescription.")
+            CreateLogEntry(request.user.username, "Edited prescription.", prescription)
             return render(request, 'medical/prescriptions/edit.html', {'form': form, 'message': 'All changes saved.'})
     else:
         form = PrescriptionForm(instance=prescription)
@@ -185,7 +185,7 @@ def remove_drug(request, drug_id):
     if request.method == 'POST':
         drug.active = False
         drug.save()
-        CreateLogEntry(request.user.username, "Drug removed.")
+        CreateLogEntry(request.user.username, "Drug removed.", drug)
         return render(request, 'medical/drug/remove_done.html')
     else:
         return render(request, 'medical/drug/remove.html', {'drug': drug})
@@ -206,7 +206,7 @@ def update_drug(request, drug_id):
         form = DrugForm(request.POST, instance=drug)
         if form.is_valid():
             form.save()
-            CreateLogEntry(request.user.username, "Removed drug.")
+            CreateLogEntry(request.user.username, "Updated drug.", drug)
             return render(request, 'medical/drug/update.html', {'form': form, 'message': 'All changes saved.'})
     else:
         form = DrugForm(instance=drug)
@@ -326,7 +326,7 @@ def upload_test_result(request, test_id):
         results_form = TestResultsForm(request.POST, request.FILES, instance=test)
         if results_form.is_valid():
             results_form.save()
-            CreateLogEntry(request.user.username, "Test results uploaded.")
+            CreateLogEntry(request.user.username, "Test results uploaded.", test)
             return render(request, 'medical/test/uploaded.html', {'test': test})
     else:
         results_form = TestResultsForm(instance=test)
@@ -342,7 +342,7 @@ def release_test_result(request, test_id):
     if request.method == 'POST':
         test.released = True
         test.save()
-        CreateLogEntry(request.user.username, "Test result released.")
+        CreateLogEntry(request.user.username, "Test result released.", test)
         return render(request, 'medical/test/release_done.html', {'diagnosis_id': test.diagnosis.id})
 
     return render(request, 'medical/test/release.html', {'test': test})
@@ -456,7 +456,7 @@ def archive_diagnosis(request, diagnosis_id):
     if request.method == 'POST':
         diagnosis.archived = True
         diagnosis.save()
-        CreateLogEntry(request.user.username, "Diagnosis archived.")
+        CreateLogEntry(request.user.username, "Diagnosis archived.", diagnosis)
         return render(request, 'medical/diagnosis/archive_done.html', {'diagnosis': diagnosis})
 
     return render(request, 'medical/diagnosis/archive.html', {'diagnosis': diagnosis})
@@ -2,3 +2,5 @@ from django.contrib import admin
 from . import models
 
 admin.site.register(models.Appointment)
+admin.site.register(models.AppointmentSeries)
+admin.site.register(models.ReminderJob)
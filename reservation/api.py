@@ -0,0 +1,122 @@
+"""
+The appointments of a schedule as JSON, for calendar clients that fetch date ranges incrementally.
+
+Only the requested fields are read, with `values()`, so no appointment objects are built. The appointments are
+ordered by (date, start time, id), which is unique, and pages are split on that key: the cursor of the next page is
+the key of the last appointment of the page, and the page after it starts with the appointments after that key.
+Unlike offsets, this stays correct when appointments are added or cancelled between pages, and costs the same for
+the last page as for the first.
+"""
+from datetime import date, time
+from django.db.models import Q
+from django.utils.dateparse import parse_date, parse_time
+from account.models import Patient, Doctor, Nurse
+from reservation.models import Appointment
+
+
+"""The fields that can be requested, and the columns they are read from."""
+FIELDS = {
+    'id': 'id',
+    'title': 'title',
+    'date': 'date',
+    'start_time': 'start_time',
+    'end_time': 'end_time',
+    'doctor': 'doctor_id',
+    'doctor_first_name': 'doctor__user__first_name',
+    'doctor_last_name': 'doctor__user__last_name',
+    'patient': 'patient_id',
+    'patient_first_name': 'patient__user__first_name',
+    'patient_last_name': 'patient__user__last_name',
+    'series': 'series_id',
+}
+DEFAULT_FIELDS = ('id', 'title', 'date', 'start_time', 'end_time', 'doctor', 'patient')
+
+"""The number of appointments in a page by default, and the most a page can have."""
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+"""The columns the appointments are ordered and paginated by."""
+KEY_COLUMNS = ('date', 'start_time', 'id')
+
+
+def get_schedule_appointments(account, start, end, doctors=None):
+    """
+    Get the appointments in the schedule an account can see over a date range: their own, or for nurses, those of
+    the doctors of their hospital.
+    :param start: The first date of the range.
+    :param end: The date the range ends before.
+    :param doctors: If given, only get the appointments with these doctors.
+    :return: A queryset of the non-cancelled appointments, or None if the account doesn't have a schedule.
+    """
+
+    if isinstance(account, (Patient, Doctor)):
+        appointments = account.appointment_set.all()
+    elif isinstance(account, Nurse):
+        appointments = Appointment.objects.filter(doctor__hospital=account.hospital)
+    else:
+        return None
+
+    appointments = appointments.filter(cancelled=False, date__gte=start, date__lt=end)
+    if doctors is not None:
+        appointments = appointments.filter(doctor__in=doctors)
+    return appointments
+
+
+def format_cursor(key):
+    """
+    :param key: A (date, start time, id) tuple.
+    :return: The cursor of the page after the appointment with the key.
+    """
+
+    return '%s_%s_%d' % (key[0].isoformat(), key[1].isoformat(), key[2])
+
+
+def parse_cursor(cursor):
+    """
+    :return: The (date, start time, id) tuple of a cursor, or None if it isn't valid.
+    """
+
+    parts = cursor.split('_')
+    if len(parts) != 3 or not parts[2].isdigit():
+        return None
+    try:
+        key = (parse_date(parts[0]), parse_time(parts[1]), int(parts[2]))
+    except ValueError:
+        return None
+    return key if None not in key else None
+
+
+def get_page(appointments, fields=DEFAULT_FIELDS, after=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Read a page of appointments, in a single query.
+    :param appointments: A queryset of the appointments.
+    :param fields: The names of the fields to read, from `FIELDS`.
+    :param after: The (date, start time, id) key the page starts after, if not the first page.
+    :param limit: The most appointments in the page.
+    :return: A tuple of the list of dictionaries of the appointments' fields, and of the key of the last appointment
+             if there are more after it, or None if this is the last page.
+    """
+
+    if after is not None:
+        day, start_time, appointment_id = after
+        appointments = appointments.filter(Q(date__gt=day) | Q(date=day, start_time__gt=start_time) |
+                                           Q(date=day, start_time=start_time, id__gt=appointment_id))
+    columns = [FIELDS[field] for field in fields]
+    # One more appointment than the page holds is read to tell whether there is a next page.
+    rows = list(appointments.order_by(*KEY_COLUMNS).values(*set(columns).union(KEY_COLUMNS))[:limit + 1])
+
+    next_key = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_key = tuple(rows[-1][column] for column in KEY_COLUMNS)
+    return [dict((field, row[column]) for field, column in zip(fields, columns)) for row in rows], next_key
+
+
+def serialize_value(value):
+    """Format the dates and times of appointments as in the other JSON views."""
+
+    if isinstance(value, time):
+        return value.strftime('%H:%M')
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
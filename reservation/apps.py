@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class ReservationConfig(AppConfig):
     name = 'reservation'
+
+    def ready(self):
+        # Connect the signal handlers that bump the schedule versions the schedule pages are cached under.
+        from reservation import signals
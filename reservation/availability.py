@@ -0,0 +1,122 @@
+"""
+The free appointment slots of a doctor.
+
+The booked intervals of the doctor (and of the patient asking, if any) over the whole date range are read in a
+single query, ordered by date and start time, and merged where they overlap. The slots of each day are then checked
+against them in a single sweep: since both are sorted, each booked interval is passed over once, instead of
+querying each slot.
+"""
+from datetime import datetime, time, timedelta
+from django.db.models import Q
+from reservation.models import Appointment, APPOINTMENT_LENGTH
+
+
+"""The day's first and last times at which appointments can start or end."""
+OPENING_TIME = time(8)
+CLOSING_TIME = time(18)
+
+"""The number of days slots are found for by default, and the most they can be found for at once."""
+DEFAULT_DAYS = 14
+MAX_DAYS = 31
+
+
+def get_booked_intervals(doctor, since, until, patient=None):
+    """
+    Get the times booked by a doctor, or by a patient, over a date range, in a single query.
+    Overlapping or adjacent appointments are merged into one interval.
+    :param since: The first date of the range.
+    :param until: The last date of the range.
+    :param patient: If given, the patient's appointments are booked times too.
+    :return: A list of disjoint (start `datetime`, end `datetime`) tuples, in chronological order.
+    """
+
+    participants_q = Q(doctor=doctor)
+    if patient is not None:
+        participants_q |= Q(patient=patient)
+    appointments = Appointment.objects.filter(participants_q).filter(
+        cancelled=False, date__gte=since, date__lte=until).order_by('date', 'start_time')
+
+    intervals = []
+    for day, start_time, end_time in appointments.values_list('date', 'start_time', 'end_time'):
+        start = datetime.combine(day, start_time)
+        end = datetime.combine(day, end_time)
+        if intervals and start <= intervals[-1][1]:
+            intervals[-1] = (intervals[-1][0], max(intervals[-1][1], end))
+        else:
+            intervals.append((start, end))
+    return intervals
+
+
+def get_day_slots(day):
+    """
+    :return: The list of (start `datetime`, end `datetime`) tuples of the slots of a day, from opening to
+             closing time.
+    """
+
+    slots = []
+    start = datetime.combine(day, OPENING_TIME)
+    closing = datetime.combine(day, CLOSING_TIME)
+    while start + APPOINTMENT_LENGTH <= closing:
+        slots.append((start, start + APPOINTMENT_LENGTH))
+        start += APPOINTMENT_LENGTH
+    return slots
+
+
+def find_overlaps(intervals, booked):
+    """
+    Check intervals against booked intervals in a single sweep.
+    :param intervals: (start `datetime`, end `datetime`) tuples, ordered by start and end.
+    :param booked: Disjoint booked intervals in chronological order, as returned by `get_booked_intervals`.
+    :return: A list of whether each interval overlaps a booked interval.
+    """
+
+    overlaps = []
+    index = 0
+    for start, end in intervals:
+        # Pass the booked intervals that end before this interval starts. Intervals are half-open, so one ending
+        # at the start of the interval doesn't overlap it.
+        while index < len(booked) and booked[index][1] <= start:
+            index += 1
+        # The booked intervals are disjoint, so only the next one can overlap the interval.
+        overlaps.append(index < len(booked) and booked[index][0] < end)
+    return overlaps
+
+
+def find_free_slots(doctor, since, until, patient=None, now=None):
+    """
+    Find the slots in which a doctor can take an appointment over a date range.
+    :param since: The first date of the range.
+    :param until: The last date of the range.
+    :param patient: If given, the slots must also be free for this patient.
+    :param now: The current `datetime`; slots that have already started are left out.
+    :return: A list of (date, start time, end time) tuples, in chronological order.
+    """
+
+    if now is None:
+        now = datetime.now()
+
+    slots = []
+    day = since
+    while day <= until:
+        slots.extend(slot for slot in get_day_slots(day) if slot[0] >= now)
+        day += timedelta(days=1)
+
+    overlaps = find_overlaps(slots, get_booked_intervals(doctor, since, until, patient))
+    return [(start.date(), start.time(), end.time()) for (start, end), overlap in zip(slots, overlaps) if not overlap]
+
+
+def find_conflicts(appointments):
+    """
+    Check new appointments against the existing bookings of their participants, with a single query over the dates
+    they span, instead of a query per appointment.
+    :param appointments: Unsaved appointments with the same doctor and patient, in chronological order.
+    :return: The list of the appointments that conflict with an existing one.
+    """
+
+    if not appointments:
+        return []
+    booked = get_booked_intervals(appointments[0].doctor, appointments[0].date, appointments[-1].date,
+                                  appointments[0].patient)
+    intervals = [(datetime.combine(appointment.date, appointment.start_time),
+                  datetime.combine(appointment.date, appointment.end_time)) for appointment in appointments]
+    return [appointment for appointment, overlap in zip(appointments, find_overlaps(intervals, booked)) if overlap]
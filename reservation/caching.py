@@ -0,0 +1,100 @@
+"""
+Conditional responses and cached fragments of the schedule pages: the month calendar, the week view and the day
+overview.
+
+Each user's schedule has a version stamp (`ScheduleVersion`), bumped whenever one of their appointments changes.
+A page's ETag and the cache keys of its rendered fragments include the stamp of the schedules it shows, so browsers
+moving back and forth between months get 304 responses, and pages that do have to be rendered reuse the fragments
+rendered for the same version. A change makes both stale by changing the stamp, so nothing has to be invalidated.
+"""
+import hashlib
+from django.core.cache import cache
+from django.db.models import Count, Max, Sum
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django.utils.safestring import mark_safe
+from account.models import Doctor
+from reservation.models import ScheduleVersion
+
+
+"""How long rendered fragments are kept, in seconds. Stale ones are never used, as their keys change."""
+FRAGMENT_TIMEOUT = 24 * 60 * 60
+
+
+def get_user_schedule_version(user):
+    """
+    :return: A tuple of the stamp of the user's schedule, and when it last changed (or None if it never did).
+    """
+
+    version = ScheduleVersion.objects.filter(user=user).values_list('version', 'modified').first() or (0, None)
+    return ScheduleVersion.get_stamp(*version), version[1]
+
+
+def get_hospital_schedule_version(hospital):
+    """
+    Get the version of the schedules of all the doctors of a hospital, as shown to nurses, in a single query.
+    Every appointment has a doctor, so it changes whenever an appointment at the hospital changes; it also changes
+    when doctors join the hospital.
+    :return: A tuple of the stamp of the schedules, and when they last changed (or None if they never did).
+    """
+
+    summary = Doctor.objects.filter(hospital=hospital).aggregate(
+        doctors=Count('id'), version=Sum('user__schedule_version__version'),
+        modified=Max('user__schedule_version__modified'))
+    return '%d-%s' % (summary['doctors'], ScheduleVersion.get_stamp(summary['version'], summary['modified'])), \
+        summary['modified']
+
+
+def get_schedule_page_validators(request, version, *page):
+    """
+    Get the ETag and the Last-Modified time of a schedule page.
+    Besides the schedules shown, the page depends on the user viewing it; logging in again, which changes the
+    CSRF token in its forms, changes both.
+    :param version: The (stamp, time of the last change) tuple of the schedules shown.
+    :param page: The name of the page and its arguments.
+    :return: A tuple of the ETag, and of the Last-Modified time as a timestamp, or None if it is unknown.
+    """
+
+    stamp, modified = version
+    user = request.user
+    etag = hashlib.md5(':'.join(str(part) for part in (user.pk, user.last_login, stamp) + page).encode()).hexdigest()
+    times = [time for time in (modified, user.last_login) if time is not None]
+    return etag, int(max(times).timestamp()) if times else None
+
+
+def conditional_schedule_page(request, version, page, render_page):
+    """
+    Answer a request for a schedule page with a 304 if the user's copy is up to date; otherwise, render it.
+    :param version: The (stamp, time of the last change) tuple of the schedules shown.
+    :param page: A tuple of the name of the page and its arguments.
+    :param render_page: A function rendering the page's response.
+    :return: The response, with its ETag and Last-Modified headers.
+    """
+
+    etag, last_modified = get_schedule_page_validators(request, version, *page)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = render_page()
+    response['ETag'] = quote_etag(etag)
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    # Browsers check with the server every time, as the schedule may change at any time.
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def get_cached_fragment(version, fragment, render_fragment):
+    """
+    Get a rendered fragment of a schedule page from the cache, rendering and caching it if it isn't there.
+    :param version: The (stamp, time of the last change) tuple of the schedules shown in the fragment.
+    :param fragment: A tuple of the name of the fragment and of everything else its content depends on.
+    :param render_fragment: A function rendering the fragment.
+    :return: The rendered fragment.
+    """
+
+    key = 'reservation:%s:%s' % (':'.join(str(part) for part in fragment), version[0])
+    content = cache.get(key)
+    if content is None:
+        content = render_fragment()
+        cache.set(key, content, FRAGMENT_TIMEOUT)
+    return mark_safe(content)
@@ -1,8 +1,12 @@
 import datetime
 
 from django import forms
-from django.db.models import Q
-from reservation.models import Appointment
+from django.db import transaction
+from account.models import Doctor
+from reservation.api import DEFAULT_FIELDS, DEFAULT_PAGE_SIZE, FIELDS, MAX_PAGE_SIZE, parse_cursor
+from reservation.availability import DEFAULT_DAYS, MAX_DAYS, find_conflicts
+from reservation.models import Appointment, AppointmentSeries, ScheduleDay, APPOINTMENT_LENGTH, MAX_SERIES_OCCURRENCES, \
+    MAX_SERIES_INTERVAL_DAYS
 from datetime import date, timedelta
 
 
@@ -23,36 +27,54 @@ class BaseAppointmentForm(forms.ModelForm):
     def clean(self):
         cleaned_data = super(BaseAppointmentForm, self).clean()
 
-        # Validate that the provided appointment time does not conflict with another already existing appointment.
+        # Validate that the provided appointment time does not conflict with another already existing appointment
+        # of either participant.
 
         # Make sure the data required for this validation process are valid,
         # otherwise don't even bother running this validation
-        if 'date' not in cleaned_data or 'start_time' not in cleaned_data or 'end_time' not in cleaned_data:
+        if 'date' not in cleaned_data or 'start_time' not in cleaned_data:
+            return cleaned_data
+        end_time = self.get_end_time(cleaned_data)
+        if end_time is None:
             return cleaned_data
 
         # Get the valid date/time data
         date = cleaned_data['date']
         start_time = cleaned_data['start_time']
-        end_time = cleaned_data['end_time']
-
-        # Construct a query to find the appointments that have time conflicts with this one
-        cancelled_q = Q(cancelled=False)
-        date_q = Q(date=date)
-        start_time_q = Q(start_time__lte=start_time) & Q(end_time__gte=start_time)
-        end_time_q = Q(start_time__lte=end_time) & Q(start_time__gte=end_time)
-        overall_time = Q(start_time__gte=start_time) & Q(start_time__lte=end_time)
-        time_q = start_time_q | end_time_q | overall_time
-        q = cancelled_q & date_q & time_q
+        if end_time <= start_time:
+            raise forms.ValidationError('The appointment must end after it starts.')
+
+        # Find the appointments of this appointment's doctor and patient that have time conflicts with this one
+        conflicts = Appointment.get_conflicting(date, start_time, end_time,
+                                                doctor_id=self.get_participant_id(cleaned_data, 'doctor'),
+                                                patient_id=self.get_participant_id(cleaned_data, 'patient'))
         # Exclude this record from the results, since an appointment cannot conflict with itself.
         if self.instance.id is not None:
-            q = ~Q(pk=self.instance.id) & q
+            conflicts = conflicts.exclude(pk=self.instance.id)
 
-        # Count the number of results returned from the query and determine if a conflict exists.
-        if Appointment.objects.filter(q).count() > 0:
+        if conflicts.exists():
             raise forms.ValidationError('The time slot is not available, please try a different one.')
 
         return cleaned_data
 
+    def get_end_time(self, cleaned_data):
+        """
+        Get the time the appointment ends at.
+        :return: A datetime.time object; Or, None if it isn't valid.
+        """
+        return cleaned_data.get('end_time')
+
+    def get_participant_id(self, cleaned_data, participant):
+        """
+        Get the id of one of the participants of the appointment: the one chosen in the form,
+        or else the one already set on the instance, e.g. by the view creating the form.
+        :param participant: Either 'doctor' or 'patient'.
+        :return: The id of the participant; Or, None if it isn't known.
+        """
+        if participant in self.fields:
+            return cleaned_data[participant].pk if cleaned_data.get(participant) is not None else None
+        return getattr(self.instance, participant + '_id')
+
     date = forms.DateField(widget=forms.SelectDateWidget)
 
     class Meta:
@@ -67,6 +89,20 @@ class AppointmentFormForPatient(BaseAppointmentForm):
     The value for the 'patient' field should be supplied when saving.
     """
 
+    def __init__(self, *args, **kwargs):
+        """
+        :param user: The patient user creating the appointment, so that the time is checked against their other
+                     appointments.
+        """
+        user = kwargs.pop('user', None)
+        super(AppointmentFormForPatient, self).__init__(*args, **kwargs)
+        if user is not None:
+            self.instance.patient = user.patient
+
+    def get_end_time(self, cleaned_data):
+        # Appointments made by patients always take the same time.
+        return (datetime.datetime.combine(date.today(), cleaned_data['start_time']) + APPOINTMENT_LENGTH).time()
+
     def save(self, creator=None, commit=True):
         """
         Save the object with the given creator as the 'patient' participant.
@@ -78,12 +114,12 @@ class AppointmentFormForPatient(BaseAppointmentForm):
         if creator is not None:
             appointment.patient = creator.patient
             appointment.end_time = (datetime.datetime.combine(date.today(), appointment.start_time) +
-                                    timedelta(minutes=30)).time()
+                                    APPOINTMENT_LENGTH).time()
 
             if commit:
-                appointment.save()
+                appointment.book()
         else:
-            appointment.save()
+            appointment.book()
 
         return appointment
 
@@ -100,23 +136,170 @@ class AppointmentFormForDoctor(BaseAppointmentForm):
     The value for the 'doctor' field should be supplied when saving.
     """
 
+    def __init__(self, *args, **kwargs):
+        """
+        :param user: The doctor user creating the appointment, so that the time is checked against their other
+                     appointments.
+        """
+        user = kwargs.pop('user', None)
+        super(AppointmentFormForDoctor, self).__init__(*args, **kwargs)
+        if user is not None:
+            self.instance.doctor = user.doctor
+
     def save(self, creator=None, commit=True):
         """
         Save the object with the given creator as the 'doctor' participant.
         :param creator: The doctor participant.
         """
 
+        appointment = super(AppointmentFormForDoctor, self).save(commit=False)
         if creator is not None:
-            appointment = super(AppointmentFormForDoctor, self).save(commit=False)
             appointment.doctor = creator.doctor
 
-            if commit:
-                appointment.save()
-        else:
-            appointment = super(AppointmentFormForDoctor, self).save(commit)
+        if commit:
+            appointment.book()
 
         return appointment
 
     class Meta:
         model = Appointment
         fields = BaseAppointmentForm.Meta.fields + ['patient']
+
+
+class AppointmentSeriesForm(forms.ModelForm):
+    """
+    A form for doctors to create a recurring series of appointments with a patient.
+    The value for the 'doctor' field should be supplied when creating the form.
+    """
+
+    first_date = forms.DateField(widget=forms.SelectDateWidget)
+    interval_days = forms.IntegerField(min_value=1, max_value=MAX_SERIES_INTERVAL_DAYS, initial=7,
+                                       label='Days between appointments', help_text='7 for weekly appointments.')
+    occurrences = forms.IntegerField(min_value=2, max_value=MAX_SERIES_OCCURRENCES, label='Number of appointments')
+
+    def __init__(self, *args, **kwargs):
+        """
+        :param user: The doctor user creating the series.
+        """
+        user = kwargs.pop('user', None)
+        super(AppointmentSeriesForm, self).__init__(*args, **kwargs)
+        if user is not None:
+            self.instance.doctor = user.doctor
+
+    def clean_first_date(self):
+        first_date = self.cleaned_data['first_date']
+        if first_date < datetime.datetime.now().date():
+            raise forms.ValidationError('Cannot schedule appointment with a past date.')
+
+        return first_date
+
+    def clean(self):
+        cleaned_data = super(AppointmentSeriesForm, self).clean()
+        for field in ('patient', 'first_date', 'start_time', 'end_time', 'interval_days', 'occurrences'):
+            if field not in cleaned_data:
+                return cleaned_data
+        if cleaned_data['end_time'] <= cleaned_data['start_time']:
+            raise forms.ValidationError('The appointment must end after it starts.')
+
+        # Check every appointment of the series against the participants' bookings at once.
+        series = AppointmentSeries(doctor=self.instance.doctor, **dict(
+            (field, cleaned_data[field]) for field in ('title', 'patient', 'first_date', 'start_time', 'end_time',
+                                                       'interval_days', 'occurrences') if field in cleaned_data))
+        conflicts = find_conflicts(series.build_appointments())
+        if conflicts:
+            raise forms.ValidationError(get_series_conflicts_message(conflicts))
+
+        return cleaned_data
+
+    def save(self, commit=True):
+        """
+        Save the series and create all its appointments, in a single transaction.
+        The participants' days are locked, and the series checked again, so that concurrent bookings can't take
+        the same time.
+        :raise ValidationError: If a time slot of the series is not available anymore.
+        """
+        series = super(AppointmentSeriesForm, self).save(commit=False)
+        if commit:
+            with transaction.atomic():
+                ScheduleDay.lock([series.doctor.user_id, series.patient.user_id], series.get_dates())
+                conflicts = find_conflicts(series.build_appointments())
+                if conflicts:
+                    raise forms.ValidationError(get_series_conflicts_message(conflicts))
+                series.save()
+                Appointment.objects.bulk_create(series.build_appointments())
+
+        return series
+
+    class Meta:
+        model = AppointmentSeries
+        fields = ['title', 'patient', 'first_date', 'start_time', 'end_time', 'interval_days', 'occurrences']
+
+
+def get_series_conflicts_message(conflicts):
+    return 'The time slot is not available on %s, please try a different one.' % ', '.join(
+        appointment.date.isoformat() for appointment in conflicts)
+
+
+class AvailabilityForm(forms.Form):
+    """
+    A form for the doctor and the date range to find free appointment slots for.
+    The range starts today and lasts `DEFAULT_DAYS` days unless given.
+    """
+    doctor = forms.ModelChoiceField(queryset=Doctor.objects.all())
+    since = forms.DateField(required=False)
+    until = forms.DateField(required=False)
+
+    def clean(self):
+        cleaned_data = super(AvailabilityForm, self).clean()
+        if not cleaned_data.get('since'):
+            cleaned_data['since'] = date.today()
+        if not cleaned_data.get('until'):
+            cleaned_data['until'] = cleaned_data['since'] + timedelta(days=DEFAULT_DAYS - 1)
+
+        if cleaned_data['since'] > cleaned_data['until']:
+            raise forms.ValidationError('The start of the date range must not be after its end.')
+        if (cleaned_data['until'] - cleaned_data['since']).days >= MAX_DAYS:
+            raise forms.ValidationError('Free slots can be found for at most %d days at once.' % MAX_DAYS)
+        return cleaned_data
+
+
+class ScheduleQueryForm(forms.Form):
+    """
+    A form for the date range, the fields and the page of the appointments to read from a schedule.
+    The range includes its start date but not its end date. The fields are given as a comma-separated list.
+    """
+    start = forms.DateField()
+    end = forms.DateField()
+    fields = forms.CharField(required=False)
+    doctors = forms.ModelMultipleChoiceField(queryset=Doctor.objects.all(), required=False)
+    after = forms.CharField(required=False)
+    limit = forms.IntegerField(required=False, min_value=1, max_value=MAX_PAGE_SIZE)
+
+    def clean_fields(self):
+        if not self.cleaned_data['fields']:
+            return DEFAULT_FIELDS
+        fields = tuple(field.strip() for field in self.cleaned_data['fields'].split(','))
+        unknown = [field for field in fields if field not in FIELDS]
+        if unknown:
+            raise forms.ValidationError('Unknown fields: %s.' % ', '.join(unknown))
+        return fields
+
+    def clean_doctors(self):
+        # No doctors means the appointments with every doctor.
+        return self.cleaned_data['doctors'] or None
+
+    def clean_after(self):
+        if not self.cleaned_data['after']:
+            return None
+        after = parse_cursor(self.cleaned_data['after'])
+        if after is None:
+            raise forms.ValidationError('Invalid cursor.')
+        return after
+
+    def clean(self):
+        cleaned_data = super(ScheduleQueryForm, self).clean()
+        if not cleaned_data.get('limit'):
+            cleaned_data['limit'] = DEFAULT_PAGE_SIZE
+        if cleaned_data.get('start') and cleaned_data.get('end') and cleaned_data['start'] >= cleaned_data['end']:
+            raise forms.ValidationError('The start of the date range must be before its end.')
+        return cleaned_data
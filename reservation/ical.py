@@ -0,0 +1,125 @@
+"""
+iCalendar (RFC 5545) feeds of a user's appointments, for subscribing from external calendar clients.
+
+A feed only covers a window of dates around today, so generating it costs the same however long the user's history
+is. The events are serialized one at a time as the response is streamed. Calendar clients poll their feeds, so each
+feed has an ETag computed with a single aggregate query over the window; when nothing in the window has changed,
+clients get a 304 without the feed being generated.
+"""
+import hashlib
+from datetime import date, datetime, timedelta
+from django.conf import settings
+from django.db.models import Count, Max
+from account.models import Patient, Doctor, get_account_from_user
+
+
+"""The number of days before and after today covered by the feeds."""
+FEED_PAST_DAYS = 30
+FEED_FUTURE_DAYS = 365
+
+"""The longest a content line can be, in octets, before it's folded."""
+MAX_LINE_LENGTH = 75
+
+
+def get_feed_appointments(user, today=None):
+    """
+    Get the appointments in a user's feed: those within the feed's window of dates, including cancelled ones,
+    which calendar clients are told to remove.
+    :return: A queryset of the appointments, or None if the user is a type of account that doesn't have any.
+    """
+
+    account = get_account_from_user(user)
+    if not isinstance(account, (Patient, Doctor)):
+        return None
+    if today is None:
+        today = date.today()
+    return account.appointment_set.filter(date__gte=today - timedelta(days=FEED_PAST_DAYS),
+                                          date__lte=today + timedelta(days=FEED_FUTURE_DAYS))
+
+
+def get_feed_etag(user, appointments, today=None):
+    """
+    Get the ETag of a user's feed.
+    It changes whenever an appointment in the window is created, changed, cancelled or deleted, or the window moves.
+    """
+
+    if today is None:
+        today = date.today()
+    summary = appointments.aggregate(count=Count('id'), modified=Max('modified'))
+    return hashlib.md5(('%d:%s:%d:%s' % (user.pk, today.isoformat(), summary['count'], summary['modified']))
+                       .encode()).hexdigest()
+
+
+def escape_text(text):
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\r\n', '\\n') \
+        .replace('\n', '\\n')
+
+
+def fold_line(line):
+    """
+    Fold a content line into lines of at most `MAX_LINE_LENGTH` octets, without splitting a UTF-8 character.
+    :return: The folded line, ending with CRLF.
+    """
+
+    folded = []
+    length = 0
+    for character in line:
+        size = len(character.encode())
+        if length + size > MAX_LINE_LENGTH:
+            # Continuation lines start with a space, which counts towards their length.
+            folded.append('\r\n ')
+            length = 1
+        folded.append(character)
+        length += size
+    folded.append('\r\n')
+    return ''.join(folded)
+
+
+def format_timestamp(timestamp):
+    """Format a naive local `datetime` as a UTC date-time."""
+
+    return datetime.utcfromtimestamp(timestamp.timestamp()).strftime('%Y%m%dT%H%M%SZ')
+
+
+def format_event(appointment, host):
+    """
+    :return: The lines of the VEVENT of an appointment.
+    """
+
+    # Times are local to the hospitals; they are sent as floating times, in the calendar's time zone.
+    return [
+        'BEGIN:VEVENT',
+        'UID:appointment-%d@%s' % (appointment.id, host),
+        'DTSTAMP:' + format_timestamp(appointment.modified),
+        'LAST-MODIFIED:' + format_timestamp(appointment.modified),
+        'DTSTART:' + datetime.combine(appointment.date, appointment.start_time).strftime('%Y%m%dT%H%M%S'),
+        'DTEND:' + datetime.combine(appointment.date, appointment.end_time).strftime('%Y%m%dT%H%M%S'),
+        'SUMMARY:' + escape_text(appointment.title),
+        'DESCRIPTION:' + escape_text('Doctor: %s\nPatient: %s' % (appointment.doctor.full_name(),
+                                                                 appointment.patient.full_name())),
+        'STATUS:' + ('CANCELLED' if appointment.cancelled else 'CONFIRMED'),
+        'END:VEVENT',
+    ]
+
+
+def stream_calendar(appointments, host):
+    """
+    Serialize appointments as an iCalendar feed, one event at a time.
+    :param appointments: A queryset of the appointments.
+    :param host: The host name the event identifiers are made unique with.
+    :return: A generator of chunks of the feed.
+    """
+
+    yield ''.join(fold_line(line) for line in [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//HealthNet//Appointments//EN',
+        'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH',
+        'X-WR-CALNAME:HealthNet appointments',
+        'X-WR-TIMEZONE:' + settings.TIME_ZONE,
+    ])
+    for appointment in appointments.select_related('doctor__user', 'patient__user').order_by(
+            'date', 'start_time').iterator():
+        yield ''.join(fold_line(line) for line in format_event(appointment, host))
+    yield fold_line('END:VCALENDAR')
@@ -0,0 +1,124 @@
+import random
+import time
+from datetime import date, time as clock, timedelta
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction, OperationalError
+from django.db.models import Q
+from account.models import Doctor, Patient
+from hospital.models import Hospital
+from reservation.models import Appointment
+
+
+class Command(BaseCommand):
+    help = 'Time the appointment conflict check on a synthetic schedule, scoped to the participants and, for ' \
+           'comparison, across every appointment on the date. The schedule is rolled back afterwards. ' \
+           'Fails if the scoped check is the slower one.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--appointments',
+            dest='appointments',
+            type=int,
+            default=100000,
+            help='The number of appointments in the schedule.'
+        )
+
+        parser.add_argument(
+            '--doctors',
+            dest='doctors',
+            type=int,
+            default=200,
+            help='The number of doctors the appointments are spread over.'
+        )
+
+        parser.add_argument(
+            '--days',
+            dest='days',
+            type=int,
+            default=365,
+            help='The number of days the appointments are spread over.'
+        )
+
+        parser.add_argument(
+            '--checks',
+            dest='checks',
+            type=int,
+            default=1000,
+            help='The number of conflict checks to time.'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                doctor_ids, patient_ids = self.generate(options.get('appointments'), options.get('doctors'),
+                                                        options.get('days'))
+                checks = self.random_appointments(options.get('checks'), doctor_ids, patient_ids,
+                                                  options.get('days'))
+
+                self.stdout.write('%d conflict checks against %d appointments:' % (len(checks),
+                                                                                   options.get('appointments')))
+                scoped = self.time_checks(checks, lambda check: Appointment.get_conflicting(*check).exists())
+                unscoped = self.time_checks(
+                    checks, lambda check: Appointment.objects.filter(cancelled=False, date=check[0])
+                    .filter(Q(start_time__lt=check[2]) & Q(end_time__gt=check[1])).count())
+                self.stdout.write('    Scoped to the participants: %.3fs' % scoped)
+                self.stdout.write('    Every appointment that day: %.3fs' % unscoped)
+
+                transaction.set_rollback(True)
+        except OperationalError:
+            raise CommandError('Operation cannot be completed. Did you forget to do database migration?')
+
+        if scoped > unscoped:
+            raise CommandError('The check scoped to the participants is slower than the check of every appointment '
+                               'that day; it isn\'t using the participants\' indexes.')
+
+    def generate(self, count, doctors, days):
+        """
+        Create a schedule of 30-minute appointments between 8:00 and 18:00, with ten patients per doctor.
+        :return: A tuple of the list of doctor ids and the list of patient ids.
+        """
+
+        random.seed(count)
+        hospital = Hospital.objects.create(name='Benchmark hospital', location='Benchmark location')
+        doctor_ids = self.create_accounts(Doctor, 'benchmark-doctor-', doctors, hospital=hospital)
+        patient_ids = self.create_accounts(Patient, 'benchmark-patient-', doctors * 10, preferred_hospital=hospital,
+                                           proof_of_insurance='')
+
+        appointments = []
+        for day, start_time, end_time, doctor_id, patient_id in self.random_appointments(count, doctor_ids,
+                                                                                         patient_ids, days):
+            appointments.append(Appointment(title='Benchmark', doctor_id=doctor_id, patient_id=patient_id,
+                                            date=day, start_time=start_time, end_time=end_time))
+        Appointment.objects.bulk_create(appointments)
+        return doctor_ids, patient_ids
+
+    @staticmethod
+    def create_accounts(account_class, prefix, count, **fields):
+        User.objects.bulk_create([User(username=prefix + str(i)) for i in range(count)])
+        user_ids = User.objects.filter(username__startswith=prefix).values_list('pk', flat=True)
+        account_class.objects.bulk_create([account_class(user_id=user_id, **fields) for user_id in user_ids])
+        return list(account_class.objects.filter(user__username__startswith=prefix).values_list('pk', flat=True))
+
+    @staticmethod
+    def random_appointments(count, doctor_ids, patient_ids, days):
+        """
+        :return: A list of (date, start time, end time, doctor id, patient id) tuples, as passed to
+                 `Appointment.get_conflicting`.
+        """
+
+        first_day = date.today() + timedelta(days=1)
+        appointments = []
+        for _ in range(count):
+            slot = random.randrange(20)
+            appointments.append((first_day + timedelta(days=random.randrange(days)),
+                                 clock(8 + slot // 2, slot % 2 * 30), clock(8 + (slot + 1) // 2, (slot + 1) % 2 * 30),
+                                 random.choice(doctor_ids), random.choice(patient_ids)))
+        return appointments
+
+    @staticmethod
+    def time_checks(checks, check_conflicts):
+        started = time.perf_counter()
+        for check in checks:
+            check_conflicts(check)
+        return time.perf_counter() - started
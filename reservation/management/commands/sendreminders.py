@@ -0,0 +1,74 @@
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError
+from reservation.reminders import DEFAULT_BATCH_SIZE, DEFAULT_LEAD_TIME, DEFAULT_LEASE_TIME, MAX_BATCH_SIZE, \
+    run_worker, schedule_reminders
+
+
+class Command(BaseCommand):
+    help = 'Queue the reminders of upcoming appointments and deliver them as messages to their patients. ' \
+           'Runs until interrupted, as a separate process; several can run at once. Use --once to run from cron.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--hours',
+            dest='hours',
+            type=int,
+            default=int(DEFAULT_LEAD_TIME.total_seconds() // 3600),
+            help='How many hours before appointments their reminders are delivered.'
+        )
+
+        parser.add_argument(
+            '--batch-size',
+            dest='batch_size',
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+            help='The number of reminders leased and delivered at once, at most %d.' % MAX_BATCH_SIZE
+        )
+
+        parser.add_argument(
+            '--lease-seconds',
+            dest='lease_seconds',
+            type=int,
+            default=int(DEFAULT_LEASE_TIME.total_seconds()),
+            help='How long a batch is held before other workers can take it over, if it isn\'t delivered.'
+        )
+
+        parser.add_argument(
+            '--interval',
+            dest='interval',
+            type=int,
+            default=60,
+            help='The number of seconds between ticks.'
+        )
+
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            dest='once',
+            default=False,
+            help='Run a single tick and exit.'
+        )
+
+    def handle(self, *args, **options):
+        if options.get('hours') < 1:
+            raise CommandError('The number of hours must be at least 1.')
+        if not 1 <= options.get('batch_size') <= MAX_BATCH_SIZE:
+            raise CommandError('The batch size must be between 1 and %d.' % MAX_BATCH_SIZE)
+        lead_time = timedelta(hours=options.get('hours'))
+        lease_time = timedelta(seconds=options.get('lease_seconds'))
+
+        try:
+            while True:
+                queued = schedule_reminders(lead_time=lead_time)
+                delivered = run_worker(batch_size=options.get('batch_size'), lease_time=lease_time)
+                if queued or delivered or options.get('once'):
+                    self.stdout.write('Queued %d reminders, delivered %d.' % (queued, delivered))
+                if options.get('once'):
+                    return
+                time.sleep(options.get('interval'))
+        except OperationalError:
+            raise CommandError('Operation cannot be completed. Did you forget to do database migration?')
+        except KeyboardInterrupt:
+            self.stdout.write('Stopped.')
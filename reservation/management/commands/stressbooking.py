@@ -0,0 +1,154 @@
+import random
+import threading
+import time
+from datetime import date, datetime, timedelta
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, OperationalError
+from django.db.models import Count
+from account.models import Doctor, Patient
+from hospital.models import Hospital
+from reservation.availability import get_day_slots
+from reservation.models import Appointment, ScheduleDay
+
+
+def run_bookings(doctor, patients, day, slots, bookings, book):
+    """
+    Book random slots of a doctor's day from one thread per patient, all at once.
+    Each thread opens its own database connection, so the database has to be one they can share.
+    :param slots: The (start time, end time) tuples of the slots of the day.
+    :param bookings: The number of bookings each thread attempts.
+    :param book: A function booking an unsaved appointment.
+    :return: A dict of the number of attempts that booked a slot ('booked'), found it taken ('taken'), and failed
+             with a database error ('errors').
+    """
+    results = {'booked': 0, 'taken': 0, 'errors': 0}
+    results_lock = threading.Lock()
+
+    def run(patient, seed):
+        rng = random.Random(seed)
+        counts = {'booked': 0, 'taken': 0, 'errors': 0}
+        try:
+            for _ in range(bookings):
+                start_time, end_time = rng.choice(slots)
+                appointment = Appointment(title='Stress test', doctor=doctor, patient=patient, date=day,
+                                          start_time=start_time, end_time=end_time)
+                try:
+                    book(appointment)
+                    counts['booked'] += 1
+                except ValidationError:
+                    counts['taken'] += 1
+                except OperationalError:
+                    # e.g. SQLite giving up waiting for another thread's lock.
+                    counts['errors'] += 1
+        finally:
+            connection.close()
+        with results_lock:
+            for key, count in counts.items():
+                results[key] += count
+
+    threads = [threading.Thread(target=run, args=(patient, i)) for i, patient in enumerate(patients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class Command(BaseCommand):
+    help = 'Book the same doctor\'s slots from many threads at once, and check that no slot is booked twice. ' \
+           'Use a file-backed database; everything created is deleted afterwards.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--threads',
+            dest='threads',
+            type=int,
+            default=16,
+            help='The number of threads booking at once.'
+        )
+
+        parser.add_argument(
+            '--bookings',
+            dest='bookings',
+            type=int,
+            default=50,
+            help='The number of bookings each thread attempts.'
+        )
+
+        parser.add_argument(
+            '--no-lock',
+            action='store_true',
+            dest='no_lock',
+            default=False,
+            help='Check the slot and save the appointment without locking, to show the double bookings it allows.'
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db(connection.settings_dict['NAME']):
+            raise CommandError('The threads need a file-backed database to share.')
+
+        try:
+            hospital, doctor, patients = self.create_accounts(options.get('threads'))
+        except OperationalError:
+            raise CommandError('Operation cannot be completed. Did you forget to do database migration?')
+
+        try:
+            day = date.today() + timedelta(days=1)
+            slots = [(start.time(), end.time()) for start, end in get_day_slots(day)]
+            book = self.book_without_lock if options.get('no_lock') else self.book
+            started = time.perf_counter()
+            results = run_bookings(doctor, patients, day, slots, options.get('bookings'), book)
+            elapsed = time.perf_counter() - started
+
+            attempts = sum(results.values())
+            double_booked = self.count_double_bookings(doctor)
+            self.stdout.write('%d bookings attempted by %d threads in %.2fs (%.0f per second):' % (
+                attempts, len(patients), elapsed, attempts / elapsed))
+            self.stdout.write('    Booked:                %d of %d slots' % (results['booked'], len(slots)))
+            self.stdout.write('    Slot already taken:    %d' % results['taken'])
+            self.stdout.write('    Database lock errors:  %d' % results['errors'])
+            self.stdout.write('    Double-booked slots:   %d' % double_booked)
+        finally:
+            self.delete_accounts(hospital, doctor, patients)
+
+        if double_booked and not options.get('no_lock'):
+            raise CommandError('Some slots were booked more than once.')
+
+    @staticmethod
+    def create_accounts(count):
+        suffix = datetime.now().strftime('%Y%m%d%H%M%S%f')
+        hospital = Hospital.objects.create(name='Stress test hospital', location='Stress test location')
+        doctor = Doctor.objects.create(user=User.objects.create(username='stress-doctor-' + suffix),
+                                       hospital=hospital)
+        patients = [Patient.objects.create(user=User.objects.create(username='stress-patient-%d-%s' % (i, suffix)),
+                                           preferred_hospital=hospital, proof_of_insurance='')
+                    for i in range(count)]
+        return hospital, doctor, patients
+
+    @staticmethod
+    def delete_accounts(hospital, doctor, patients):
+        users = [doctor.user_id] + [patient.user_id for patient in patients]
+        Appointment.objects.filter(doctor=doctor).delete()
+        ScheduleDay.objects.filter(user__in=users).delete()
+        Patient.objects.filter(pk__in=[patient.pk for patient in patients]).delete()
+        doctor.delete()
+        User.objects.filter(pk__in=users).delete()
+        hospital.delete()
+
+    @staticmethod
+    def book(appointment):
+        appointment.book()
+
+    @staticmethod
+    def book_without_lock(appointment):
+        if Appointment.get_conflicting(appointment.date, appointment.start_time, appointment.end_time,
+                                       doctor_id=appointment.doctor_id).exists():
+            raise ValidationError('The time slot is not available, please try a different one.')
+        appointment.save()
+
+    @staticmethod
+    def count_double_bookings(doctor):
+        return Appointment.objects.filter(doctor=doctor, cancelled=False).values('date', 'start_time').annotate(
+            count=Count('id')).filter(count__gt=1).count()
@@ -1,8 +1,21 @@
 from datetime import date, timedelta
-from django.db import models
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import connection, models, transaction, IntegrityError
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.crypto import get_random_string
 from account.models import Patient, Doctor, get_account_from_user
 
 
+"""The length of the appointments patients make."""
+APPOINTMENT_LENGTH = timedelta(minutes=30)
+
+"""The most appointments a series can have, and the most days between them."""
+MAX_SERIES_OCCURRENCES = 52
+MAX_SERIES_INTERVAL_DAYS = 365
+
+
 class Appointment(models.Model):
     """
     A model object that stores an appointment's information.
@@ -11,11 +24,21 @@ class Appointment(models.Model):
     title = models.CharField(max_length=50)
     patient = models.ForeignKey(Patient, on_delete=models.PROTECT)
     doctor = models.ForeignKey(Doctor, on_delete=models.PROTECT)
-    date = models.DateField()
+    """
+    Indexed on its own for the reminder scheduler, which finds the appointments starting in a time range. An index
+    on (date, start_time) would do too, but the conflict check would then be planned onto it instead of the
+    participants' indexes; see `get_conflicting`.
+    """
+    date = models.DateField(db_index=True)
     start_time = models.TimeField()
     end_time = models.TimeField()
 
     cancelled = models.BooleanField(default=False)
+    # When the appointment was last created, changed or cancelled; used to tell whether calendar feeds changed.
+    modified = models.DateTimeField(auto_now=True)
+    # The recurring series the appointment was created in, if any.
+    series = models.ForeignKey('AppointmentSeries', on_delete=models.SET_NULL, null=True, blank=True,
+                               related_name='appointments')
 
     def __str__(self):
         return self.view_appointment()
@@ -28,6 +51,24 @@ class Appointment(models.Model):
     def accessible_by_user(self, user):
         return self.patient.user == user or self.doctor.user == user
 
+    def book(self):
+        """
+        Save the appointment, unless either participant has another appointment at the same time.
+        The participants' days are locked while checking and saving, so that concurrent bookings can't both take
+        the same time.
+        :raise ValidationError: If the time slot is not available.
+        """
+
+        with transaction.atomic():
+            ScheduleDay.lock([self.doctor.user_id, self.patient.user_id], [self.date])
+            conflicts = Appointment.get_conflicting(self.date, self.start_time, self.end_time,
+                                                    doctor_id=self.doctor_id, patient_id=self.patient_id)
+            if self.pk is not None:
+                conflicts = conflicts.exclude(pk=self.pk)
+            if not self.cancelled and conflicts.exists():
+                raise ValidationError('The time slot is not available, please try a different one.')
+            self.save()
+
     @classmethod
     def get_for_user_in_year_in_month(cls, user, year, month):
         return user.appointment_set.exclude(cancelled=True).filter(date__year=year).filter(date__month=month).order_by(
@@ -51,12 +92,240 @@ class Appointment(models.Model):
         except AttributeError:
             return None
 
+    @classmethod
+    def get_for_hospital_in_week_starting_at_date(cls, hospital, starting_date, doctor_ids=None):
+        """
+        Get the appointments with the doctors of a hospital in the week starting at the given date,
+        with the doctors and patients read in the same query.
+        :param hospital: A hospital object.
+        :param starting_date: A datetime.date object representing the first day of the week.
+        :param doctor_ids: If given, only get the appointments with these doctors.
+        :return: The appointments, ordered by date, doctor name and time.
+        """
+
+        appointments = cls.objects.exclude(cancelled=True).filter(doctor__hospital=hospital).filter(
+            date__gte=starting_date).filter(date__lt=starting_date + timedelta(days=7))
+        if doctor_ids is not None:
+            appointments = appointments.filter(doctor_id__in=doctor_ids)
+        return appointments.select_related('doctor__user', 'patient__user').order_by(
+            'date', 'doctor__user__last_name', 'doctor__user__first_name', 'doctor', 'start_time')
+
     @classmethod
     def get_for_user_in_date(cls, user, date):
         return user.appointment_set.exclude(cancelled=True).filter(date=date).order_by('start_time')
 
+    @classmethod
+    def get_conflicting(cls, date, start_time, end_time, doctor_id=None, patient_id=None):
+        """
+        Get the appointments of either participant that overlap the given time on the given date.
+        Times are half-open intervals, so an appointment may start at the time another one ends.
+        The query is planned as a lookup of each participant's appointments with their (participant, date,
+        start_time) index, e.g. SQLite's MULTI-INDEX OR. That only holds while no other index serves the date and
+        time better, which is why the date is indexed on its own; `test_conflict_query_plan` checks it.
+        Two separate queries would be certain to use the indexes too, but cost more than the whole check in Django.
+        :param doctor_id: The id of the doctor of the appointment, if known.
+        :param patient_id: The id of the patient of the appointment, if known.
+        :return: A queryset of the non-cancelled conflicting appointments;
+                 Or, an empty queryset if neither participant is known.
+        """
+
+        participants_q = Q()
+        if doctor_id is not None:
+            participants_q |= Q(doctor_id=doctor_id)
+        if patient_id is not None:
+            participants_q |= Q(patient_id=patient_id)
+        if not participants_q:
+            return cls.objects.none()
+
+        return cls.objects.filter(participants_q).filter(cancelled=False, date=date, start_time__lt=end_time,
+                                                         end_time__gt=start_time)
+
     class Meta:
+        index_together = (
+            ('doctor', 'date', 'start_time'),
+            ('patient', 'date', 'start_time'),
+        )
         permissions = (
             ('cancel_appointment', 'Can cancel appointment'),
             ('view_appointment', 'Can view appointments'),
         )
+
+
+class AppointmentSeries(models.Model):
+    """
+    A series of appointments at the same time that repeats every few days, such as weekly follow-up visits.
+    The appointments are created along with the series, and can then be changed or cancelled one by one.
+    """
+    title = models.CharField(max_length=50)
+    patient = models.ForeignKey(Patient, on_delete=models.PROTECT)
+    doctor = models.ForeignKey(Doctor, on_delete=models.PROTECT)
+    first_date = models.DateField()
+    start_time = models.TimeField()
+    end_time = models.TimeField()
+    """The number of days from one appointment to the next; 7 for weekly appointments."""
+    interval_days = models.PositiveSmallIntegerField(default=7)
+    occurrences = models.PositiveSmallIntegerField()
+
+    def __str__(self):
+        return '%s, every %d days from %s, %d times' % (self.title, self.interval_days, self.first_date,
+                                                        self.occurrences)
+
+    def get_dates(self):
+        return [self.first_date + timedelta(days=self.interval_days * i) for i in range(self.occurrences)]
+
+    def build_appointments(self):
+        """
+        :return: The list of the series' appointments, unsaved, in chronological order.
+        """
+        return [Appointment(title=self.title, patient=self.patient, doctor=self.doctor, date=date,
+                            start_time=self.start_time, end_time=self.end_time, series=self)
+                for date in self.get_dates()]
+
+
+class ScheduleDay(models.Model):
+    """
+    A user's schedule on a date, which is locked while appointments are booked on that date.
+    Checking a time slot and saving the appointment are two queries; by first writing to the rows of the
+    participants' days, which locks them until the transaction ends, concurrent bookings on the same days are
+    checked and saved one after the other, so two of them can't both take the same slot.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    date = models.DateField()
+    """The number of times appointments have been booked on this day."""
+    bookings = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def lock(cls, user_ids, dates):
+        """
+        Lock the days of the given users until the end of the current transaction, creating those that don't exist.
+        :param user_ids: The ids of the users.
+        :param dates: The dates to lock.
+        """
+
+        keys = set((user_id, date) for user_id in user_ids for date in dates)
+        days = cls.objects.filter(user_id__in=user_ids, date__in=dates)
+        if connection.features.has_select_for_update:
+            # Lock the rows in the same order for every booking, so that two bookings can't each wait for a row the
+            # other one locked.
+            list(days.select_for_update().order_by('user', 'date').values_list('pk', flat=True))
+        # Writing to the rows locks them on every database; on SQLite, it takes the write lock before anything is
+        # read.
+        if days.update(bookings=F('bookings') + 1) == len(keys):
+            return
+
+        existing = set(days.values_list('user_id', 'date'))
+        missing = sorted(keys - existing)
+        try:
+            with transaction.atomic():
+                cls.objects.bulk_create([cls(user_id=user_id, date=date, bookings=1) for user_id, date in missing])
+        except IntegrityError:
+            # Another booking created some of the days first; it has to finish before they can be locked.
+            for user_id, date in missing:
+                try:
+                    with transaction.atomic():
+                        cls.objects.create(user_id=user_id, date=date, bookings=1)
+                except IntegrityError:
+                    cls.objects.filter(user_id=user_id, date=date).update(bookings=F('bookings') + 1)
+
+    class Meta:
+        unique_together = (('user', 'date'),)
+
+
+class ScheduleVersion(models.Model):
+    """
+    A stamp of the version of a user's schedule, bumped by the signal handlers in `reservation.signals` whenever
+    one of the user's appointments is created, changed, cancelled or deleted.
+    The schedule pages are cached under the version of the schedules they show, so they don't have to be invalidated.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='schedule_version')
+    version = models.PositiveIntegerField(default=0)
+    modified = models.DateTimeField()
+
+    def __str__(self):
+        return self.get_stamp(self.version, self.modified)
+
+    @staticmethod
+    def get_stamp(version, modified):
+        """
+        :return: A string identifying a version of a schedule; it includes the time of the change, so that a
+                 schedule recreated under the same user id never reuses the stamp of an older one.
+        """
+        if modified is None:
+            return str(version or 0)
+        return '%d-%s' % (version, modified.strftime('%Y%m%d%H%M%S%f'))
+
+    @classmethod
+    def bump(cls, user_ids):
+        """
+        Move the schedules of the given users to a new version, creating their stamps on first use.
+        :param user_ids: The ids of the users.
+        """
+
+        user_ids = set(user_ids)
+        modified = timezone.now()
+        stamps = cls.objects.filter(user_id__in=user_ids)
+        if stamps.update(version=F('version') + 1, modified=modified) == len(user_ids):
+            return
+
+        missing = sorted(user_ids - set(stamps.values_list('user_id', flat=True)))
+        try:
+            with transaction.atomic():
+                cls.objects.bulk_create([cls(user_id=user_id, version=1, modified=modified) for user_id in missing])
+        except IntegrityError:
+            # A concurrent change created some of the stamps since they were looked up.
+            for user_id in missing:
+                try:
+                    with transaction.atomic():
+                        cls.objects.create(user_id=user_id, version=1, modified=modified)
+                except IntegrityError:
+                    cls.objects.filter(user_id=user_id).update(version=F('version') + 1, modified=modified)
+
+
+class ReminderJob(models.Model):
+    """
+    A reminder of an appointment to deliver to its patient, queued by the scheduler in `reservation.reminders`.
+    Workers lease due jobs for a while before delivering them, so that several of them can run at once without
+    delivering a reminder twice; the jobs of a worker that stops are leased again once their lease expires.
+    """
+    appointment = models.ForeignKey(Appointment, on_delete=models.CASCADE, related_name='reminder_jobs')
+    """When the appointment starts; if it is moved, the job is dropped and a new one is queued."""
+    start = models.DateTimeField(db_index=True)
+    """When the reminder is to be delivered."""
+    due = models.DateTimeField()
+
+    """The token of the worker's lease, and when it expires."""
+    lease_token = models.CharField(max_length=32, blank=True)
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    """The number of times the job was leased."""
+    attempts = models.PositiveSmallIntegerField(default=0)
+    """When the reminder was delivered, or dropped."""
+    completed = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return 'Reminder of appointment %d, due %s' % (self.appointment_id, self.due)
+
+    class Meta:
+        unique_together = (('appointment', 'start'),)
+        index_together = (('completed', 'due'),)
+
+
+class CalendarFeed(models.Model):
+    """
+    The secret token in the address of a user's iCalendar feed of appointments.
+    Calendar clients can't log in, so whoever knows the token can read the feed; resetting it revokes the old address.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='calendar_feed')
+    token = models.CharField(max_length=40, unique=True)
+
+    @classmethod
+    def for_user(cls, user):
+        """Get the user's feed, creating it on first use."""
+
+        try:
+            return user.calendar_feed
+        except cls.DoesNotExist:
+            return cls.objects.create(user=user, token=get_random_string(40))
+
+    def reset(self):
+        self.token = get_random_string(40)
+        self.save()
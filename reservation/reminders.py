@@ -0,0 +1,156 @@
+"""
+Reminders of upcoming appointments, delivered to patients as messages from their doctors.
+
+Reminders go through a queue of jobs in the database (`ReminderJob`), run by the `sendreminders` command in its own
+process, so they never slow requests down:
+
+- Each tick, the scheduler finds the appointments starting within the reminder lead time with a single range query
+  on the date index, which spans at most a couple of days, and queues a job for those that don't have one yet.
+- Workers lease batches of due jobs with a conditional update, which only succeeds for jobs nobody else holds, then
+  deliver the reminders of a batch with a single bulk insert of messages, in the same transaction as completing the
+  jobs. A worker that stops loses its lease when it expires, and its jobs are leased again.
+"""
+import uuid
+from datetime import datetime, timedelta
+from django.db import transaction, IntegrityError
+from django.db.models import F, Q
+from django.utils import timezone
+from messaging.models import Message
+from reservation.models import Appointment, ReminderJob
+
+
+"""How long before appointments their reminders are delivered."""
+DEFAULT_LEAD_TIME = timedelta(hours=24)
+
+"""The number of jobs leased at once by default, and the most that can be; a batch's ids are sent in one query."""
+DEFAULT_BATCH_SIZE = 100
+MAX_BATCH_SIZE = 500
+
+"""How long a worker holds the jobs it leased before others can lease them."""
+DEFAULT_LEASE_TIME = timedelta(minutes=5)
+
+"""The number of times a job is leased before it's given up on."""
+MAX_ATTEMPTS = 5
+
+
+def get_appointments_starting_between(since, until):
+    """
+    Get the appointments starting after a time and at or before another, in a single range query.
+    :return: A queryset of the non-cancelled appointments.
+    """
+
+    return Appointment.objects.filter(cancelled=False, date__gte=since.date(), date__lte=until.date()).filter(
+        Q(date__gt=since.date()) | Q(date=since.date(), start_time__gt=since.time())).filter(
+        Q(date__lt=until.date()) | Q(date=until.date(), start_time__lte=until.time()))
+
+
+def schedule_reminders(now=None, lead_time=DEFAULT_LEAD_TIME):
+    """
+    Queue the reminders of the appointments starting within the lead time that haven't been queued yet.
+    Reminders of appointments booked less than the lead time ahead are due at once.
+    It can run in several processes at once; each reminder is only queued once.
+    :return: The number of reminders queued.
+    """
+
+    if now is None:
+        now = timezone.now()
+    until = now + lead_time
+
+    appointments = get_appointments_starting_between(now, until).values_list('id', 'date', 'start_time')
+    queued = set(ReminderJob.objects.filter(start__gt=now, start__lte=until).values_list('appointment_id', 'start'))
+    jobs = []
+    for appointment_id, day, start_time in appointments:
+        start = datetime.combine(day, start_time)
+        if (appointment_id, start) not in queued:
+            jobs.append(ReminderJob(appointment_id=appointment_id, start=start, due=max(start - lead_time, now)))
+    if not jobs:
+        return 0
+
+    try:
+        with transaction.atomic():
+            ReminderJob.objects.bulk_create(jobs)
+        return len(jobs)
+    except IntegrityError:
+        # Another scheduler queued some of them since they were looked up.
+        count = 0
+        for job in jobs:
+            try:
+                with transaction.atomic():
+                    job.save()
+                count += 1
+            except IntegrityError:
+                pass
+        return count
+
+
+def lease_jobs(now=None, batch_size=DEFAULT_BATCH_SIZE, lease_time=DEFAULT_LEASE_TIME):
+    """
+    Lease a batch of due jobs, earliest first.
+    The jobs are leased with an update conditional on nobody else holding them, so two workers never get the same
+    job, whatever the database's locking.
+    :return: A tuple of the lease token, and the list of the leased jobs, with their appointments and participants.
+    """
+
+    if now is None:
+        now = timezone.now()
+    available = ReminderJob.objects.filter(completed__isnull=True, due__lte=now, attempts__lt=MAX_ATTEMPTS).filter(
+        Q(lease_expires__isnull=True) | Q(lease_expires__lte=now))
+    candidates = list(available.order_by('due').values_list('id', flat=True)[:min(batch_size, MAX_BATCH_SIZE)])
+
+    token = uuid.uuid4().hex
+    if candidates:
+        available.filter(id__in=candidates).update(lease_token=token, lease_expires=now + lease_time,
+                                                   attempts=F('attempts') + 1)
+    jobs = list(ReminderJob.objects.filter(lease_token=token).select_related(
+        'appointment__doctor__user', 'appointment__patient__user').order_by('due')) if candidates else []
+    return token, jobs
+
+
+def format_reminder(appointment):
+    return 'Reminder: you have an appointment with Dr. %s on %s, from %s to %s: %s' % (
+        appointment.doctor.full_name(), appointment.date.strftime('%A, %B %d, %Y'),
+        appointment.start_time.strftime('%H:%M'), appointment.end_time.strftime('%H:%M'), appointment.title)
+
+
+def deliver_reminders(token, jobs, now=None):
+    """
+    Deliver the reminders of leased jobs, with a single bulk insert of messages, and complete the jobs.
+    The jobs of appointments that were cancelled or moved since they were queued are completed without a reminder.
+    Jobs whose lease expired and that were leased again by another worker are left to it.
+    :param token: The token the jobs were leased with.
+    :return: The number of reminders delivered.
+    """
+
+    if now is None:
+        now = timezone.now()
+    jobs = dict((job.pk, job) for job in jobs)
+    leased = ReminderJob.objects.filter(id__in=list(jobs), lease_token=token)
+
+    with transaction.atomic():
+        # Completing the jobs first locks them, and tells which of them the lease still holds.
+        leased.filter(completed__isnull=True).update(completed=now)
+        held = leased.filter(completed=now).values_list('id', flat=True)
+
+        messages = []
+        for job_id in held:
+            appointment = jobs[job_id].appointment
+            if not appointment.cancelled and \
+                    datetime.combine(appointment.date, appointment.start_time) == jobs[job_id].start:
+                messages.append(Message(sender=appointment.doctor.user, recipient=appointment.patient.user,
+                                        content=format_reminder(appointment)))
+        Message.objects.bulk_create(messages)
+    return len(messages)
+
+
+def run_worker(now=None, batch_size=DEFAULT_BATCH_SIZE, lease_time=DEFAULT_LEASE_TIME):
+    """
+    Lease and deliver batches of due jobs until none are left.
+    :return: The number of reminders delivered.
+    """
+
+    delivered = 0
+    while True:
+        token, jobs = lease_jobs(now, batch_size, lease_time)
+        if not jobs:
+            return delivered
+        delivered += deliver_reminders(token, jobs, now)
@@ -0,0 +1,41 @@
+"""
+Signal handlers that bump the schedule versions of the participants of appointments as the appointments change.
+
+An appointment changing participants changes the schedules of both the previous and the new ones, so the previous
+participants are read from the database in `pre_save`.
+"""
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from reservation.models import Appointment, AppointmentSeries, ScheduleVersion
+
+
+def participant_user_ids(appointment):
+    return {appointment.doctor.user_id, appointment.patient.user_id}
+
+
+@receiver(pre_save, sender=Appointment)
+def remember_participants(sender, instance, raw=False, **kwargs):
+    instance._previous_participant_user_ids = set()
+    if instance.pk is not None and not raw:
+        previous = Appointment.objects.filter(pk=instance.pk).values_list('doctor__user', 'patient__user').first()
+        if previous is not None:
+            instance._previous_participant_user_ids = set(previous)
+
+
+@receiver(post_save, sender=Appointment)
+def appointment_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        ScheduleVersion.bump(participant_user_ids(instance) |
+                             getattr(instance, '_previous_participant_user_ids', set()))
+
+
+@receiver(post_delete, sender=Appointment)
+def appointment_deleted(sender, instance, **kwargs):
+    ScheduleVersion.bump(participant_user_ids(instance))
+
+
+@receiver(post_save, sender=AppointmentSeries)
+def series_saved(sender, instance, created, raw=False, **kwargs):
+    # The appointments of a series are bulk created, without signals, in the same transaction as the series.
+    if created and not raw:
+        ScheduleVersion.bump(participant_user_ids(instance))
@@ -1,13 +1,64 @@
+import calendar
 import datetime
-from django.test import TestCase
-from reservation.forms import BaseAppointmentForm, AppointmentFormForPatient, AppointmentFormForDoctor
+import json
+import math
+from unittest import mock, skipUnless
+from io import StringIO
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.core.urlresolvers import reverse
+from reservation.forms import BaseAppointmentForm, AppointmentFormForPatient, AppointmentFormForDoctor, \
+    AppointmentSeriesForm
 from django.contrib.auth.models import User
-from account.models import Patient, Doctor
+from account.management.commands import setupgroups
+from account.models import Patient, Doctor, Nurse, create_default_account
 from hospital.models import Hospital
-from reservation.models import Appointment
+from messaging.models import Message
+from reservation.models import Appointment, AppointmentSeries, CalendarFeed, ReminderJob, ScheduleDay, \
+    ScheduleVersion, APPOINTMENT_LENGTH
+from reservation.ical import fold_line, FEED_PAST_DAYS, FEED_FUTURE_DAYS
+from reservation.api import MAX_PAGE_SIZE
+from reservation.availability import find_free_slots, get_booked_intervals, find_conflicts, get_day_slots
+from reservation.reminders import deliver_reminders, lease_jobs, run_worker, schedule_reminders, DEFAULT_LEASE_TIME, \
+    MAX_ATTEMPTS
+from reservation.views import get_month_grid, get_week
+from reservation.management.commands import stressbooking
+
+PASSWORD = '$teamname'
 
 
 # Create your tests here.
+def days_from_today(days):
+    return datetime.date.today() + datetime.timedelta(days=days)
+
+
+class ScheduleTestCase(TestCase):
+    """
+    The setup shared by the schedule tests: the groups, a hospital and two of its patients.
+    Appointments are booked with `book`, by default with `self.doctor` and `self.patient` on `self.day`.
+    """
+
+    def setUp(self):
+        setupgroups.Command().handle(quiet=True)
+        self.hospital = Hospital.objects.create(name='Test hospital', location='Test location')
+        self.patient = self.create_account('patient', Patient).patient
+        self.other_patient = self.create_account('other_patient', Patient).patient
+        self.day = datetime.date.today() + datetime.timedelta(days=1)
+
+    def create_account(self, username, account_class, hospital=None):
+        return create_default_account(username, PASSWORD, account_class, hospital or self.hospital)
+
+    def book(self, title='Appointment', day=None, start_time='9:00', end_time='9:30', doctor=None, patient=None,
+             cancelled=False):
+        return Appointment.objects.create(title=title, doctor=doctor or self.doctor, patient=patient or self.patient,
+                                          date=day or self.day, start_time=start_time, end_time=end_time,
+                                          cancelled=cancelled)
+
+
 class AppointmentFormTestCaseBase(TestCase):
     def setUp(self):
         hospital = Hospital.objects.create(name='Test hospital', location='Test location')
@@ -62,11 +113,77 @@ class BaseAppointmentFormTestCase(AppointmentFormTestCaseBase):
                                    date=self.tomorrow(), start_time='4:00', end_time='5:00')
 
         form = BaseAppointmentForm({'title': 'appointment 2', 'start_time': '4:30', 'end_time': '5:30',
-                                    'date': self.tomorrow()})
+                                    'date': self.tomorrow()},
+                                   instance=Appointment(patient=self.patient(), doctor=self.doctor()))
 
         self.assertFalse(form.is_valid(),
                          'Form not reporting error when having time conflict with an existing appointment.')
 
+    def test_conflicts_are_scoped_to_participants(self):
+        hospital = Hospital.objects.first()
+        other_doctor = Doctor.objects.create(user=User.objects.create_user(username='d2', password='password'),
+                                             hospital=hospital)
+        other_patient = Patient.objects.create(user=User.objects.create_user(username='p2', password='password'),
+                                               preferred_hospital=hospital, proof_of_insurance='')
+        Appointment.objects.create(title='appointment 1', patient=self.patient(), doctor=self.doctor(),
+                                   date=self.tomorrow(), start_time='4:00', end_time='5:00')
+
+        data = {'title': 'appointment 2', 'start_time': '4:30', 'end_time': '5:30', 'date': self.tomorrow()}
+        form = BaseAppointmentForm(data, instance=Appointment(patient=other_patient, doctor=other_doctor))
+        self.assertTrue(form.is_valid(), 'Appointments of other doctors and patients should not conflict.')
+
+        form = BaseAppointmentForm(data, instance=Appointment(patient=other_patient, doctor=self.doctor()))
+        self.assertFalse(form.is_valid(), 'Form not reporting error when the doctor is busy.')
+
+        form = BaseAppointmentForm(data, instance=Appointment(patient=self.patient(), doctor=other_doctor))
+        self.assertFalse(form.is_valid(), 'Form not reporting error when the patient is busy.')
+
+    @skipUnless(connection.vendor == 'sqlite', 'The query plan is checked on SQLite.')
+    def test_conflict_query_plan(self):
+        with connection.cursor() as cursor:
+            indexes = dict((tuple(constraint['columns']), name) for name, constraint in
+                           connection.introspection.get_constraints(cursor, Appointment._meta.db_table).items()
+                           if constraint['index'])
+            sql, params = Appointment.get_conflicting(datetime.date.today(), datetime.time(4), datetime.time(5),
+                                                      doctor_id=self.doctor().pk,
+                                                      patient_id=self.patient().pk).query.sql_with_params()
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = ' '.join(row[-1] for row in cursor.fetchall())
+
+        for participant in ('doctor_id', 'patient_id'):
+            self.assertIn('USING INDEX %s ' % indexes[participant, 'date', 'start_time'], plan,
+                          'Expected each participant\'s appointments to be looked up with their own index, not '
+                          'every appointment of the day.')
+
+    def test_adjacent_times(self):
+        appointment = Appointment.objects.create(title='appointment 1', patient=self.patient(), doctor=self.doctor(),
+                                                 date=self.tomorrow(), start_time='4:00', end_time='5:00')
+        participants = Appointment(patient=self.patient(), doctor=self.doctor())
+
+        form = BaseAppointmentForm({'title': 'appointment 2', 'start_time': '5:00', 'end_time': '6:00',
+                                    'date': self.tomorrow()}, instance=participants)
+        self.assertTrue(form.is_valid(), 'An appointment should be able to start when another one ends.')
+
+        form = BaseAppointmentForm({'title': 'appointment 2', 'start_time': '3:00', 'end_time': '4:00',
+                                    'date': self.tomorrow()}, instance=participants)
+        self.assertTrue(form.is_valid(), 'An appointment should be able to end when another one starts.')
+
+        form = BaseAppointmentForm({'title': 'appointment 1', 'start_time': '4:30', 'end_time': '5:30',
+                                    'date': self.tomorrow()}, instance=appointment)
+        self.assertTrue(form.is_valid(), 'An appointment should not conflict with itself.')
+
+        appointment.cancelled = True
+        appointment.save()
+        form = BaseAppointmentForm({'title': 'appointment 2', 'start_time': '4:30', 'end_time': '5:30',
+                                    'date': self.tomorrow()}, instance=participants)
+        self.assertTrue(form.is_valid(), 'Cancelled appointments should not conflict.')
+
+    def test_end_before_start(self):
+        form = BaseAppointmentForm({'title': 'Check up', 'start_time': '5:30', 'end_time': '4:30',
+                                    'date': self.tomorrow()})
+
+        self.assertFalse(form.is_valid(), 'Form not reporting error when the appointment ends before it starts.')
+
 
 class AppointmentFormForDoctorTestCase(AppointmentFormTestCaseBase):
     def test_success_scenario(self):
@@ -84,6 +201,19 @@ class AppointmentFormForDoctorTestCase(AppointmentFormTestCaseBase):
         doctor_apt_errors = apt_form_doctors.errors
         self.assertTrue('patient' in doctor_apt_errors, 'Field not reporting an error when field not supplied')
 
+    def test_conflicting_times(self):
+        Appointment.objects.create(title='appointment 1', patient=self.patient(), doctor=self.doctor(),
+                                   date=self.tomorrow(), start_time='2:30', end_time='3:30')
+        other_patient = Patient.objects.create(user=User.objects.create_user(username='p2', password='password'),
+                                               preferred_hospital=Hospital.objects.first(), proof_of_insurance='')
+
+        apt_form_doctors = AppointmentFormForDoctor({'title': 'Check up', 'date': self.tomorrow(), 'start_time': '2:00',
+                                                     'end_time': '3:00', 'patient': other_patient.id},
+                                                    user=self.doctor().user)
+
+        self.assertFalse(apt_form_doctors.is_valid(),
+                         'Form not reporting error when the creating doctor has a conflicting appointment.')
+
 
 class AppointmentFormForPatientTestCase(AppointmentFormTestCaseBase):
     def test_success_scenario(self):
@@ -99,3 +229,925 @@ class AppointmentFormForPatientTestCase(AppointmentFormTestCaseBase):
 
         patient_apt_errors = apt_form_patients.errors
         self.assertTrue('doctor' in patient_apt_errors, 'Field not reporting an error when field not supplied')
+
+    def test_conflicting_times(self):
+        Appointment.objects.create(title='appointment 1', patient=self.patient(), doctor=self.doctor(),
+                                   date=self.tomorrow(), start_time='2:20', end_time='3:00')
+
+        apt_form_patients = AppointmentFormForPatient({'title': 'Check up', 'date': self.tomorrow(), 'start_time':
+            '2:00', 'doctor': self.doctor().id}, user=self.patient().user)
+        self.assertFalse(apt_form_patients.is_valid(),
+                         'Form not reporting error when the 30 minutes of the appointment conflict with another one.')
+
+        apt_form_patients = AppointmentFormForPatient({'title': 'Check up', 'date': self.tomorrow(), 'start_time':
+            '3:00', 'doctor': self.doctor().id}, user=self.patient().user)
+        self.assertTrue(apt_form_patients.is_valid(), 'Appointment form for patients should be validated')
+
+
+
+class FreeSlotsTestCase(ScheduleTestCase):
+    def setUp(self):
+        super(FreeSlotsTestCase, self).setUp()
+        self.doctor = self.create_account('doctor', Doctor).doctor
+        self.other_doctor = self.create_account('other_doctor', Doctor).doctor
+
+    def free_start_times(self, patient=None, now=None):
+        return [start_time.strftime('%H:%M') for day, start_time, end_time in
+                find_free_slots(self.doctor, self.day, self.day, patient=patient, now=now)]
+
+    def test_free_day(self):
+        start_times = self.free_start_times()
+
+        self.assertEqual(20, len(start_times), 'A free day should have a slot every 30 minutes from 8:00 to 18:00.')
+        self.assertEqual('08:00', start_times[0])
+        self.assertEqual('17:30', start_times[-1])
+
+    def test_booked_times(self):
+        self.book(start_time='9:00', end_time='10:00')
+        # Overlapping appointments are merged into one booked interval.
+        self.book(start_time='11:00', end_time='12:00')
+        self.book(start_time='11:15', end_time='11:45')
+        self.book(start_time='11:50', end_time='12:10')
+        self.book(start_time='14:10', end_time='14:20')
+        self.book(start_time='15:00', end_time='16:00', cancelled=True)
+        self.book(start_time='16:00', end_time='17:00', doctor=self.other_doctor)
+
+        self.assertEqual(3, len(get_booked_intervals(self.doctor, self.day, self.day)),
+                         'Overlapping appointments should be merged.')
+        self.assertEqual(['08:00', '08:30', '10:00', '10:30', '12:30', '13:00', '13:30', '14:30', '15:00', '15:30',
+                          '16:00', '16:30', '17:00', '17:30'], self.free_start_times(),
+                         'Slots should not overlap the doctor\'s appointments, but may be next to them.')
+
+    def test_patient_times(self):
+        self.book(start_time='16:00', end_time='17:00', doctor=self.other_doctor, patient=self.patient)
+
+        self.assertIn('16:00', self.free_start_times(), 'Other doctors\' appointments should not take slots.')
+        self.assertNotIn('16:00', self.free_start_times(patient=self.patient),
+                         'The patient\'s own appointments should take slots.')
+        self.assertIn('17:00', self.free_start_times(patient=self.patient))
+
+    def test_past_slots(self):
+        now = datetime.datetime.combine(self.day, datetime.time(12, 10))
+
+        self.assertEqual('12:30', self.free_start_times(now=now)[0], 'Slots that have started should be left out.')
+
+    def test_date_range(self):
+        next_day = self.day + datetime.timedelta(days=1)
+        self.book(start_time='8:00', end_time='18:00')
+        self.book(start_time='8:00', end_time='9:00', day=next_day)
+
+        slots = find_free_slots(self.doctor, self.day, next_day)
+        self.assertEqual(18, len(slots))
+        self.assertTrue(all(day == next_day for day, start_time, end_time in slots))
+
+    def test_availability_view(self):
+        self.book(start_time='8:00', end_time='17:00')
+        self.book(start_time='17:00', end_time='17:30', doctor=self.other_doctor, patient=self.patient)
+        self.client.login(username='patient', password=PASSWORD)
+
+        response = self.client.get(reverse('reservation:availability'),
+                                   {'doctor': self.doctor.pk, 'since': self.day.isoformat(),
+                                    'until': self.day.isoformat()})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([{'date': self.day.isoformat(), 'start_time': '17:30', 'end_time': '18:00'}],
+                         json.loads(response.content.decode())['slots'],
+                         'The patient should only be offered slots that are free for both participants.')
+
+        response = self.client.get(reverse('reservation:availability'), {'doctor': self.doctor.pk})
+        slots = json.loads(response.content.decode())['slots']
+        self.assertEqual(datetime.date.today() + datetime.timedelta(days=13),
+                         datetime.datetime.strptime(slots[-1]['date'], '%Y-%m-%d').date(),
+                         'Slots should be found for two weeks by default.')
+
+        response = self.client.get(reverse('reservation:availability'),
+                                   {'doctor': self.doctor.pk, 'until': (self.day + datetime.timedelta(days=40))})
+        self.assertEqual(400, response.status_code, 'Long date ranges should be refused.')
+
+        response = self.client.get(reverse('reservation:availability'))
+        self.assertEqual(400, response.status_code, 'The doctor should be required.')
+
+    def test_create_page_offers_slots(self):
+        self.client.login(username='patient', password=PASSWORD)
+        self.assertContains(self.client.get(reverse('reservation:create')), 'id="free-slots"')
+
+        self.client.login(username='doctor', password=PASSWORD)
+        self.assertNotContains(self.client.get(reverse('reservation:create')), 'id="free-slots"',
+                               msg_prefix='Doctors choose the patient rather than a doctor\'s free slot.')
+
+
+class CalendarViewTestCase(ScheduleTestCase):
+    def setUp(self):
+        super(CalendarViewTestCase, self).setUp()
+        self.doctor = self.create_account('doctor', Doctor).doctor
+
+    def test_appointments_by_day(self):
+        self.book('Afternoon', datetime.date(2030, 3, 5), '14:00', '23:00')
+        self.book('Morning', datetime.date(2030, 3, 5), '9:00', '23:00')
+        self.book('Last day', datetime.date(2030, 3, 31), '9:00', '23:00')
+        self.book('Cancelled', datetime.date(2030, 3, 6), '9:00', '23:00', cancelled=True)
+        self.book('Other patient', datetime.date(2030, 3, 7), '9:00', '23:00', patient=self.other_patient)
+        self.book('Next month', datetime.date(2030, 4, 5), '9:00', '23:00')
+        self.client.login(username='patient', password=PASSWORD)
+
+        response = self.client.get(reverse('reservation:calendar', args=[3, 2030]))
+
+        cells = dict((day, [appointment['title'] for appointment in appointments])
+                     for week in response.context['calendar_weeks'] for day, appointments in week if day)
+        self.assertEqual(31, len(cells), 'Every day of the month should have a cell.')
+        self.assertEqual(['Morning', 'Afternoon'], cells[5], 'A day\'s appointments should be in order of time.')
+        self.assertEqual(['Last day'], cells[31])
+        self.assertEqual([], cells[6], 'Cancelled appointments should not be shown.')
+        self.assertEqual([], cells[7], 'Other users\' appointments should not be shown.')
+        self.assertContains(response, 'Morning')
+        self.assertNotContains(response, 'Next month')
+
+        self.client.login(username='doctor', password=PASSWORD)
+        response = self.client.get(reverse('reservation:calendar', args=[3, 2030]))
+        self.assertEqual(['Other patient'],
+                         [appointment['title'] for appointment in response.context['appointments_by_day'][7]],
+                         'Doctors should see the appointments of all their patients.')
+
+
+def calculate_day(month, year):
+    """
+    The month layout the calendar used before `get_month_grid`, kept to compare against.
+    Function is used to calculate the days in the month and
+    when it stars and ends. Extra days are added as place
+    holders
+    :param month: a month in the form of an int
+    :param year: a year
+    :return: list of days for a given month
+    """
+    if int(month) == 2 or int(month) == 1:
+        year = int(year) - 1
+        month = int(month) + 12
+
+    final = 1 + (2 * int(month)) + (3 * (int(month) + 1) / 5) + int(year) + math.floor(int(year) / 4) - \
+            math.floor(int(year) / 100) + math.floor(int(year) / 400) + 2
+
+    remainder = math.floor(final / 7)
+    remainder *= 7
+    final -= remainder
+
+    thirtyone_months = ["12", "13", "3", "5", "7", "8", "10"]
+
+    if (int(year) / 4 and int(month) == 14) or (month == 14 and int(year) / 100 and int(year) / 400):
+        counter = 29
+    if month == 14:
+        counter = 28
+    elif month in thirtyone_months or month == 13:
+        counter = 31
+    else:
+        counter = 30
+
+    count = 1
+    days_one = []
+    days_two = []
+    days_three = []
+    days_four = []
+    days_five = []
+    days_six = []
+
+    # populate each of the weeks to be displayed
+    if (int(final) == 0):
+        final = 7
+
+    for i in range(0, int(final) - 1):
+        days_one.append("none")
+
+    for i in range(0, 7 - (int(final) - 1)):
+        days_one.append(count)
+        count += 1
+
+    for i in range(0, 7):
+        days_two.append(count)
+        count += 1
+
+    for i in range(0, 7):
+        days_three.append(count)
+        count += 1
+
+    for i in range(0, 7):
+        days_four.append(count)
+        count += 1
+    counter -= (21 + (7 - (final - 1)))
+    if int(counter) - 7 < 0 and int(counter) > 0:
+        for i in range(0, int(counter)):
+            days_five.append(count)
+            count += 1
+        for i in range(int(counter), 7):
+            days_five.append("none")
+        for i in range(0, 7):
+            days_six.append("none")
+    elif int(counter) == 0:
+        for i in range(0, 7):
+            days_five.append("none")
+            days_six.append("none")
+    else:
+        for i in range(0, 7):
+            days_five.append(count)
+            count += 1
+        counter -= 7
+        if int(counter) - 7 < 0 and int(counter) > 0:
+            for i in range(0, int(counter)):
+                days_six.append(count)
+                count += 1
+            for i in range(int(counter), 7):
+                days_six.append("none")
+
+    days = [days_one, days_two, days_three, days_four, days_five, days_six]
+
+    return days
+
+
+class MonthGridTestCase(TestCase):
+    def test_matches_previous_layout(self):
+        for year in range(1000, 10000):
+            for month in range(1, 13):
+                # The last week of December 9999 is cut short, as there are no later dates.
+                grid = [[day.day if day.month == month else 'none' for day in week] + ['none'] * (7 - len(week))
+                        for week in get_month_grid(year, month)]
+                # The previous layout always had six weeks, padded with blank or empty weeks.
+                previous = [week for week in calculate_day(str(month), str(year)) if any(day != 'none' for day in week)]
+                if month == 2 and calendar.isleap(year):
+                    # The previous layout never had a 29th of February.
+                    self.assertEqual(29, max(grid[-1], key=lambda day: 0 if day == 'none' else day))
+                    grid[-1] = [day if day != 29 else 'none' for day in grid[-1]]
+                    if all(day == 'none' for day in grid[-1]):
+                        grid.pop()
+                self.assertEqual(previous, grid, 'Month layout differs for %d/%d' % (month, year))
+
+    def test_immutable_and_cached(self):
+        grid = get_month_grid(2017, 3)
+
+        self.assertIsInstance(grid, tuple)
+        self.assertTrue(all(isinstance(week, tuple) and len(week) == 7 for week in grid))
+        self.assertEqual(datetime.date(2017, 2, 26), grid[0][0], 'Weeks should start on Sunday.')
+        self.assertEqual(datetime.date(2017, 4, 1), grid[-1][-1])
+        self.assertIs(grid, get_month_grid(2017, 3), 'Month grids should be cached.')
+
+    def test_week(self):
+        week = get_week(datetime.date(2017, 2, 26))
+
+        self.assertEqual(tuple(datetime.date(2017, 2, 26) + datetime.timedelta(days=i) for i in range(7)), week)
+        self.assertIs(get_month_grid(2017, 2)[-1], week, 'Weeks should be shared with the month grid.')
+        self.assertEqual(datetime.date(2017, 3, 4), get_week(datetime.date(2017, 2, 26))[-1])
+
+
+class WeekViewTestCase(ScheduleTestCase):
+    def setUp(self):
+        super(WeekViewTestCase, self).setUp()
+        self.other_hospital = Hospital.objects.create(name='Other hospital', location='Other location')
+        self.create_account('nurse', Nurse)
+        self.doctors = [self.create_doctor('doctor%d' % i, self.hospital) for i in range(2)]
+        # The week from Sunday, 3 March 2030.
+        self.sunday = datetime.date(2030, 3, 3)
+
+    def create_doctor(self, username, hospital):
+        doctor = self.create_account(username, Doctor, hospital).doctor
+        doctor.user.last_name = username
+        doctor.user.save()
+        return doctor
+
+    def get_week_days(self, data=None):
+        url = reverse('reservation:weekview', args=[self.sunday.day, self.sunday.month, self.sunday.year])
+        response = self.client.post(url, data) if data is not None else self.client.get(url)
+        return response, dict((day, [(doctor and doctor.user.username, [appointment.title for appointment in
+                                                                        appointments])
+                                     for doctor, appointments in doctor_appointments])
+                              for day, doctor_appointments in response.context['week_days'])
+
+    def test_nurse_week(self):
+        monday = self.sunday + datetime.timedelta(days=1)
+        self.book('Second', monday, '10:00', '23:00', doctor=self.doctors[0])
+        self.book('First', monday, '9:00', '23:00', doctor=self.doctors[0])
+        self.book('Other doctor', monday, '8:00', '23:00', doctor=self.doctors[1])
+        self.book('Cancelled', monday, '9:00', '23:00', doctor=self.doctors[1], cancelled=True)
+        self.book('Saturday', self.sunday + datetime.timedelta(days=6), '9:00', '23:00', doctor=self.doctors[1])
+        self.book('Next week', self.sunday + datetime.timedelta(days=7), '9:00', '23:00', doctor=self.doctors[0])
+        self.book('Last week', self.sunday - datetime.timedelta(days=1), '9:00', '23:00', doctor=self.doctors[0])
+        self.book('Other hospital', monday, '9:00', '23:00',
+                  doctor=self.create_doctor('other_doctor', self.other_hospital))
+        self.client.login(username='nurse', password=PASSWORD)
+
+        response, week_days = self.get_week_days()
+        self.assertEqual(list(get_week(self.sunday)), [day for day, _ in response.context['week_days']])
+        self.assertEqual([('doctor0', ['First', 'Second']), ('doctor1', ['Other doctor'])], week_days[monday],
+                         'A day\'s appointments should be grouped by doctor, and ordered by time.')
+        self.assertEqual([('doctor1', ['Saturday'])], week_days[self.sunday + datetime.timedelta(days=6)])
+        self.assertEqual([], week_days[self.sunday])
+        self.assertNotContains(response, 'Next week')
+        self.assertNotContains(response, 'Last week')
+        self.assertNotContains(response, 'Other hospital')
+
+        response, week_days = self.get_week_days({'doctor_list': [self.doctors[1].pk]})
+        self.assertEqual([('doctor1', ['Other doctor'])], week_days[monday],
+                         'Only the selected doctors\' appointments should be shown.')
+
+    def test_nurse_week_queries(self):
+        self.client.login(username='nurse', password=PASSWORD)
+        for doctor in self.doctors:
+            self.book('Appointment', self.sunday, '9:00', '23:00', doctor=doctor)
+
+        # Including the version of the hospital's schedules, which the page is cached under.
+        with self.assertNumQueries(10):
+            self.get_week_days()
+
+        for i in range(2, 10):
+            doctor = self.create_doctor('doctor%d' % i, self.hospital)
+            for day in range(7):
+                self.book('Appointment', self.sunday + datetime.timedelta(days=day), '9:00', '23:00',
+                          doctor=doctor)
+        # The number of queries doesn't grow with the number of doctors or appointments.
+        with self.assertNumQueries(10):
+            self.get_week_days()
+
+    def test_patient_week(self):
+        self.book('Monday', self.sunday + datetime.timedelta(days=1), '9:00', '23:00', doctor=self.doctors[0])
+        self.book('Next week', self.sunday + datetime.timedelta(days=7), '9:00', '23:00', doctor=self.doctors[0])
+        self.client.login(username='patient', password=PASSWORD)
+
+        response, week_days = self.get_week_days()
+        self.assertEqual([(None, ['Monday'])], week_days[self.sunday + datetime.timedelta(days=1)])
+        self.assertNotContains(response, 'Next week')
+
+
+class CalendarFeedTestCase(ScheduleTestCase):
+    def setUp(self):
+        super(CalendarFeedTestCase, self).setUp()
+        self.doctor = self.create_account('doctor', Doctor).doctor
+        self.create_account('nurse', Nurse)
+        self.feed = CalendarFeed.for_user(self.patient.user)
+
+    def get_feed(self, **headers):
+        return self.client.get(reverse('reservation:calendar_feed', args=[self.feed.token]), **headers)
+
+    def test_feed(self):
+        appointment = self.book('Check up, annual', days_from_today(1))
+        self.book('Cancelled', days_from_today(2), cancelled=True)
+        self.book('Long ago', days_from_today(-FEED_PAST_DAYS - 1))
+        self.book('Far ahead', days_from_today(FEED_FUTURE_DAYS + 1))
+        self.book('Other patient', days_from_today(1), patient=self.other_patient)
+
+        response = self.get_feed()
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('text/calendar; charset=utf-8', response['Content-Type'])
+        feed = b''.join(response.streaming_content).decode()
+        self.assertTrue(feed.startswith('BEGIN:VCALENDAR\r\n'))
+        self.assertTrue(feed.endswith('END:VCALENDAR\r\n'))
+        self.assertEqual(2, feed.count('BEGIN:VEVENT'))
+        self.assertIn('SUMMARY:Check up\\, annual\r\n', feed, 'Text should be escaped.')
+        self.assertIn('DTSTART:%s\r\n' % appointment.date.strftime('%Y%m%dT090000'), feed)
+        self.assertIn('STATUS:CANCELLED', feed, 'Cancelled appointments should be removed from calendars.')
+        self.assertNotIn('Long ago', feed, 'The feed should only cover its window of dates.')
+        self.assertNotIn('Far ahead', feed, 'The feed should only cover its window of dates.')
+        self.assertNotIn('Other patient', feed)
+
+        self.feed = CalendarFeed.for_user(self.doctor.user)
+        self.assertIn('Other patient', b''.join(self.get_feed().streaming_content).decode(),
+                      'Doctors\' feeds should have the appointments with all their patients.')
+
+    def test_etag(self):
+        appointment = self.book('Check up', days_from_today(1))
+        etag = self.get_feed()['ETag']
+
+        response = self.get_feed(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code, 'An unchanged feed should not be sent again.')
+        self.assertEqual(etag, response['ETag'])
+
+        appointment.start_time = datetime.time(10)
+        appointment.save()
+        response = self.get_feed(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code, 'A changed appointment should change the feed.')
+        etag = response['ETag']
+
+        appointment.delete()
+        self.assertEqual(200, self.get_feed(HTTP_IF_NONE_MATCH=etag).status_code,
+                         'A deleted appointment should change the feed.')
+
+    def test_feed_queries(self):
+        self.book('Check up', days_from_today(1))
+        with self.assertNumQueries(5):
+            b''.join(self.get_feed().streaming_content)
+
+        for days in range(FEED_PAST_DAYS + 1, FEED_PAST_DAYS + 50):
+            self.book('Long ago', days_from_today(-days))
+        # The feed's cost doesn't depend on the appointments outside its window.
+        with self.assertNumQueries(5):
+            self.assertEqual(1, b''.join(self.get_feed().streaming_content).decode().count('BEGIN:VEVENT'))
+
+    def test_settings(self):
+        self.client.login(username='patient', password=PASSWORD)
+        response = self.client.get(reverse('reservation:calendar_feed_settings'))
+        self.assertContains(response, reverse('reservation:calendar_feed', args=[self.feed.token]))
+
+        old_token = self.feed.token
+        self.client.post(reverse('reservation:calendar_feed_settings'))
+        self.feed.refresh_from_db()
+        self.assertNotEqual(old_token, self.feed.token)
+        self.assertEqual(404, self.client.get(reverse('reservation:calendar_feed', args=[old_token])).status_code,
+                         'The old address should stop working once reset.')
+        self.assertEqual(200, self.get_feed().status_code)
+
+        self.client.login(username='nurse', password=PASSWORD)
+        self.assertEqual(403, self.client.get(reverse('reservation:calendar_feed_settings')).status_code,
+                         'Nurses don\'t have appointments of their own.')
+
+    def test_fold_line(self):
+        self.assertEqual('SUMMARY:Short\r\n', fold_line('SUMMARY:Short'))
+
+        folded = fold_line('DESCRIPTION:' + '\u00e9' * 100)
+        lines = folded.split('\r\n')
+        self.assertEqual('', lines.pop(), 'Folded lines should end with CRLF.')
+        self.assertTrue(all(len(line.encode()) <= 75 for line in lines), 'Lines should be at most 75 octets.')
+        self.assertTrue(all(line.startswith(' ') for line in lines[1:]))
+        self.assertEqual('DESCRIPTION:' + '\u00e9' * 100, ''.join(line[1:] if i else line
+                                                                   for i, line in enumerate(lines)))
+
+
+class AppointmentSeriesTestCase(ScheduleTestCase):
+    def setUp(self):
+        super(AppointmentSeriesTestCase, self).setUp()
+        self.doctor = self.create_account('doctor', Doctor).doctor
+        self.first_date = self.day
+
+    def series_data(self, **data):
+        series_data = {'title': 'Follow-up', 'patient': self.patient.pk, 'first_date': self.first_date.isoformat(),
+                       'start_time': '9:00', 'end_time': '9:30', 'interval_days': 7, 'occurrences': 4}
+        series_data.update(data)
+        return series_data
+
+    def test_dates(self):
+        weekly = AppointmentSeries(first_date=datetime.date(2030, 1, 31), interval_days=7, occurrences=3)
+        self.assertEqual([datetime.date(2030, 1, 31), datetime.date(2030, 2, 7), datetime.date(2030, 2, 14)],
+                         weekly.get_dates())
+
+        every_three_days = AppointmentSeries(first_date=datetime.date(2030, 2, 27), interval_days=3, occurrences=2)
+        self.assertEqual([datetime.date(2030, 2, 27), datetime.date(2030, 3, 2)], every_three_days.get_dates())
+
+    def test_find_conflicts(self):
+        Appointment.objects.create(title='Doctor busy', doctor=self.doctor, patient=self.other_patient,
+                                   date=self.first_date + datetime.timedelta(days=7), start_time='9:15',
+                                   end_time='10:00')
+        Appointment.objects.create(title='Adjacent', doctor=self.doctor, patient=self.other_patient,
+                                   date=self.first_date, start_time='8:00', end_time='9:00')
+        Appointment.objects.create(title='Patient busy', doctor=self.doctor, patient=self.patient,
+                                   date=self.first_date + datetime.timedelta(days=21), start_time='8:45',
+                                   end_time='9:05')
+        Appointment.objects.create(title='After the series', doctor=self.doctor, patient=self.patient,
+                                   date=self.first_date + datetime.timedelta(days=28), start_time='9:00',
+                                   end_time='9:30')
+        series = AppointmentSeries(title='Follow-up', doctor=self.doctor, patient=self.patient,
+                                   first_date=self.first_date, start_time=datetime.time(9),
+                                   end_time=datetime.time(9, 30), interval_days=7, occurrences=4)
+        appointments = series.build_appointments()
+
+        with self.assertNumQueries(1):
+            conflicts = find_conflicts(appointments)
+        self.assertEqual([self.first_date + datetime.timedelta(days=7), self.first_date + datetime.timedelta(days=21)],
+                         [appointment.date for appointment in conflicts])
+
+    def test_create_series(self):
+        form = AppointmentSeriesForm(self.series_data(), user=self.doctor.user)
+        self.assertTrue(form.is_valid(), form.errors)
+
+        # Locking the schedule days of both participants, creating them, checking for conflicts, creating the
+        # series and its appointments, and bumping the participants' schedule versions doesn't depend on the number
+        # of occurrences.
+        with self.assertNumQueries(15):
+            series = form.save()
+        self.assertEqual([self.first_date + datetime.timedelta(days=7 * i) for i in range(4)],
+                         list(series.appointments.order_by('date').values_list('date', flat=True)))
+        self.assertTrue(all(appointment.doctor == self.doctor and appointment.patient == self.patient
+                            for appointment in series.appointments.all()))
+
+        form = AppointmentSeriesForm(self.series_data(first_date=(self.first_date + datetime.timedelta(days=14))
+                                                      .isoformat(), start_time='9:20', end_time='9:40'),
+                                     user=self.doctor.user)
+        self.assertFalse(form.is_valid(), 'Form not reporting error when the series conflicts with another.')
+        self.assertIn((self.first_date + datetime.timedelta(days=14)).isoformat(), str(form.errors),
+                      'The dates of the conflicts should be reported.')
+        self.assertEqual(4, Appointment.objects.count(), 'No appointment should be created when there\'s a conflict.')
+
+    def test_invalid_series(self):
+        self.assertFalse(AppointmentSeriesForm(self.series_data(occurrences=1), user=self.doctor.user).is_valid())
+        self.assertFalse(AppointmentSeriesForm(self.series_data(interval_days=0), user=self.doctor.user).is_valid())
+        self.assertFalse(AppointmentSeriesForm(self.series_data(end_time='8:00'), user=self.doctor.user).is_valid())
+        self.assertFalse(AppointmentSeriesForm(self.series_data(first_date=datetime.date.today() -
+                                                                datetime.timedelta(days=1)),
+                                               user=self.doctor.user).is_valid())
+
+    def test_create_series_view(self):
+        self.client.login(username='patient', password=PASSWORD)
+        self.assertEqual(403, self.client.get(reverse('reservation:create_series')).status_code,
+                         'Only doctors should create series.')
+
+        self.client.login(username='doctor', password=PASSWORD)
+        data = self.series_data()
+        data.pop('first_date')
+        data.update({'first_date_year': self.first_date.year, 'first_date_month': self.first_date.month,
+                     'first_date_day': self.first_date.day})
+        response = self.client.post(reverse('reservation:create_series'), data)
+        self.assertRedirects(response, reverse('reservation:create_done'))
+        self.assertEqual(4, Appointment.objects.filter(series__isnull=False).count())
+
+
+class BookingTestCase(ScheduleTestCase):
+    def setUp(self):
+        super(BookingTestCase, self).setUp()
+        self.doctor = self.create_account('doctor', Doctor).doctor
+
+    def patient_form(self, patient):
+        return AppointmentFormForPatient({'title': 'Check up', 'date': self.day.isoformat(), 'start_time': '9:00',
+                                          'doctor': self.doctor.pk}, user=patient.user)
+
+    def test_concurrent_bookings(self):
+        # Both bookings are validated before either is saved, as when two requests come in at once.
+        first = self.patient_form(self.patient)
+        second = self.patient_form(self.other_patient)
+        self.assertTrue(first.is_valid())
+        self.assertTrue(second.is_valid())
+
+        first.save(self.patient.user)
+        with self.assertRaises(ValidationError, msg='The second booking of the slot should fail when saved.'):
+            second.save(self.other_patient.user)
+        self.assertEqual(1, Appointment.objects.count())
+
+        # The failed booking's locks were rolled back with it.
+        self.assertEqual(sorted([(self.doctor.user_id, 1), (self.patient.user_id, 1)]),
+                         sorted(ScheduleDay.objects.filter(date=self.day).values_list('user', 'bookings')),
+                         'The participants\' days should be locked for each booking.')
+
+    def test_concurrent_booking_view(self):
+        form = self.patient_form(self.other_patient)
+        self.assertTrue(form.is_valid())
+        form.save(self.other_patient.user)
+
+        self.client.login(username='patient', password=PASSWORD)
+        with mock.patch.object(AppointmentFormForPatient, 'clean', lambda form: form.cleaned_data):
+            # The slot is taken between validating the form and saving it.
+            response = self.client.post(reverse('reservation:create'), {
+                'title': 'Check up', 'date_year': self.day.year, 'date_month': self.day.month,
+                'date_day': self.day.day, 'start_time': '9:15', 'doctor': self.doctor.pk})
+        self.assertEqual(200, response.status_code)
+        self.assertIn('The time slot is not available, please try a different one.',
+                      response.context['form'].non_field_errors())
+        self.assertEqual(1, Appointment.objects.count())
+
+    def test_concurrent_series(self):
+        form = AppointmentSeriesForm({'title': 'Follow-up', 'patient': self.patient.pk,
+                                      'first_date': self.day.isoformat(), 'start_time': '9:00', 'end_time': '9:30',
+                                      'interval_days': 7, 'occurrences': 3}, user=self.doctor.user)
+        self.assertTrue(form.is_valid())
+        Appointment(title='Check up', doctor=self.doctor, patient=self.other_patient,
+                    date=self.day + datetime.timedelta(days=14), start_time=datetime.time(9, 15),
+                    end_time=datetime.time(9, 45)).book()
+
+        with self.assertRaises(ValidationError):
+            form.save()
+        self.assertEqual(1, Appointment.objects.count(), 'No appointment of the series should be created.')
+        self.assertFalse(AppointmentSeries.objects.exists())
+
+    def test_stress_command_needs_file_database(self):
+        with self.assertRaises(CommandError):
+            call_command('stressbooking', threads=2, bookings=1, stdout=StringIO())
+
+
+@skipUnless(connection.vendor != 'sqlite' or connection.features.can_share_in_memory_db,
+            'The booking threads need a database they can share.')
+class ConcurrentBookingTestCase(TransactionTestCase):
+    """Book from several threads at once, each with its own connection, as the `stressbooking` command does."""
+
+    def test_no_double_booking(self):
+        hospital, doctor, patients = stressbooking.Command.create_accounts(4)
+        day = datetime.date.today() + datetime.timedelta(days=1)
+        slots = [(start.time(), end.time()) for start, end in get_day_slots(day)][:4]
+
+        results = stressbooking.run_bookings(doctor, patients, day, slots, 10, stressbooking.Command.book)
+        self.assertGreater(results['booked'], 0)
+        self.assertLessEqual(results['booked'], len(slots))
+        self.assertEqual(stressbooking.Command.count_double_bookings(doctor), 0,
+                         'Expected no slot to be booked twice, however the threads interleave.')
+
+
+class ScheduleCacheTestCase(ScheduleTestCase):
+    def setUp(self):
+        super(ScheduleCacheTestCase, self).setUp()
+        cache.clear()
+        self.create_account('nurse', Nurse)
+        self.doctor = self.create_account('doctor', Doctor).doctor
+        self.other_doctor = self.create_account('other_doctor', Doctor).doctor
+        self.day = datetime.date(2030, 3, 5)
+
+    def get_versions(self):
+        return dict(ScheduleVersion.objects.values_list('user', 'version'))
+
+    def test_versions(self):
+        appointment = self.book('Check up')
+        self.assertEqual({self.doctor.user_id: 1, self.patient.user_id: 1}, self.get_versions(),
+                         'Creating an appointment should bump the versions of both participants.')
+
+        appointment.cancelled = True
+        appointment.save()
+        self.assertEqual({self.doctor.user_id: 2, self.patient.user_id: 2}, self.get_versions())
+
+        appointment.doctor = self.other_doctor
+        appointment.save()
+        self.assertEqual({self.doctor.user_id: 3, self.other_doctor.user_id: 1, self.patient.user_id: 3},
+                         self.get_versions(), 'Both the previous and the new participants\' versions should be bumped.')
+
+        appointment.delete()
+        self.assertEqual({self.doctor.user_id: 3, self.other_doctor.user_id: 2, self.patient.user_id: 4},
+                         self.get_versions())
+
+        AppointmentSeriesForm({'title': 'Follow-up', 'patient': self.other_patient.pk,
+                               'first_date': (datetime.date.today() + datetime.timedelta(days=1)).isoformat(),
+                               'start_time': '9:00', 'end_time': '9:30', 'interval_days': 7, 'occurrences': 3},
+                              user=self.doctor.user).save()
+        self.assertEqual({self.doctor.user_id: 4, self.other_doctor.user_id: 2, self.patient.user_id: 4,
+                          self.other_patient.user_id: 1}, self.get_versions(),
+                         'Creating a series should bump the versions of its participants once.')
+
+    def assert_not_modified(self, url, modified_by):
+        """
+        Check that a page is answered with a 304 while it's unchanged, and is rendered again once `modified_by`
+        changes the schedules it shows.
+        """
+
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('private, no-cache', response['Cache-Control'])
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code, 'An unchanged page should not be sent again.')
+        self.assertEqual(b'', response.content)
+
+        modified_by()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code, 'A changed page should be sent again.')
+        self.assertNotEqual(etag, response['ETag'])
+        return response
+
+    def test_calendar(self):
+        self.client.login(username='patient', password=PASSWORD)
+        response = self.assert_not_modified(reverse('reservation:calendar', args=[3, 2030]),
+                                            lambda: self.book('New appointment'))
+        self.assertContains(response, 'New appointment')
+
+        # Other users' appointments don't change the page.
+        etag = response['ETag']
+        self.book('Other patient', patient=self.other_patient, doctor=self.other_doctor)
+        response = self.client.get(reverse('reservation:calendar', args=[3, 2030]), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+
+    def test_calendar_fragment(self):
+        self.book('Check up')
+        self.client.login(username='patient', password=PASSWORD)
+        url = reverse('reservation:calendar', args=[3, 2030])
+        content = self.client.get(url).content
+
+        with mock.patch.object(Appointment, 'get_for_user_in_year_in_month') as get_appointments:
+            response = self.client.get(url)
+        self.assertFalse(get_appointments.called, 'The month should be rendered from the cache.')
+        self.assertEqual(content, response.content)
+
+        self.client.login(username='doctor', password=PASSWORD)
+        self.assertEqual(content.count(b'Check up'), self.client.get(url).content.count(b'Check up'),
+                         'Users should not be shown each other\'s cached months.')
+
+    def test_week(self):
+        self.client.login(username='doctor', password=PASSWORD)
+        self.assert_not_modified(reverse('reservation:weekview', args=[3, 3, 2030]), lambda: self.book('Check up'))
+
+    def test_nurse_pages(self):
+        self.client.login(username='nurse', password=PASSWORD)
+        response = self.assert_not_modified(reverse('reservation:weekview', args=[3, 3, 2030]),
+                                            lambda: self.book('Check up', doctor=self.other_doctor))
+        self.assertContains(response, 'Check up')
+
+        self.assert_not_modified(reverse('reservation:overview', args=[5, 3, 2030]),
+                                 lambda: self.create_account('new_doctor', Doctor))
+
+        # The week of the selected doctors is posted, and always rendered.
+        response = self.client.post(reverse('reservation:weekview', args=[3, 3, 2030]),
+                                    {'doctor_list': [self.doctor.pk]})
+        self.assertEqual(200, response.status_code)
+        self.assertNotContains(response, 'Check up')
+
+    def test_overview(self):
+        appointment = self.book('Check up')
+        self.client.login(username='patient', password=PASSWORD)
+
+        def cancel():
+            appointment.cancelled = True
+            appointment.save()
+
+        response = self.assert_not_modified(reverse('reservation:overview', args=[5, 3, 2030]), cancel)
+        self.assertNotContains(response, 'Check up')
+
+    def test_login_changes_etag(self):
+        self.client.login(username='patient', password=PASSWORD)
+        url = reverse('reservation:calendar', args=[3, 2030])
+        etag = self.client.get(url)['ETag']
+
+        # Logging in again changes the CSRF token in the page's forms.
+        User.objects.filter(pk=self.patient.user_id).update(
+            last_login=datetime.datetime.now() + datetime.timedelta(seconds=1))
+        self.assertEqual(200, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+
+
+class ScheduleApiTestCase(ScheduleTestCase):
+    def setUp(self):
+        super(ScheduleApiTestCase, self).setUp()
+        other_hospital = Hospital.objects.create(name='Other hospital', location='Other location')
+        self.create_account('nurse', Nurse)
+        self.doctors = [self.create_account('doctor%d' % i, Doctor).doctor for i in range(3)]
+        self.other_doctor = self.create_account('other_doctor', Doctor, other_hospital).doctor
+        self.day = datetime.date(2030, 3, 4)
+
+    def get(self, etag=None, **params):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        response = self.client.get(reverse('reservation:schedule'), dict(
+            {'start': self.day.isoformat(), 'end': (self.day + datetime.timedelta(days=7)).isoformat()}, **params),
+            **headers)
+        return response, json.loads(response.content.decode()) if response.status_code != 304 else None
+
+    def test_range(self):
+        self.book('First day', self.day, '9:00', '23:00', doctor=self.doctors[0])
+        self.book('Last day', self.day + datetime.timedelta(days=6), '9:00', '23:00', doctor=self.doctors[0])
+        self.book('End', self.day + datetime.timedelta(days=7), '9:00', '23:00', doctor=self.doctors[0])
+        self.book('Before', self.day - datetime.timedelta(days=1), '9:00', '23:00', doctor=self.doctors[0])
+        self.book('Cancelled', self.day, '9:00', '23:00', doctor=self.doctors[1], cancelled=True)
+        self.book('Other patient', self.day, '10:00', '23:00', doctor=self.doctors[1], patient=self.other_patient)
+        self.client.login(username='patient', password=PASSWORD)
+
+        response, data = self.get()
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(['First day', 'Last day'], [appointment['title'] for appointment in data['appointments']],
+                         'The range should include its start but not its end.')
+        self.assertEqual({'id', 'title', 'date', 'start_time', 'end_time', 'doctor', 'patient'},
+                         set(data['appointments'][0]))
+        self.assertEqual('2030-03-04', data['appointments'][0]['date'])
+        self.assertEqual('09:00', data['appointments'][0]['start_time'])
+        self.assertIsNone(data['next'])
+
+    def test_fields(self):
+        self.book('Check up', self.day, '9:00', '23:00', doctor=self.doctors[0])
+        self.client.login(username='patient', password=PASSWORD)
+
+        with mock.patch.object(Appointment, 'from_db', side_effect=AssertionError) as from_db:
+            response, data = self.get(fields='title,doctor_last_name')
+        self.assertFalse(from_db.called, 'Only the fields\' values should be read.')
+        self.assertEqual([{'title': 'Check up', 'doctor_last_name': self.doctors[0].user.last_name}],
+                         data['appointments'], 'Only the requested fields should be returned.')
+
+        response, data = self.get(fields='title,password')
+        self.assertEqual(400, response.status_code)
+        self.assertIn('fields', data['errors'])
+
+    def test_pages(self):
+        # Appointments at the same time with different doctors are ordered by id.
+        for day in range(3):
+            for doctor in self.doctors:
+                for start_time in ('9:00', '10:00'):
+                    self.book('Appointment', self.day + datetime.timedelta(days=day), start_time, '23:00',
+                              doctor=doctor, patient=self.create_account(
+                                  'patient-%d-%d-%s' % (day, doctor.pk, start_time), Patient).patient)
+        self.book('Other hospital', self.day, '9:00', '23:00', doctor=self.other_doctor)
+        expected = list(Appointment.objects.filter(doctor__hospital=self.hospital).order_by(
+            'date', 'start_time', 'id').values_list('id', flat=True))
+        self.client.login(username='nurse', password=PASSWORD)
+
+        ids = []
+        params = {'fields': 'id', 'limit': 5}
+        while True:
+            with self.assertNumQueries(9):
+                response, data = self.get(**params)
+            self.assertLessEqual(len(data['appointments']), 5)
+            ids.extend(appointment['id'] for appointment in data['appointments'])
+            if data['next'] is None:
+                break
+            params['after'] = data['next']
+        self.assertEqual(expected, ids, 'Every appointment should be on exactly one page, in order.')
+
+        response, data = self.get(fields='id', doctors=[self.doctors[1].pk, self.other_doctor.pk])
+        self.assertEqual(set(Appointment.objects.filter(doctor=self.doctors[1]).values_list('id', flat=True)),
+                         set(appointment['id'] for appointment in data['appointments']),
+                         'Nurses should only get the selected doctors of their hospital.')
+
+        response, data = self.get(after='2030-03-04_nine_1')
+        self.assertEqual(400, response.status_code)
+
+    def test_not_modified(self):
+        self.client.login(username='doctor0', password=PASSWORD)
+        response, data = self.get()
+        self.assertEqual(304, self.get(etag=response['ETag'])[0].status_code)
+
+        self.book('Check up', self.day, '9:00', '23:00', doctor=self.doctors[0])
+        response, data = self.get(etag=response['ETag'])
+        self.assertEqual(['Check up'], [appointment['title'] for appointment in data['appointments']])
+
+    def test_invalid_range(self):
+        self.client.login(username='patient', password=PASSWORD)
+        self.assertEqual(400, self.get(end=self.day.isoformat())[0].status_code)
+        self.assertEqual(400, self.get(limit=MAX_PAGE_SIZE + 1)[0].status_code)
+
+
+class ReminderTestCase(ScheduleTestCase):
+    def setUp(self):
+        super(ReminderTestCase, self).setUp()
+        self.doctor = self.create_account('doctor', Doctor).doctor
+        self.now = datetime.datetime(2030, 3, 4, 12, 0)
+
+    def book_at(self, title, start, cancelled=False):
+        return self.book(title, start.date(), start.time(), (start + APPOINTMENT_LENGTH).time(), cancelled=cancelled)
+
+    def test_schedule(self):
+        soon = self.book_at('Soon', self.now + datetime.timedelta(hours=1))
+        tomorrow = self.book_at('Tomorrow', self.now + datetime.timedelta(hours=23))
+        later = self.book_at('Later', self.now + datetime.timedelta(hours=25))
+        self.book_at('Cancelled', self.now + datetime.timedelta(hours=2), cancelled=True)
+        self.book_at('Past', self.now - datetime.timedelta(hours=1))
+
+        with self.assertNumQueries(5):
+            self.assertEqual(2, schedule_reminders(self.now))
+        self.assertEqual({soon.pk: self.now, tomorrow.pk: self.now}, dict(ReminderJob.objects.values_list(
+            'appointment', 'due')), 'Appointments starting within the lead time should be reminded of at once.')
+        self.assertEqual(0, schedule_reminders(self.now), 'Reminders should only be queued once.')
+
+        self.assertEqual(1, schedule_reminders(self.now + datetime.timedelta(hours=2)))
+        self.assertEqual(self.now + datetime.timedelta(hours=2), ReminderJob.objects.get(appointment=later).due)
+
+        later.date += datetime.timedelta(days=1)
+        later.save()
+        self.assertEqual(0, schedule_reminders(self.now + datetime.timedelta(hours=2)),
+                         'Appointments moved out of the lead time should not be queued.')
+        self.assertEqual(1, schedule_reminders(self.now + datetime.timedelta(hours=26)),
+                         'Moved appointments should be queued again.')
+
+    def test_deliver(self):
+        self.book_at('Check up', self.now + datetime.timedelta(hours=1))
+        cancelled = self.book_at('Cancelled', self.now + datetime.timedelta(hours=2))
+        moved = self.book_at('Moved', self.now + datetime.timedelta(hours=3))
+        schedule_reminders(self.now)
+        cancelled.cancelled = True
+        cancelled.save()
+        moved.start_time = datetime.time(16, 0)
+        moved.save()
+
+        self.assertEqual(1, run_worker(self.now))
+        message = Message.objects.get()
+        self.assertEqual(self.doctor.user, message.sender)
+        self.assertEqual(self.patient.user, message.recipient)
+        self.assertIn('Check up', message.content)
+        self.assertIn('13:00', message.content)
+        self.assertFalse(ReminderJob.objects.filter(completed__isnull=True).exists(),
+                         'The jobs of cancelled and moved appointments should be completed without a reminder.')
+
+        self.assertEqual(0, run_worker(self.now), 'Reminders should only be delivered once.')
+        self.assertEqual(1, schedule_reminders(self.now), 'The moved appointment should be queued again.')
+        self.assertEqual(1, run_worker(self.now))
+
+    def test_leases(self):
+        for hour in range(1, 6):
+            self.book_at('Appointment', self.now + datetime.timedelta(hours=hour))
+        schedule_reminders(self.now)
+
+        token, jobs = lease_jobs(self.now, batch_size=3)
+        self.assertEqual(3, len(jobs))
+        other_token, other_jobs = lease_jobs(self.now + datetime.timedelta(minutes=1), batch_size=3)
+        self.assertEqual(2, len(other_jobs), 'Leased jobs should not be leased again.')
+        self.assertEqual([], lease_jobs(self.now + datetime.timedelta(minutes=1))[1])
+
+        # The first worker stops, and its lease expires.
+        later = self.now + DEFAULT_LEASE_TIME
+        takeover_token, takeover_jobs = lease_jobs(later)
+        self.assertEqual(set(job.pk for job in jobs), set(job.pk for job in takeover_jobs))
+        self.assertEqual([2, 2, 2], [job.attempts for job in takeover_jobs])
+
+        self.assertEqual(0, deliver_reminders(token, jobs, later),
+                         'Jobs leased by another worker should be left to it.')
+        # The reminders of a batch are delivered in a single insert.
+        with self.assertNumQueries(5):
+            self.assertEqual(3, deliver_reminders(takeover_token, takeover_jobs, later))
+        self.assertEqual(2, deliver_reminders(other_token, other_jobs, later))
+        self.assertEqual(5, Message.objects.count())
+
+    def test_gives_up(self):
+        self.book_at('Check up', self.now + datetime.timedelta(hours=1))
+        schedule_reminders(self.now)
+        for attempt in range(MAX_ATTEMPTS):
+            self.assertEqual(1, len(lease_jobs(self.now + DEFAULT_LEASE_TIME * attempt)[1]))
+        self.assertEqual([], lease_jobs(self.now + DEFAULT_LEASE_TIME * MAX_ATTEMPTS)[1])
+
+    def test_command(self):
+        self.book_at('Check up', datetime.datetime.now() + datetime.timedelta(hours=2))
+        out = StringIO()
+        call_command('sendreminders', once=True, stdout=out)
+        self.assertIn('Queued 1 reminders, delivered 1.', out.getvalue())
+        self.assertEqual(1, Message.objects.filter(recipient=self.patient.user).count())
+
+        with self.assertRaises(CommandError):
+            call_command('sendreminders', once=True, batch_size=0, stdout=StringIO())
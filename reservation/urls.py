@@ -5,10 +5,15 @@ app_name = 'reservation'
 urlpatterns = [
     url(r'^calendar/$', views.calendar, name='calendar_now'),
     url(r'^calendar/(?P<month>[0-9]{1,2})/(?P<year>[0-9]{4})/$', views.calendar, name='calendar'),
+    url(r'^calendar/feed/$', views.calendar_feed_settings, name='calendar_feed_settings'),
+    url(r'^calendar/feed/(?P<token>[0-9A-Za-z]+)\.ics$', views.calendar_feed, name='calendar_feed'),
     url(r'^overview/$', views.overview, name='overview_today'),
     url(r'^overview/(?P<day>[0-9]{1,2})/(?P<month>[0-9]{1,2})/(?P<year>[0-9]{4})/$', views.overview, name='overview'),
     url(r'^create/$', views.create_appointment, name='create'),
     url(r'^create/done$', views.create_appointment_done, name='create_done'),
+    url(r'^create/series/$', views.create_series, name='create_series'),
+    url(r'^availability/$', views.availability, name='availability'),
+    url(r'^schedule/$', views.schedule, name='schedule'),
     url(r'^edit/(?P<appointment_id>[0-9]+)/$', views.edit_appointment, name='edit'),
     url(r'^cancel/(?P<appointment_id>[0-9]+)/$', views.cancel_appointment, name='cancel'),
     url(r'^weekview/(?P<day>[0-9]{1,2})/(?P<month>[0-9]{1,2})/(?P<year>[0-9]{4})/$', views.weekview, name='weekview'),
@@ -1,17 +1,34 @@
+import calendar as calendar_module
 import datetime
-import math
+import functools
+import itertools
 
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import Http404
-from django.core.exceptions import PermissionDenied
+from django.template.loader import render_to_string
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.core.exceptions import PermissionDenied, ValidationError
 from django.core.urlresolvers import reverse
 from django.contrib.auth.decorators import login_required, permission_required, user_passes_test
-from reservation.models import Appointment, get_account_from_user
-from reservation.forms import AppointmentFormForPatient, AppointmentFormForDoctor
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from django.utils.safestring import mark_safe
+from reservation.models import Appointment, CalendarFeed, get_account_from_user
+from reservation.forms import AppointmentFormForPatient, AppointmentFormForDoctor, AppointmentSeriesForm, \
+    AvailabilityForm, ScheduleQueryForm
+from reservation.api import get_schedule_appointments, get_page, format_cursor, serialize_value
+from reservation.availability import find_free_slots
+from reservation.caching import conditional_schedule_page, get_cached_fragment, get_hospital_schedule_version, \
+    get_user_schedule_version
+from reservation.ical import get_feed_appointments, get_feed_etag, stream_calendar, FEED_PAST_DAYS, \
+    FEED_FUTURE_DAYS
 from account.models import Patient, Doctor, Nurse, ProfileInformation, get_account_from_user
 from hnet.logger import CreateLogEntry
 
 
+# The calendars' weeks start on Sunday.
+MONTH_CALENDAR = calendar_module.Calendar(firstweekday=calendar_module.SUNDAY)
+
+
 @login_required
 @permission_required('reservation.view_appointment')
 @user_passes_test(lambda u: not u.is_superuser)
@@ -28,7 +45,7 @@ def calendar(request, month=datetime.date.today().month, year=datetime.date.toda
     if not is_month_valid(month) or not is_year_valid(year):
         raise Http404()
 
-    week_list = calculate_day(str(month), str(year))
+    week_list = get_month_grid(year, month)
 
     # forward and back arrow calculations
     if month == 1:
@@ -56,21 +73,87 @@ def calendar(request, month=datetime.date.today().month, year=datetime.date.toda
     if profile_information is not None:
         account_type = profile_information.account_type
         if account_type == Patient.ACCOUNT_TYPE:
-            appointments = Appointment.get_for_user_in_year_in_month(request.user.patient, year, month)
-            if appointments is None:
-                raise Http404()
-            context['appointment_list'] = appointments
-            return render(request, 'reservation/calendar.html', context)
+            account = request.user.patient
         elif account_type == Doctor.ACCOUNT_TYPE:
-            appointments = Appointment.get_for_user_in_year_in_month(request.user.doctor, year, month)
-            if appointments is None:
-                raise Http404()
-            context['appointment_list'] = appointments
+            account = request.user.doctor
+        else:
+            raise PermissionDenied()
+
+        version = get_user_schedule_version(request.user)
+
+        def render_month():
+            # Only read the columns shown in the day cells, and put each appointment in its day's cell in one pass.
+            appointments = Appointment.get_for_user_in_year_in_month(account, year, month).values(
+                'date', 'title', 'start_time', 'end_time')
+            appointments_by_day = group_by_day(appointments)
+            context['appointments_by_day'] = appointments_by_day
+            # Days of the months before and after are left blank.
+            context['calendar_weeks'] = [[(day.day, appointments_by_day.get(day.day, ())) if day.month == month else
+                                          (None, ()) for day in week] for week in week_list]
+            return render_to_string('reservation/calendar_month.html', context)
+
+        def render_page():
+            context['calendar_month'] = get_cached_fragment(version, ('calendar', request.user.pk, year, month),
+                                                            render_month)
             return render(request, 'reservation/calendar.html', context)
 
+        return conditional_schedule_page(request, version, ('calendar', year, month), render_page)
+
     raise PermissionDenied()
 
 
+@login_required
+@permission_required('reservation.view_appointment')
+@user_passes_test(lambda u: not u.is_superuser)
+def calendar_feed_settings(request):
+    """
+    Shows the address of the user's iCalendar feed, and resets it on POST.
+    :param request: requested page
+    :return: page with the feed address
+    """
+    if get_feed_appointments(request.user) is None:
+        raise PermissionDenied()
+
+    feed = CalendarFeed.for_user(request.user)
+    message = None
+    if request.method == 'POST':
+        feed.reset()
+        CreateLogEntry(request.user.username, "Calendar feed address reset.")
+        message = 'The address has been reset; calendars subscribed to the old address will stop updating.'
+
+    feed_url = request.build_absolute_uri(reverse('reservation:calendar_feed', args=[feed.token]))
+    return render(request, 'reservation/feed.html', {'feed_url': feed_url, 'message': message,
+                                                     'past_days': FEED_PAST_DAYS, 'future_days': FEED_FUTURE_DAYS})
+
+
+def calendar_feed(request, token):
+    """
+    The iCalendar feed of a user's appointments. Calendar clients can't log in, so the secret token in the address
+    identifies the user.
+    Clients polling the feed get a 304 response when the appointments in it haven't changed.
+    :param token: the token of the user's feed
+    :return: the feed, streamed
+    """
+    try:
+        feed = CalendarFeed.objects.select_related('user').get(token=token)
+    except CalendarFeed.DoesNotExist:
+        raise Http404()
+    appointments = get_feed_appointments(feed.user)
+    if appointments is None or not feed.user.is_active:
+        raise Http404()
+
+    etag = get_feed_etag(feed.user, appointments)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = StreamingHttpResponse(stream_calendar(appointments, request.get_host()),
+                                         content_type='text/calendar; charset=utf-8')
+        response['Content-Disposition'] = 'inline; filename=appointments.ics'
+    response['ETag'] = quote_etag(etag)
+    # The token in the address is a secret.
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
 @login_required()
 @permission_required('reservation.view_appointment')
 @user_passes_test(lambda u: not u.is_superuser)
@@ -105,24 +188,51 @@ def weekview(request, day=datetime.date.today().day, month=datetime.date.today()
         nurse = get_account_from_user(request.user)
         hospital = nurse.hospital
         person = "nurse"
-        doctors = Doctor.objects.all().filter(hospital=hospital)
+        doctors = Doctor.objects.all().filter(hospital=hospital).select_related('user')
         if request.method == "POST":
             doctor_list = [parse_int(x) for x in request.POST.getlist("doctor_list")]
-            appointments = Appointment.objects.filter(cancelled=False).filter(doctor_id__in=doctor_list)
-        else:
-            appointments = Appointment.objects.filter(cancelled=False).filter(doctor__hospital=hospital)
+        version = get_hospital_schedule_version(hospital)
+        fragment = ('weekview', 'hospital', hospital.pk, week_starting_date)
+
+        def get_week_days():
+            appointments = Appointment.get_for_hospital_in_week_starting_at_date(hospital, week_starting_date,
+                                                                                doctor_ids=doctor_list)
+            # Nurses see the appointments of many doctors, so each day's appointments are grouped by doctor.
+            return group_by_date_and_doctor(appointments)
     else:
-        appointments = Appointment.get_for_user_in_week_starting_at_date(request.user, week_starting_date)
+        version = get_user_schedule_version(request.user)
+        fragment = ('weekview', 'user', request.user.pk, week_starting_date)
+
+        def get_week_days():
+            appointments = Appointment.get_for_user_in_week_starting_at_date(request.user, week_starting_date)
+            # Other users only see their own appointments, in a single group per day.
+            return dict((day, [(None, list(day_appointments))]) for day, day_appointments in
+                        itertools.groupby(appointments or (), key=lambda appointment: appointment.date))
 
-    week = get_week(week_starting_date, week_ending_date)
+    week = get_week(week_starting_date)
     last_week = week_starting_date - datetime.timedelta(days=1)
     next_week = week_ending_date + datetime.timedelta(days=1)
     # 'start_date' and 'end_date' are `datetime.date` objects representing the dates at the start and end of the week.
-    context = {'appointment_list': appointments, 'week': week, 'start_day': week_starting_date,
-               'end_day': week_ending_date, 'next_week': next_week, 'last_week': last_week, 'person': person,
+    context = {'week': week,
+               'start_day': week_starting_date, 'end_day': week_ending_date, 'next_week': next_week, 'last_week': last_week, 'person': person,
                'doctors': doctors, 'selected_doctor_list': doctor_list}
 
-    return render(request, 'reservation/weekview.html', context)
+    def render_days():
+        week_days = get_week_days()
+        context['week_days'] = [(day, week_days.get(day, [])) for day in week]
+        return render_to_string('reservation/weekview_days.html', context)
+
+    def render_page():
+        if doctor_list is None:
+            context['week_days_html'] = get_cached_fragment(version, fragment, render_days)
+        else:
+            # The doctors nurses select are posted, and the days showing only them aren't cached.
+            context['week_days_html'] = mark_safe(render_days())
+        return render(request, 'reservation/weekview.html', context)
+
+    if request.method == 'POST':
+        return render_page()
+    return conditional_schedule_page(request, version, ('weekview', week_starting_date), render_page)
 
 
 @login_required
@@ -152,24 +262,40 @@ def overview(request, day=None, month=None, year=None):
                'can_cancel': request.user.has_perm('reservation.cancel_appointment')}
 
     profile_information = ProfileInformation.from_user(request.user)
-    if profile_information is not None:
-        account_type = profile_information.account_type
-        if account_type == Patient.ACCOUNT_TYPE:
-            appointments = Appointment.get_for_user_in_date(request.user.patient, date)
-            context['appointment_list'] = appointments
-            return render(request, 'reservation/overview.html', context)
-        elif account_type == Doctor.ACCOUNT_TYPE:
-            appointments = Appointment.get_for_user_in_date(request.user.doctor, date)
-            context['appointment_list'] = appointments
-            return render(request, 'reservation/overview.html', context)
-        elif account_type == Nurse.ACCOUNT_TYPE:
-            hospital = request.user.nurse.hospital
+    if profile_information is None:
+        raise PermissionDenied()
+    account_type = profile_information.account_type
+    if account_type == Patient.ACCOUNT_TYPE or account_type == Doctor.ACCOUNT_TYPE:
+        account = request.user.patient if account_type == Patient.ACCOUNT_TYPE else request.user.doctor
+        version = get_user_schedule_version(request.user)
+        fragment = ('overview', 'user', request.user.pk, date)
+        template_name = 'reservation/overview.html'
+        fragment_template_name = 'reservation/overview_appointments.html'
+
+        def get_appointments():
+            return Appointment.get_for_user_in_date(account, date)
+    elif account_type == Nurse.ACCOUNT_TYPE:
+        hospital = request.user.nurse.hospital
+        version = get_hospital_schedule_version(hospital)
+        fragment = ('overview', 'hospital', hospital.pk, date)
+        template_name = 'reservation/overview_nurse.html'
+        fragment_template_name = 'reservation/overview_nurse_appointments.html'
+
+        def get_appointments():
             # filter all cancelled and appointments that are not for a given hospital for the Nurse
-            appointments = Appointment.objects.filter(cancelled=False).filter(date=date).filter(doctor__hospital=hospital)
-            context['appointment_list'] = appointments
-            return render(request, 'reservation/overview_nurse.html', context)
+            return Appointment.objects.filter(cancelled=False).filter(date=date).filter(doctor__hospital=hospital)
+    else:
+        raise PermissionDenied()
 
-    raise PermissionDenied()
+    def render_appointments():
+        context['appointment_list'] = get_appointments()
+        return render_to_string(fragment_template_name, context)
+
+    def render_page():
+        context['appointment_list_html'] = get_cached_fragment(version, fragment, render_appointments)
+        return render(request, template_name, context)
+
+    return conditional_schedule_page(request, version, ('overview', date), render_page)
 
 
 @login_required
@@ -193,10 +319,10 @@ def create_appointment(request):
         raise PermissionDenied()
 
     if request.method == 'POST':
-        form = form_type(request.POST)
-        if form.is_valid():
-            CreateLogEntry(request.user.username, "Appointment created.")
-            form.save(request.user)
+        form = form_type(request.POST, user=request.user)
+        appointment = form.is_valid() and save_booking(form, request.user)
+        if appointment:
+            CreateLogEntry(request.user.username, "Appointment created.", appointment)
             return redirect(reverse('reservation:create_done'))
     else:
         form = form_type()
@@ -204,6 +330,99 @@ def create_appointment(request):
     return render(request, 'reservation/appointment/create.html', {'form': form})
 
 
+@login_required
+@permission_required('reservation.add_appointment')
+@user_passes_test(lambda u: not u.is_superuser)
+def create_series(request):
+    """
+    Used by doctors to create a recurring series of appointments, such as weekly follow-up visits
+    :param request: page requested
+    :return: none
+    """
+    if ProfileInformation.from_user(request.user).account_type != Doctor.ACCOUNT_TYPE:
+        raise PermissionDenied()
+
+    if request.method == 'POST':
+        form = AppointmentSeriesForm(request.POST, user=request.user)
+        series = form.is_valid() and save_booking(form)
+        if series:
+            CreateLogEntry(request.user.username, "Appointment series created.", series)
+            return redirect(reverse('reservation:create_done'))
+    else:
+        form = AppointmentSeriesForm(user=request.user)
+
+    return render(request, 'reservation/appointment/create_series.html', {'form': form})
+
+
+@login_required
+@permission_required('reservation.add_appointment')
+@user_passes_test(lambda u: not u.is_superuser)
+def availability(request):
+    """
+    Used to find the free appointment slots of a doctor over a date range, as JSON.
+    For patients, the slots must also be free in their own schedule.
+    :param request: requested page, with the doctor id and the optional date range in the query string
+    :return: the list of free slots; or the form errors, with a 400 status
+    """
+    form = AvailabilityForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+
+    account = get_account_from_user(request.user)
+    patient = account if isinstance(account, Patient) else None
+    slots = find_free_slots(form.cleaned_data['doctor'], form.cleaned_data['since'], form.cleaned_data['until'],
+                            patient=patient)
+
+    return JsonResponse({
+        'doctor': form.cleaned_data['doctor'].pk,
+        'since': form.cleaned_data['since'].isoformat(),
+        'until': form.cleaned_data['until'].isoformat(),
+        'slots': [{'date': day.isoformat(), 'start_time': start_time.strftime('%H:%M'),
+                   'end_time': end_time.strftime('%H:%M')} for day, start_time, end_time in slots],
+    })
+
+
+@login_required
+@permission_required('reservation.view_appointment')
+@user_passes_test(lambda u: not u.is_superuser)
+def schedule(request):
+    """
+    The appointments of the user's schedule over a date range, as JSON, a page at a time.
+    Patients and doctors get their own appointments; nurses get those of the doctors of their hospital.
+    Clients get a 304 response when the schedule hasn't changed since they last read the page.
+    :param request: requested page, with the date range, and the optional fields, doctors, cursor and page size
+                    in the query string
+    :return: the page of appointments, and the cursor of the next page; or the form errors, with a 400 status
+    """
+    account = get_account_from_user(request.user)
+    if isinstance(account, Nurse):
+        version = get_hospital_schedule_version(account.hospital)
+    elif isinstance(account, (Patient, Doctor)):
+        version = get_user_schedule_version(request.user)
+    else:
+        raise PermissionDenied()
+
+    form = ScheduleQueryForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+
+    def render_page():
+        appointments = get_schedule_appointments(account, form.cleaned_data['start'], form.cleaned_data['end'],
+                                                 doctors=form.cleaned_data['doctors'])
+        page, next_key = get_page(appointments, form.cleaned_data['fields'], after=form.cleaned_data['after'],
+                                  limit=form.cleaned_data['limit'])
+        return JsonResponse({
+            'start': form.cleaned_data['start'].isoformat(),
+            'end': form.cleaned_data['end'].isoformat(),
+            'fields': form.cleaned_data['fields'],
+            'appointments': [dict((field, serialize_value(value)) for field, value in appointment.items())
+                             for appointment in page],
+            'next': format_cursor(next_key) if next_key is not None else None,
+        })
+
+    return conditional_schedule_page(request, version, ('schedule', request.GET.urlencode()), render_page)
+
+
 @login_required
 @permission_required('reservation.add_appointment')
 def create_appointment_done(request):
@@ -233,9 +452,8 @@ def edit_appointment(request, appointment_id):
     if ProfileInformation.from_user(request.user).account_type == Doctor.ACCOUNT_TYPE:
         if request.method == 'POST':
             form = AppointmentFormForDoctor(request.POST, instance=appointment)
-            if form.is_valid():
-                CreateLogEntry(request.user.username, "Appointment edited.")
-                form.save()
+            if form.is_valid() and save_booking(form):
+                CreateLogEntry(request.user.username, "Appointment edited.", appointment)
                 return render(request, 'reservation/appointment/edit.html',
                               {'form': form, 'message': 'All changes saved.'})
         else:
@@ -243,9 +461,8 @@ def edit_appointment(request, appointment_id):
     else:
         if request.method == 'POST':
             form = AppointmentFormForPatient(request.POST, instance=appointment)
-            if form.is_valid():
-                CreateLogEntry(request.user.username, "Appointment edited.")
-                form.save()
+            if form.is_valid() and save_booking(form):
+                CreateLogEntry(request.user.username, "Appointment edited.", appointment)
                 return render(request, 'reservation/appointment/edit.html',
                               {'form': form, 'message': 'All changes saved.'})
         else:
@@ -271,13 +488,28 @@ def cancel_appointment(request, appointment_id):
     if request.method == 'POST':
         appointment.cancelled = True
         appointment.save()
-        CreateLogEntry(request.user.username, "Appointment canceled.")
+        CreateLogEntry(request.user.username, "Appointment canceled.", appointment)
 
         return render(request, 'reservation/appointment/cancel_done.html')
     else:
         return render(request, 'reservation/appointment/cancel.html', {'appointment': appointment})
 
 
+def save_booking(form, *args):
+    """
+    Save a valid form that books appointments.
+    The time slots are checked again when saving, as they may have been taken since the form was validated.
+    :param form: the form to save
+    :param args: the arguments to save the form with
+    :return: the saved object; or None if a time slot was taken, in which case the error is added to the form
+    """
+    try:
+        return form.save(*args)
+    except ValidationError as error:
+        form.add_error(None, error)
+        return None
+
+
 def is_month_valid(month):
     """Test whether or not the given month is a valid value."""
 
@@ -290,135 +522,59 @@ def is_year_valid(year):
     return 1000 < year < 9999
 
 
-def get_week(start_day, end_day):
+def get_week(start_day):
     """
-    Calculate the start and end days in a week.
+    Get the days of the week starting at the given day.
     Used for the weekview calendar
-    :param start_day: the datetime when the week starts
-    :param end_day: the datetime when the week should end
-    :return: list of weekdays
-    """
-    # keep original date object
-    start_date = start_day
-    end_date = end_day
-    # grab days for beginning and end of week
-    start_day = start_day.day
-    end_day = end_day.day
-    counter = start_day
-    if start_day < end_day:
-        weekday = []
-        while counter != end_day + 1:
-            weekday.append(start_date)
-            start_date += datetime.timedelta(days=1)
-            counter += 1
-    else:
-        weekday = [0] * 7
-        day_index = 6
-        while end_day >= 1 and day_index >= 0:
-            weekday[day_index] = end_date
-            end_date -= datetime.timedelta(days=1)
-            end_day -= 1
-            day_index -= 1
-
-        temp_index = 0
-        while day_index >= 0:
-            weekday[temp_index] = start_date
-            start_date += datetime.timedelta(days=1)
-            day_index -= 1
-            temp_index += 1
+    :param start_day: the date the week starts at, a Sunday
+    :return: tuple of the seven dates of the week, from the cached month grid
+    """
+    for week in get_month_grid(start_day.year, start_day.month):
+        if week[0] == start_day:
+            return week
 
-    return weekday
+    # Only weeks starting on a Sunday are in the month grids.
+    return tuple(start_day + datetime.timedelta(days=i) for i in range(7))
 
 
-def calculate_day(month, year):
+@functools.lru_cache(maxsize=256)
+def get_month_grid(year, month):
     """
-    Function is used to calculate the days in the month and
-    when it stars and ends. Extra days are added as place
-    holders
-    :param month: a month in the form of an int
+    Lay out the days of a month in weeks starting on Sunday, as shown on the month calendar.
+    The layout only depends on the month, so it is cached; the result is immutable, so it can be shared.
     :param year: a year
-    :return: list of days for a given month
+    :param month: a month in the form of an int
+    :return: tuple of weeks, each a tuple of seven dates; the first and last weeks are filled in
+             with the dates of the months before and after, except past the last date of December 9999
     """
-    if int(month) == 2 or int(month) == 1:
-        year = int(year) - 1
-        month = int(month) + 12
+    return tuple(tuple(week) for week in MONTH_CALENDAR.monthdatescalendar(year, month))
 
-    final = 1 + (2 * int(month)) + (3 * (int(month) + 1) / 5) + int(year) + math.floor(int(year) / 4) - \
-            math.floor(int(year) / 100) + math.floor(int(year) / 400) + 2
 
-    remainder = math.floor(final / 7)
-    remainder *= 7
-    final -= remainder
+def group_by_day(appointments):
+    """
+    Group the appointments of a month by the day of the month they are on.
+    :param appointments: Dictionaries of the fields of the appointments, including 'date', ordered by time.
+    :return: A dictionary from the day of the month to the list of its appointments, in the same order.
+    """
+    appointments_by_day = {}
+    for appointment in appointments:
+        appointments_by_day.setdefault(appointment['date'].day, []).append(appointment)
+    return appointments_by_day
 
-    thirtyone_months = ["12", "13", "3", "5", "7", "8", "10"]
 
-    if (int(year) / 4 and int(month) == 14) or (month == 14 and int(year) / 100 and int(year) / 400):
-        counter = 29
-    if month == 14:
-        counter = 28
-    elif month in thirtyone_months or month == 13:
-        counter = 31
-    else:
-        counter = 30
-
-    count = 1
-    days_one = []
-    days_two = []
-    days_three = []
-    days_four = []
-    days_five = []
-    days_six = []
-
-    # populate each of the weeks to be displayed
-    if (int(final) == 0):
-        final = 7
-
-    for i in range(0, int(final) - 1):
-        days_one.append("none")
-
-    for i in range(0, 7 - (int(final) - 1)):
-        days_one.append(count)
-        count += 1
-
-    for i in range(0, 7):
-        days_two.append(count)
-        count += 1
-
-    for i in range(0, 7):
-        days_three.append(count)
-        count += 1
-
-    for i in range(0, 7):
-        days_four.append(count)
-        count += 1
-    counter -= (21 + (7 - (final - 1)))
-    if int(counter) - 7 < 0 and int(counter) > 0:
-        for i in range(0, int(counter)):
-            days_five.append(count)
-            count += 1
-        for i in range(int(counter), 7):
-            days_five.append("none")
-        for i in range(0, 7):
-            days_six.append("none")
-    elif int(counter) == 0:
-        for i in range(0, 7):
-            days_five.append("none")
-            days_six.append("none")
-    else:
-        for i in range(0, 7):
-            days_five.append(count)
-            count += 1
-        counter -= 7
-        if int(counter) - 7 < 0 and int(counter) > 0:
-            for i in range(0, int(counter)):
-                days_six.append(count)
-                count += 1
-            for i in range(int(counter), 7):
-                days_six.append("none")
-
-    days = [days_one, days_two, days_three, days_four, days_five, days_six]
-
-    return days
+def group_by_date_and_doctor(appointments):
+    """
+    Group appointments by their date, and each day's appointments by doctor.
+    :param appointments: The appointments, ordered by date and then doctor.
+    :return: A dictionary from the date to a list of (doctor, list of their appointments that day) tuples.
+    """
+    appointments_by_date = {}
+    for appointment in appointments:
+        doctors = appointments_by_date.setdefault(appointment.date, [])
+        if not doctors or doctors[-1][0].pk != appointment.doctor_id:
+            doctors.append((appointment.doctor, []))
+        doctors[-1][1].append(appointment)
+    return appointments_by_date
 
 
 def parse_int(input):